@@ -1,3 +1,9 @@
+import os
+import sys
+
+# Make the wire protocol shared with the servers importable
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
 from app import App
 
 def main():
@@ -1,16 +1,46 @@
+import heapq
+import json
 import os
 import socket
-from typing import Optional, Tuple, List
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional, Tuple, List
+
+from common import wire_protocol as wp
+from common import archive_stream
+from common import manifest
+from common import compression
 
-BUFFER_SIZE = 1024
 BRIDGE_HOST = "127.0.0.1"
 BRIDGE_PORT = 12345
+UPLOAD_MODES = ("incremental", "archive", "files")
+UPLOAD_CONNECTIONS = 4  # Parallel connections used for "incremental" and "files" uploads
+TRANSFER_RETRIES = 5  # Reconnections attempted after an upload or download breaks off
+RETRY_DELAY = 1.0  # Seconds before the first reconnection, doubled after every attempt
+UPLOAD_STATE_FILE = ".upload_state"  # Per-dataset record of the last upload, used to resume it
+PART_SUFFIX = ".part"  # Suffix of a model file that is still being downloaded
 
 class TrainModel:
     """Handles file transfers and communication with the server."""
 
-    def __init__(self):
+    def __init__(self, upload_mode: str = "incremental", compress: bool = True, connections: int = UPLOAD_CONNECTIONS):
+        """
+        Args:
+            upload_mode (str): "incremental" sends a manifest of content hashes
+                and only the files the server does not have yet, "archive"
+                streams the dataset as a single tar stream, "files" sends one
+                frame per file.
+            compress (bool): Offer wire compression to the server.
+            connections (int): Number of parallel connections the files are
+                striped over. Archive uploads always use a single connection.
+        """
+        if upload_mode not in UPLOAD_MODES:
+            raise ValueError(f"Unknown upload mode: {upload_mode}")
         self.main_dataset_dir = os.path.join(os.getcwd(), "list_of_dataset")
+        self.upload_mode = upload_mode
+        self.compress = compress
+        self.connections = max(1, connections)
 
     def get_dataset_list(self) -> List[str]:
         """Retrieve a list of datasets available in the main directory.
@@ -27,11 +57,18 @@ class TrainModel:
             print(f"[ERROR] Dataset directory not found: {e}")
             return []
 
-    def send_files_to_server(self, dataset_name: str) -> Tuple[bool, str]:
+    def send_files_to_server(self, dataset_name: str, wait: bool = True) -> Tuple[bool, str]:
         """Send files from a dataset to the server.
 
+        An upload that broke off, here or in an earlier run, is resumed on the
+        same server as long as the dataset files did not change in between.
+
         Args:
             dataset_name (str): Name of the dataset.
+            wait (bool): Stay connected until the model is trained and received.
+                Otherwise disconnect once the server queued the training job,
+                whose progress can be followed with ``get_job_status`` and
+                whose model is downloaded with ``receive_best_model_from_server``.
 
         Returns:
             Tuple[bool, str]: Status and message of the operation.
@@ -43,26 +80,223 @@ class TrainModel:
             if not files:
                 return False, "No valid files found in the dataset!"
 
-            server_port = self._get_server_port()
-            if not server_port:
-                return False, "Failed to retrieve server port!"
-
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                client_socket.connect((BRIDGE_HOST, server_port))
-                client_socket.send(dataset_name.encode())
+            state = self._load_upload_state(dataset_path, files)
+            if state is None:
+                server_address = self._get_server_address(dataset_name=dataset_name)
+                if not server_address:
+                    return False, "Failed to retrieve server port!"
+                state = self._new_upload_state(dataset_path, files, server_address)
+            else:
+                print(f"[INFO] Resuming upload session {state['session_id']} on port {state['port']}.")
 
-                for file_name in files:
-                    file_path = os.path.join(dataset_path, file_name)
-                    self._send_file(client_socket, file_name, file_path)
+            attempt = 0
+            while True:
+                resuming = state["started"] and state["dataset_id"] is None
+                try:
+                    self._upload_and_receive(dataset_name, dataset_path, files, state, wait)
+                    break
+                except wp.RemoteError as e:
+                    if not resuming or state["dataset_id"] is not None:
+                        raise
+                    # The server no longer knows the session (expired or already complete): start over
+                    print(f"[WARNING] Cannot resume: {e}. Starting a new upload.")
+                    state = self._new_upload_state(dataset_path, files, self._state_address(state))
+                except (OSError, wp.ProtocolError) as e:
+                    if attempt == TRANSFER_RETRIES:
+                        raise
+                    self._wait_before_retry(attempt, e)
+                    attempt += 1
 
+            if not wait:
+                return True, f"Dataset sent, training job {state['job_id']} queued."
             return True, "Files sent to server successfully!"
+        except wp.RemoteError as e:
+            print(f"[ERROR] Server refused the transfer: {e}")
+            return False, f"Server error: {e}"
         except Exception as e:
             print(f"[ERROR] Sending files failed: {e}")
             return False, "Error sending files to server!"
 
+    def _upload_and_receive(self, dataset_name: str, dataset_path: str, files: List[str], state: dict,
+                            wait: bool = True) -> None:
+        """Upload (or resume uploading) a dataset, then receive the trained model over the same connection.
+
+        Once the server acknowledged the dataset only the model download is
+        picked up again. Without ``wait`` the connection is closed as soon as
+        the training job is queued.
+        """
+        with socket.create_connection(self._state_address(state)) as client_socket:
+            transfer = compression.negotiate(client_socket, self.compress)
+            offset = 0
+            if state["dataset_id"] is None:
+                resume = state["started"]
+                state["started"] = True
+                self._save_upload_state(dataset_path, state)
+                receipt = self.send_dataset(client_socket, dataset_name, dataset_path, files, transfer,
+                                            state["session_id"], resume, detach=not wait)
+                state["dataset_id"] = receipt["dataset_id"]
+                state["job_id"] = receipt.get("job_id")
+                self._save_upload_state(dataset_path, state)
+                print(f"[TRANSFER STATS] Upload: {transfer.stats.report()}")
+                print(f"[INFO] Training job {state['job_id']} queued at position {receipt.get('position', 0)}.")
+                if not wait:
+                    return
+            else:
+                offset = self._request_model(client_socket, dataset_name, dataset_path, state["dataset_id"],
+                                             state.get("job_id"))
+
+            transfer.stats = compression.TransferStats()
+            self._receive_model(client_socket, dataset_path, transfer, offset)
+            print(f"[TRANSFER STATS] Download: {transfer.stats.report()}")
+
+    def send_dataset(self, client_socket: socket.socket, dataset_name: str, dataset_path: str, files: List[str],
+                     transfer: Optional[compression.Transfer] = None, session_id: Optional[str] = None,
+                     resume: bool = False, detach: bool = False) -> dict:
+        """Upload a dataset over an open worker connection using the configured mode.
+
+        Args:
+            client_socket (socket.socket): The socket connection to the server.
+            dataset_name (str): Name of the dataset.
+            dataset_path (str): Path to the dataset.
+            files (List[str]): Names of the files to upload.
+            transfer (Optional[compression.Transfer]): Negotiated compression state.
+            session_id (Optional[str]): Upload session to open, or to resume.
+                A new one is made up when omitted.
+            resume (bool): Continue ``session_id`` from what the server already
+                holds instead of opening it.
+            detach (bool): Tell the server the model will be fetched later
+                rather than over this connection.
+
+        Returns:
+            dict: Receipt of the server: ``dataset_id`` the dataset is stored
+            under, ``job_id`` of the training queued on it and its ``position``
+            in the queue.
+
+        Raises:
+            wp.RemoteError: If the server refused the upload, e.g. because it
+                does not know the session to resume.
+        """
+        transfer = transfer or compression.Transfer()
+        session_id = session_id or uuid.uuid4().hex
+        streams = 1 if self.upload_mode == "archive" else min(self.connections, len(files))
+        session_request = json.dumps({"streams": streams, "detach": detach}).encode()
+        entries = manifest.build_manifest(dataset_path, files) if self.upload_mode == "incremental" else None
+
+        if resume:
+            wp.send_frame(client_socket, wp.OP_RESUME, session_id, session_request)
+        else:
+            wp.send_frame(client_socket, wp.OP_SESSION, session_id, session_request)
+            if self.upload_mode == "archive":
+                wp.send_frame(client_socket, wp.OP_ARCHIVE, dataset_name)
+            elif self.upload_mode == "incremental":
+                wp.send_frame(client_socket, wp.OP_MANIFEST, dataset_name, manifest.encode(entries))
+            else:
+                wp.send_frame(client_socket, wp.OP_DATASET, dataset_name)
+        reply = json.loads(wp.expect(wp.recv_frame(client_socket), wp.OP_RESUME if resume else wp.OP_SESSION).payload)
+        print(f"[INFO] Uploading as training job {reply['job_id']}.")
+        # Bytes of each file the server already holds durably
+        offsets = reply["offsets"] if resume else {}
+
+        if self.upload_mode == "archive":
+            remaining = [name for name, _, _ in self._remaining_items(dataset_path, files, offsets)]
+            archive_stream.send_archive(client_socket, dataset_path, remaining, transfer)
+            return self._upload_complete(client_socket)
+
+        if self.upload_mode == "incremental":
+            needed = set(manifest.decode(wp.expect(wp.recv_frame(client_socket), wp.OP_NEED).payload))
+            print(f"[INFO] Server needs {len(needed)} of {len(entries)} files.")
+            opcode, items = wp.OP_BLOB, []
+            for entry in entries:
+                if entry["digest"] in needed:
+                    needed.discard(entry["digest"])
+                    items.append((entry["digest"], os.path.join(dataset_path, entry["name"]),
+                                  offsets.get(entry["digest"], 0)))
+        else:
+            opcode = wp.OP_FILE
+            items = self._remaining_items(dataset_path, files, offsets)
+        if resume:
+            print(f"[INFO] Resuming with {len(items)} files left to send.")
+
+        stripes = self._stripe(items, streams)
+        with ThreadPoolExecutor(max_workers=max(1, streams - 1)) as pool:
+            extra_streams = [
+                pool.submit(self._send_stripe, client_socket.getpeername(), session_id, opcode, stripe)
+                for stripe in stripes[1:]
+            ]
+            self._send_items(client_socket, opcode, stripes[0], transfer)
+            wp.send_frame(client_socket, wp.OP_DONE)
+            for future in extra_streams:
+                transfer.stats.merge(future.result())
+        return self._upload_complete(client_socket)
+
+    def _remaining_items(self, dataset_path: str, files: List[str], offsets: dict) -> List[Tuple[str, str, int]]:
+        """Return the files the server does not fully hold yet, with the offset to continue from."""
+        items = []
+        for file_name in files:
+            file_path = os.path.join(dataset_path, file_name)
+            if file_name in offsets and offsets[file_name] >= os.path.getsize(file_path):
+                continue
+            items.append((file_name, file_path, offsets.get(file_name, 0)))
+        return items
+
+    def _upload_complete(self, client_socket: socket.socket) -> dict:
+        """Wait for the server to confirm the whole dataset arrived and return its receipt."""
+        frame = wp.expect(wp.recv_frame(client_socket), wp.OP_DONE)
+        return json.loads(frame.payload.decode())
+
+    def _stripe(self, items: List[Tuple[str, str, int]], streams: int) -> List[List[Tuple[str, str, int]]]:
+        """Spread files over the streams so that each stream carries about the same number of bytes.
+
+        Args:
+            items (List[Tuple[str, str, int]]): Frame names, local paths and
+                resume offsets of the files.
+            streams (int): Number of streams.
+
+        Returns:
+            List[List[Tuple[str, str, int]]]: One list of files per stream.
+        """
+        def remaining(item):
+            return os.path.getsize(item[1]) - item[2]
+
+        stripes = [[] for _ in range(max(1, streams))]
+        heap = [(0, index) for index in range(len(stripes))]
+        for item in sorted(items, key=remaining, reverse=True):
+            size, index = heapq.heappop(heap)
+            stripes[index].append(item)
+            heapq.heappush(heap, (size + remaining(item), index))
+        return stripes
+
+    def _send_items(self, client_socket: socket.socket, opcode: int, items: List[Tuple[str, str, int]],
+                    transfer: compression.Transfer) -> None:
+        """Send files as OP_FILE or OP_BLOB frames, each from its resume offset."""
+        for name, file_path, offset in items:
+            if opcode == wp.OP_FILE:
+                self._send_file(client_socket, name, file_path, transfer, offset)
+            else:
+                transfer.send_file(client_socket, opcode, name, file_path, offset)
+
+    def _send_stripe(self, server_address: tuple, session_id: str, opcode: int,
+                     items: List[Tuple[str, str, int]]) -> compression.TransferStats:
+        """Send one stripe of a session over its own connection.
+
+        Returns:
+            compression.TransferStats: Counters of this stream.
+        """
+        with socket.create_connection(server_address) as stream_socket:
+            transfer = compression.negotiate(stream_socket, self.compress)
+            wp.send_frame(stream_socket, wp.OP_JOIN, session_id)
+            self._send_items(stream_socket, opcode, items, transfer)
+            wp.send_frame(stream_socket, wp.OP_DONE)
+            wp.expect(wp.recv_frame(stream_socket), wp.OP_DONE)
+        return transfer.stats
+
     def receive_best_model_from_server(self, dataset_name: str) -> Tuple[bool, str]:
         """Receive the best model file from the server.
 
+        The model of the last training job of the dataset is asked from the
+        server that owns the job, as routed by the bridge. A download that broke
+        off is continued from the bytes already received.
+
         Args:
             dataset_name (str): Name of the dataset.
 
@@ -70,25 +304,180 @@ class TrainModel:
             Tuple[bool, str]: Status and message of the operation.
         """
         try:
-            server_port = self._get_server_port()
-            if not server_port:
+            dataset_path = os.path.join(self.main_dataset_dir, dataset_name)
+            state = self._read_upload_state(dataset_path) or {}
+            job_id = state.get("job_id")
+            if job_id:
+                server_address = self._get_server_address(job_id)
+            else:
+                server_address = (self._state_address(state) if state.get("port")
+                                  else self._get_server_address(dataset_name=dataset_name, purpose="model"))
+            if not server_address:
                 return False, "Failed to retrieve server port!"
 
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client_socket:
-                client_socket.connect((BRIDGE_HOST, server_port))
-                client_socket.send(dataset_name.encode())
-
-                model_name = client_socket.recv(BUFFER_SIZE).decode()
-                client_socket.send(b"ACK")
-
-                model_path = os.path.join(self.main_dataset_dir, dataset_name, model_name)
-                self._receive_file(client_socket, model_path)
+            for attempt in range(TRANSFER_RETRIES + 1):
+                try:
+                    with socket.create_connection(server_address) as client_socket:
+                        transfer = compression.negotiate(client_socket, self.compress)
+                        offset = self._request_model(client_socket, dataset_name, dataset_path,
+                                                     state.get("dataset_id"), job_id)
+                        self._receive_model(client_socket, dataset_path, transfer, offset)
+                    break
+                except wp.RemoteError:
+                    raise
+                except (OSError, wp.ProtocolError) as e:
+                    if attempt == TRANSFER_RETRIES:
+                        raise
+                    self._wait_before_retry(attempt, e)
 
             return True, "Best model received successfully!"
+        except wp.RemoteError as e:
+            print(f"[ERROR] Server refused the transfer: {e}")
+            return False, f"Server error: {e}"
         except Exception as e:
             print(f"[ERROR] Receiving model failed: {e}")
             return False, "Error receiving best model!"
 
+    def get_job_status(self, dataset_name: str) -> Tuple[bool, str]:
+        """Ask the bridge for the state of the last training job of a dataset.
+
+        Args:
+            dataset_name (str): Name of the dataset.
+
+        Returns:
+            Tuple[bool, str]: Status of the query and a summary of the job.
+        """
+        state = self._read_upload_state(os.path.join(self.main_dataset_dir, dataset_name)) or {}
+        if not state.get("job_id"):
+            return False, "No training job submitted for this dataset yet."
+        try:
+            status = self._query_job_status(state["job_id"])
+        except wp.RemoteError as e:
+            return False, f"Server error: {e}"
+        except (OSError, wp.ProtocolError, ValueError) as e:
+            print(f"[ERROR] Querying job status failed: {e}")
+            return False, "Error querying job status!"
+        timings = ", ".join(f"{name} {seconds:.0f}s" for name, seconds in status["timings"].items())
+        message = f"Job {status['job_id']}: {status['state']} ({timings})"
+        if status["state"] == "queued":
+            message += f", position {status['position']} in the queue"
+        if status["error"]:
+            message += f": {status['error']}"
+        return status["state"] != "failed", message
+
+    def watch_job_progress(self, dataset_name: str, on_event: Callable[[dict], None]) -> Tuple[bool, str]:
+        """Follow the last training job of a dataset epoch by epoch until it ends.
+
+        The events are streamed by the server that owns the job. A broken
+        stream is reopened from the last event received.
+
+        Args:
+            dataset_name (str): Name of the dataset.
+            on_event (Callable[[dict], None]): Called with every progress event:
+                ``epoch``, ``epochs``, ``epoch_time``, ``eta`` (seconds) and ``metrics``.
+
+        Returns:
+            Tuple[bool, str]: Whether the training succeeded, and a summary of the job.
+        """
+        state = self._read_upload_state(os.path.join(self.main_dataset_dir, dataset_name)) or {}
+        job_id = state.get("job_id")
+        if not job_id:
+            return False, "No training job submitted for this dataset yet."
+        events = []
+        attempt = 0
+        try:
+            while True:
+                try:
+                    status = self._follow_job(job_id, events, on_event)
+                    break
+                except wp.RemoteError:
+                    raise
+                except (OSError, wp.ProtocolError) as e:
+                    if attempt == TRANSFER_RETRIES:
+                        raise
+                    self._wait_before_retry(attempt, e)
+                    attempt += 1
+        except wp.RemoteError as e:
+            return False, f"Server error: {e}"
+        except Exception as e:
+            print(f"[ERROR] Watching training progress failed: {e}")
+            return False, "Error watching training progress!"
+        if status["state"] != "done":
+            return False, f"Job {job_id} {status['state']}: {status['error']}"
+        return True, f"Job {job_id} done in {status['timings'].get('training', 0):.0f}s."
+
+    def _follow_job(self, job_id: str, events: List[dict], on_event: Callable[[dict], None]) -> dict:
+        """Stream the progress events of a job after those already in ``events`` and return its final status."""
+        server_address = self._get_server_address(job_id)
+        if not server_address:
+            raise OSError("Failed to retrieve server port!")
+        with socket.create_connection(server_address) as client_socket:
+            wp.send_frame(client_socket, wp.OP_PROGRESS, job_id, json.dumps({"from": len(events)}).encode())
+            while True:
+                frame = wp.recv_frame(client_socket)
+                if frame.opcode != wp.OP_PROGRESS:
+                    return json.loads(wp.expect(frame, wp.OP_STATUS).payload)
+                events.append(json.loads(frame.payload))
+                on_event(events[-1])
+
+    def _query_job_status(self, job_id: str) -> dict:
+        """Return the status of a training job, relayed by the bridge from the server that owns it."""
+        with socket.create_connection((BRIDGE_HOST, BRIDGE_PORT)) as bridge_socket:
+            wp.send_frame(bridge_socket, wp.OP_STATUS, job_id)
+            return json.loads(wp.expect(wp.recv_frame(bridge_socket), wp.OP_STATUS).payload)
+
+    def _wait_before_retry(self, attempt: int, error: Exception) -> None:
+        """Back off exponentially before reconnecting after a broken transfer."""
+        delay = RETRY_DELAY * 2 ** attempt
+        print(f"[WARNING] Transfer interrupted ({error}), reconnecting in {delay:.0f}s.")
+        time.sleep(delay)
+
+    def _snapshot(self, dataset_path: str, files: List[str]) -> dict:
+        """Describe the dataset files well enough to notice when they change."""
+        snapshot = {}
+        for file_name in files:
+            stat = os.stat(os.path.join(dataset_path, file_name))
+            snapshot[file_name] = [stat.st_size, stat.st_mtime_ns]
+        return snapshot
+
+    def _read_upload_state(self, dataset_path: str) -> Optional[dict]:
+        """Return the record of the last upload of a dataset, if any."""
+        try:
+            with open(os.path.join(dataset_path, UPLOAD_STATE_FILE), "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _load_upload_state(self, dataset_path: str, files: List[str]) -> Optional[dict]:
+        """Return the record of an unfinished upload that can be resumed, if any."""
+        state = self._read_upload_state(dataset_path)
+        if (state is None or state.get("dataset_id") is not None or state.get("mode") != self.upload_mode
+                or state.get("files") != self._snapshot(dataset_path, files)):
+            return None
+        return state
+
+    def _new_upload_state(self, dataset_path: str, files: List[str], server_address: Tuple[str, int]) -> dict:
+        """Start the record of a new upload session."""
+        state = {
+            "session_id": uuid.uuid4().hex,
+            "host": server_address[0],
+            "port": server_address[1],
+            "mode": self.upload_mode,
+            "files": self._snapshot(dataset_path, files),
+            "started": False,  # The server may hold the session from here on
+            "dataset_id": None,  # Set once the server confirmed the whole dataset
+            "job_id": None,  # Training job the server queued on the dataset
+        }
+        self._save_upload_state(dataset_path, state)
+        return state
+
+    def _save_upload_state(self, dataset_path: str, state: dict) -> None:
+        """Write the upload record atomically."""
+        state_path = os.path.join(dataset_path, UPLOAD_STATE_FILE)
+        with open(state_path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(state_path + ".tmp", state_path)
+
     def _get_valid_files(self, dataset_path: str) -> List[str]:
         """Retrieve valid files from the dataset directory.
 
@@ -107,52 +496,107 @@ class TrainModel:
             print(f"[ERROR] Dataset path not found: {e}")
             return []
 
-    def _send_file(self, client_socket: socket.socket, file_name: str, file_path: str) -> None:
+    def _send_file(self, client_socket: socket.socket, file_name: str, file_path: str,
+                   transfer: compression.Transfer, offset: int = 0) -> None:
         """Send a single file to the server.
 
         Args:
             client_socket (socket.socket): The socket connection to the server.
             file_name (str): Name of the file.
             file_path (str): Path to the file.
+            transfer (compression.Transfer): Negotiated compression state.
+            offset (int): Bytes the server already holds, skipped when sending.
         """
-        client_socket.send(file_name.encode())
-        client_socket.recv(BUFFER_SIZE)  # Acknowledge
-        with open(file_path, "rb") as f:
-            while (chunk := f.read(BUFFER_SIZE)):
-                client_socket.send(chunk)
-            client_socket.send(b"<END>")
-            client_socket.recv(BUFFER_SIZE)  # Final Acknowledge
+        transfer.send_file(client_socket, wp.OP_FILE, file_name, file_path, offset)
 
-    def _receive_file(self, client_socket: socket.socket, file_path: str) -> None:
-        """Receive a file from the server.
+    def _request_model(self, client_socket: socket.socket, dataset_name: str, target_dir: str,
+                       dataset_id: Optional[str] = None, job_id: Optional[str] = None) -> int:
+        """Ask for the model of a dataset, continuing a partial download if there is one.
 
         Args:
             client_socket (socket.socket): The socket connection to the server.
-            file_path (str): Path where the file will be saved.
+            dataset_name (str): Name of the dataset.
+            target_dir (str): Directory the model is downloaded to.
+            dataset_id (Optional[str]): Upload whose model is wanted; the latest one when omitted.
+            job_id (Optional[str]): Training job whose model is wanted, preferred
+                over ``dataset_id`` by servers that still know the job.
+
+        Returns:
+            int: Offset the download was asked to continue from.
         """
-        with open(file_path, "wb") as f:
-            while True:
-                data = client_socket.recv(BUFFER_SIZE)
-                if data.endswith(b"<END>"):
-                    f.write(data[:-5])
-                    break
-                f.write(data)
+        part_path = os.path.join(target_dir, "best.pt" + PART_SUFFIX)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        request = {"offset": offset}
+        if dataset_id is not None:
+            request["dataset_id"] = dataset_id
+        if job_id is not None:
+            request["job_id"] = job_id
+        wp.send_frame(client_socket, wp.OP_FETCH, dataset_name, json.dumps(request).encode())
+        return offset
+
+    def _receive_model(self, client_socket: socket.socket, target_dir: str, transfer: compression.Transfer,
+                       offset: int = 0) -> str:
+        """Receive a model file from the server and verify it against the checksum that follows it.
 
-    def _get_server_port(self) -> Optional[int]:
-        """Retrieve the server port from the bridge.
+        The file is written to a ``.part`` file first and only renamed once its
+        checksum matches, so a broken download can be continued later.
+
+        Args:
+            client_socket (socket.socket): The socket connection to the server.
+            target_dir (str): Directory where the file will be saved.
+            transfer (compression.Transfer): Negotiated compression state.
+            offset (int): Bytes of the ``.part`` file to keep if the server continues the download.
+
+        Returns:
+            str: Path of the saved file.
+        """
+        _, flags, file_name, payload_len = wp.expect_header(client_socket, wp.OP_MODEL)
+        file_path = os.path.join(target_dir, os.path.basename(file_name))
+        part_path = file_path + PART_SUFFIX
+        offset = offset if flags & wp.FLAG_APPEND else 0
+        transfer.recv_file(client_socket, flags, payload_len, part_path, offset=offset)
+
+        checksum = wp.expect(wp.recv_frame(client_socket), wp.OP_CHECKSUM).payload.decode()
+        if manifest.file_digest(part_path) != checksum:
+            os.remove(part_path)
+            raise wp.ProtocolError(f"Checksum mismatch for {file_name}, download discarded")
+        os.replace(part_path, file_path)
+        return file_path
+
+    def _state_address(self, state: dict) -> Tuple[str, int]:
+        """Return the address of the server an upload record belongs to."""
+        return state.get("host") or BRIDGE_HOST, state["port"]  # Records of older versions have no host
+
+    def _get_server_address(self, job_id: Optional[str] = None, dataset_name: Optional[str] = None,
+                            purpose: str = "train") -> Optional[Tuple[str, int]]:
+        """Retrieve the server address from the bridge.
+
+        The least loaded server is returned when neither a job nor a dataset
+        is given.
+
+        Args:
+            job_id (Optional[str]): Training job whose server is wanted.
+            dataset_name (Optional[str]): Dataset the request is about; the bridge
+                prefers the server that already holds it.
+            purpose (str): ``"train"`` to upload the dataset, ``"model"`` to
+                download its model.
 
         Returns:
-            Optional[int]: The port number or None if an error occurs.
+            Optional[Tuple[str, int]]: The host and port, or None if an error occurs.
         """
         try:
             with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as bridge_socket:
                 bridge_socket.connect((BRIDGE_HOST, BRIDGE_PORT))
-                port_data = bridge_socket.recv(BUFFER_SIZE).decode().strip()
+                request = {"dataset": dataset_name, "purpose": purpose} if dataset_name and not job_id else None
+                wp.send_frame(bridge_socket, wp.OP_ROUTE, job_id or "",
+                              json.dumps(request).encode('utf-8') if request else b"")
+                frame = wp.expect(wp.recv_frame(bridge_socket), wp.OP_ROUTE)
+                port_data = frame.payload.decode().strip()
                 if port_data.isdigit():
-                    return int(port_data)
+                    return frame.name or BRIDGE_HOST, int(port_data)
                 else:
                     print(f"[ERROR] Invalid port data received: {port_data}")
                     return None
-        except (socket.error, ValueError) as e:
+        except (socket.error, ValueError, wp.ProtocolError) as e:
             print(f"[ERROR] Failed to connect to bridge: {e}")
             return None
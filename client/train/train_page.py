@@ -1,10 +1,14 @@
 import os
-import socket
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox
-from utils import clear_body, get_server_port
+from utils import clear_body
+from model.train_model import TrainModel
 
-BUFFER_SIZE = 1024  # Sesuaikan dengan ukuran buffer yang digunakan dalam komunikasi
+UPLOAD_MODE = "incremental"  # See TrainModel for the available upload modes
+UPLOAD_CONNECTIONS = 4  # Parallel connections for striped uploads
+PROGRESS_REFRESH_MS = 250  # How often the progress bar picks up new training events
 
 class TrainPage:
     def __init__(self, parent_frame):
@@ -13,6 +17,8 @@ class TrainPage:
         self.dataset_dir = "list_of_dataset"
         self.selected_dataset = tk.StringVar()
         self.selected_dataset.set("Select a dataset")
+        self.train_model = TrainModel(UPLOAD_MODE, connections=UPLOAD_CONNECTIONS)
+        self.progress_events = queue.Queue()  # Filled by the watcher thread, drained by the UI
         
         self.body_frame = tk.Frame(self.parent_frame)
         self.body_frame.pack(fill="both", expand=True)
@@ -50,9 +56,19 @@ class TrainPage:
         send_button = tk.Button(self.body_frame, text="Send Files to Server", command=self.send_files_to_server)
         send_button.pack(pady=5)
 
+        status_button = tk.Button(self.body_frame, text="Check Training Status", command=self.check_job_status)
+        status_button.pack(pady=5)
+
         receive_button = tk.Button(self.body_frame, text="Receive Best Model", command=self.receive_best_model_from_server)
         receive_button.pack(pady=5)
 
+        # Training progress
+        self.progress_bar = ttk.Progressbar(self.body_frame, orient="horizontal", length=300, mode="determinate")
+        self.progress_bar.pack(pady=5)
+
+        self.progress_label = tk.Label(self.body_frame, text="", font=("Arial", 10))
+        self.progress_label.pack(pady=5)
+
         # Error and Success labels
         self.error_label = tk.Label(self.body_frame, text="", font=("Arial", 10))
         self.error_label.pack(pady=5)
@@ -61,129 +77,80 @@ class TrainPage:
         self.success_label.pack(pady=5)
 
     def send_files_to_server(self):
-        """Send dataset files to the selected server."""
+        """Send dataset files to the selected server and queue a training job on them.
+
+        An upload that broke off earlier is resumed where it stopped. The page
+        does not wait for the training: its state is checked with "Check
+        Training Status" and the model is downloaded with "Receive Best Model".
+        """
         dataset_name = self.selected_dataset.get()
         if dataset_name == "Select a dataset":
             self.error_label.config(text="Please select a valid dataset.", fg="red")
             return
 
-        # Step 1: Retrieve the least loaded server's port
-        server_port = get_server_port()
-        if not server_port:
-            self.error_label.config(text="Failed to get server information. Please try again.", fg="red")
-            return
-
-        # Step 2: Get the path of the dataset and prepare the list of files to send
-        dataset_path = os.path.join(self.dataset_dir, dataset_name)
         print(f"Sending files from dataset: {dataset_name}")
+        success, message = self.train_model.send_files_to_server(dataset_name, wait=False)
+        self._show_result(success, message)
+        if success:
+            self._watch_progress(dataset_name)
 
-        # Include .png, .jpg, .txt, and .json files
-        files_to_send = [f for f in os.listdir(dataset_path) if f.endswith(('.png', '.jpg', '.txt', '.json'))]
-
-        if not files_to_send:
-            self.error_label.config(text="No .png, .jpg, .txt, or .json files found in the selected dataset.", fg="red")
+    def check_job_status(self):
+        """Show the state of the last training job of the selected dataset."""
+        dataset_name = self.selected_dataset.get()
+        if dataset_name == "Select a dataset":
+            self.error_label.config(text="Please select a valid dataset.", fg="red")
             return
 
-        try:
-            # Step 3: Connect to the server
-            client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            client_socket.connect(("127.0.0.1", server_port))
-            print(f"Connected to server on port {server_port}.")
-
-            # Step 4: Send the dataset name to the server
-            client_socket.send(dataset_name.encode())
-            client_socket.recv(BUFFER_SIZE)  # Acknowledge dataset name
-
-            # Step 5: Send all files (.png, .jpg, .txt, .json) to the server
-            for file_name in files_to_send:
-                file_path = os.path.join(dataset_path, file_name)
-                print(f"Sending file: {file_name}")
-                
-                # Send file name to the server
-                client_socket.send(file_name.encode())
-                client_socket.recv(BUFFER_SIZE)  # Acknowledge file name
-
-                # Send file content to the server
-                with open(file_path, "rb") as f:
-                    while (chunk := f.read(BUFFER_SIZE)):
-                        client_socket.send(chunk)
-
-                # Indicate end of file transfer for this file
-                client_socket.send(b"<END>")
-                client_socket.recv(BUFFER_SIZE)  # Acknowledge end of transfer
-                print(f"File {file_name} sent successfully.")
-
-            # Step 6: Indicate all files have been sent
-            client_socket.send(b"<DONE>")
-            print("All files sent successfully.")
-
-            # Step 7: Receive model.txt from the server
-            model_name = client_socket.recv(BUFFER_SIZE).decode()
-            client_socket.send(b"ACK")  # Acknowledge model.txt name
-
-            model_path = os.path.join(dataset_path, model_name)
-            print(f"Receiving {model_name}")
-
-            with open(model_path, "wb") as model_file:
-                while True:
-                    data = client_socket.recv(BUFFER_SIZE)
-                    if data.endswith(b"<END>"):
-                        model_file.write(data[:-5])  # Remove <END> marker
-                        break
-                    model_file.write(data)
-
-            client_socket.send(b"ACK")  # Acknowledge model file transfer
-            print(f"Model file saved to {model_path}")
-            self.success_label.config(text="Files and model received successfully.", fg="green")
-
-        except Exception as e:
-            print(f"Error sending files: {e}")
-            self.error_label.config(text=f"Error sending files: {e}", fg="red")
-        finally:
-            client_socket.close()
+        success, message = self.train_model.get_job_status(dataset_name)
+        self._show_result(success, message)
 
     def receive_best_model_from_server(self):
-        """Receive the best model file from the server."""
+        """Receive the best model file from the server, continuing a partial download."""
         dataset_name = self.selected_dataset.get()
         if dataset_name == "Select a dataset":
             self.error_label.config(text="Please select a valid dataset.", fg="red")
             return
 
-        # Step 1: Retrieve the least loaded server's port
-        server_port = get_server_port()
-        if not server_port:
-            self.error_label.config(text="Failed to get server information. Please try again.", fg="red")
-            return
-
-        # Connect to the server
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect(("127.0.0.1", server_port))
-
-        try:
-            # Send dataset name to the server
-            client_socket.send(dataset_name.encode())
-            client_socket.recv(BUFFER_SIZE)  # Acknowledge dataset name
-
-            # Step 2: Receive the best.pt file
-            file_name = client_socket.recv(BUFFER_SIZE).decode()  # Receive file name
-            client_socket.send(b"ACK")  # Acknowledge file name
-
-            file_path = os.path.join(self.dataset_dir, dataset_name, file_name)
-
-            with open(file_path, "wb") as best_model_file:
-                while True:
-                    data = client_socket.recv(BUFFER_SIZE)
-                    if data.endswith(b"<END>"):
-                        best_model_file.write(data[:-5])  # Remove <END> marker
-                        break
-                    best_model_file.write(data)
-
-            client_socket.send(b"ACK")  # Acknowledge file transfer
-            print(f"Best model {file_name} received and saved at {file_path}")
-
-            self.success_label.config(text="Best model received successfully.", fg="green")
-        except Exception as e:
-            print(f"Error receiving best model: {e}")
-            self.error_label.config(text=f"Error receiving best model: {e}", fg="red")
-        finally:
-            client_socket.close()
+        success, message = self.train_model.receive_best_model_from_server(dataset_name)
+        self._show_result(success, message)
+
+    def _watch_progress(self, dataset_name):
+        """Follow the training of a dataset in the background and show it in the progress bar."""
+        self.progress_bar["value"] = 0
+        self.progress_label.config(text="Waiting for the first epoch...")
+
+        def watch():
+            result = self.train_model.watch_job_progress(dataset_name, self.progress_events.put)
+            self.progress_events.put(result)
+
+        threading.Thread(target=watch, daemon=True).start()
+        self.body_frame.after(PROGRESS_REFRESH_MS, self._refresh_progress)
+
+    def _refresh_progress(self):
+        """Show the training events received since the last refresh."""
+        if not self.progress_bar.winfo_exists():
+            return  # The page was left
+        while not self.progress_events.empty():
+            event = self.progress_events.get()
+            if isinstance(event, tuple):
+                # The training ended
+                success, message = event
+                self._show_result(success, message)
+                self.progress_label.config(text="")
+                if success:
+                    self.progress_bar["value"] = 100
+                return
+            self.progress_bar["value"] = 100 * event["epoch"] / event["epochs"]
+            minutes, seconds = divmod(int(event["eta"]), 60)
+            self.progress_label.config(text=f"Epoch {event['epoch']}/{event['epochs']}, "
+                                            f"{event['epoch_time']:.1f}s per epoch, ETA {minutes}m {seconds:02d}s")
+        self.body_frame.after(PROGRESS_REFRESH_MS, self._refresh_progress)
+
+    def _show_result(self, success, message):
+        """Show the outcome of a transfer in the success or error label."""
+        if success:
+            self.error_label.config(text="")
+            self.success_label.config(text=message, fg="green")
+        else:
+            self.success_label.config(text="")
+            self.error_label.config(text=message, fg="red")
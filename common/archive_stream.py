@@ -0,0 +1,63 @@
+"""
+Single-stream dataset upload built on the wire protocol.
+
+The client packs the dataset into a tar stream on the fly and ships it as a
+sequence of ``OP_ARCHIVE_DATA`` frames terminated by ``OP_DONE``; no temporary
+archive is ever written to disk. The worker unpacks each member as soon as
+its bytes have arrived, with ``wire_async.receive_archive``.
+Each frame is compressed on its own when the connection negotiated a codec
+and a sample of the frame compresses well.
+"""
+import os
+import socket
+import tarfile
+from typing import Iterable
+
+from common import wire_protocol as wp
+from common.compression import Transfer
+
+ARCHIVE_CHUNK_SIZE = 256 * 1024  # Tar bytes buffered before a frame is sent
+
+
+class FrameWriter:
+    """Write-only file object that sends its data as ``OP_ARCHIVE_DATA`` frames."""
+
+    def __init__(self, sock: socket.socket, transfer: Transfer) -> None:
+        self.sock = sock
+        self.transfer = transfer
+        self.pending = bytearray()
+
+    def write(self, data: bytes) -> int:
+        self.pending += data
+        if len(self.pending) >= ARCHIVE_CHUNK_SIZE:
+            self.flush()
+        return len(data)
+
+    def flush(self) -> None:
+        if self.pending:
+            self.transfer.send_payload(self.sock, wp.OP_ARCHIVE_DATA, bytes(self.pending))
+            self.pending.clear()
+
+    def close(self) -> None:
+        self.flush()
+
+
+def send_archive(sock: socket.socket, dataset_dir: str, file_names: Iterable[str], transfer: Transfer = None) -> None:
+    """Stream files of a dataset directory as one tar archive.
+
+    The caller is expected to have sent ``OP_ARCHIVE`` first; this function
+    finishes the stream with ``OP_DONE``.
+
+    Args:
+        sock (socket.socket): Connected socket.
+        dataset_dir (str): Directory holding the files.
+        file_names (Iterable[str]): Names of the files to include.
+        transfer (Transfer): Compression state of the connection.
+    """
+    writer = FrameWriter(sock, transfer or Transfer())
+    with tarfile.open(fileobj=writer, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for file_name in file_names:
+            tar.add(os.path.join(dataset_dir, file_name), arcname=file_name, recursive=False)
+    writer.close()
+    wp.send_frame(sock, wp.OP_DONE)
+
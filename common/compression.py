@@ -0,0 +1,317 @@
+"""
+Negotiated wire compression.
+
+The client opens a connection with ``OP_HELLO`` listing the codecs it
+supports; the worker answers with the codec it picked (or none). Files that
+are worth compressing are then sent as a frame flagged ``FLAG_COMPRESSED``
+with an empty payload, followed by ``OP_CHUNK`` frames carrying the
+compressed stream and an empty ``OP_CHUNK`` terminator.
+
+zlib is always available. zstd and lz4 are used when the ``zstandard`` or
+``lz4`` packages are installed on both ends.
+"""
+import json
+import socket
+import time
+import zlib
+from typing import List, Optional, Tuple
+
+from common import wire_protocol as wp
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+ZLIB_LEVEL = 3
+ZSTD_LEVEL = 3
+READ_SIZE = 1024 * 1024
+SAMPLE_SIZE = 64 * 1024
+MIN_RATIO = 0.9  # Compressed/raw ratio above which a payload is sent raw
+MIN_SIZE = 512  # Payloads smaller than this are never compressed
+INCOMPRESSIBLE_EXTENSIONS = (
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".mp4", ".zip", ".gz", ".bz2", ".xz", ".zst", ".lz4",
+)
+
+
+class ZlibCodec:
+    name = "zlib"
+
+    def compressor(self):
+        return zlib.compressobj(ZLIB_LEVEL)
+
+    def decompressor(self):
+        return zlib.decompressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return zlib.compress(data, ZLIB_LEVEL)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zlib.decompress(data)
+
+
+class ZstdCodec:
+    name = "zstd"
+
+    def compressor(self):
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+
+    def decompressor(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return zstandard.ZstdDecompressor().decompressobj().decompress(data)
+
+
+class _Lz4Compressor:
+    """Give ``LZ4FrameCompressor`` the ``compress``/``flush`` interface of zlib."""
+
+    def __init__(self) -> None:
+        self._compressor = lz4_frame.LZ4FrameCompressor()
+        self._header = self._compressor.begin()
+
+    def compress(self, data: bytes) -> bytes:
+        out = self._header + self._compressor.compress(data)
+        self._header = b""
+        return out
+
+    def flush(self) -> bytes:
+        return self._header + self._compressor.flush()
+
+
+class Lz4Codec:
+    name = "lz4"
+
+    def compressor(self):
+        return _Lz4Compressor()
+
+    def decompressor(self):
+        return lz4_frame.LZ4FrameDecompressor()
+
+    def compress(self, data: bytes) -> bytes:
+        return lz4_frame.compress(data)
+
+    def decompress(self, data: bytes) -> bytes:
+        return lz4_frame.decompress(data)
+
+
+def available_codecs() -> List[str]:
+    """Return the codecs usable on this machine, fastest first."""
+    names = []
+    if lz4_frame is not None:
+        names.append(Lz4Codec.name)
+    if zstandard is not None:
+        names.append(ZstdCodec.name)
+    names.append(ZlibCodec.name)
+    return names
+
+
+def get_codec(name: Optional[str]):
+    """Return a codec instance by name, or ``None`` for no compression."""
+    codecs = {ZlibCodec.name: ZlibCodec, ZstdCodec.name: ZstdCodec, Lz4Codec.name: Lz4Codec}
+    if name is None:
+        return None
+    if name not in codecs or name not in available_codecs():
+        raise wp.ProtocolError(f"Unsupported codec: {name}")
+    return codecs[name]()
+
+
+class TransferStats:
+    """Byte and time counters for one transfer, in both directions."""
+
+    def __init__(self) -> None:
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compress_seconds = 0.0
+        self.decompress_seconds = 0.0
+        self.compressed_files = 0
+        self.raw_files = 0
+        self.started = time.perf_counter()
+
+    def add(self, raw_bytes: int, wire_bytes: int, compressed: bool) -> None:
+        self.raw_bytes += raw_bytes
+        self.wire_bytes += wire_bytes
+        if compressed:
+            self.compressed_files += 1
+        else:
+            self.raw_files += 1
+
+    def merge(self, other: "TransferStats") -> None:
+        """Add the counters of another transfer, e.g. a parallel stream of the same upload."""
+        self.raw_bytes += other.raw_bytes
+        self.wire_bytes += other.wire_bytes
+        self.compress_seconds += other.compress_seconds
+        self.decompress_seconds += other.decompress_seconds
+        self.compressed_files += other.compressed_files
+        self.raw_files += other.raw_files
+
+    def report(self) -> str:
+        """Summarise the transfer in a single log line."""
+        elapsed = time.perf_counter() - self.started
+        ratio = self.wire_bytes / self.raw_bytes if self.raw_bytes else 1.0
+        return (
+            f"{self.raw_bytes} bytes -> {self.wire_bytes} on the wire (ratio {ratio:.2f}), "
+            f"{self.compressed_files} compressed / {self.raw_files} raw, "
+            f"compress {self.compress_seconds:.3f}s, decompress {self.decompress_seconds:.3f}s, "
+            f"total {elapsed:.3f}s"
+        )
+
+
+class Transfer:
+    """
+    Compression state of one connection.
+
+    Attributes:
+        codec: Negotiated codec, or ``None`` when the connection is uncompressed.
+        stats (TransferStats): Counters for everything sent and received.
+    """
+
+    def __init__(self, codec=None) -> None:
+        self.codec = codec
+        self.stats = TransferStats()
+
+    def should_compress(self, file_path: str) -> bool:
+        """Decide from the extension, then from a compressed sample, whether a file is worth compressing."""
+        if self.codec is None or file_path.lower().endswith(INCOMPRESSIBLE_EXTENSIONS):
+            return False
+        with open(file_path, "rb") as f:
+            sample = f.read(SAMPLE_SIZE)
+        return self._compressible(sample)
+
+    def _compressible(self, sample: bytes) -> bool:
+        if len(sample) < MIN_SIZE:
+            return False
+        started = time.perf_counter()
+        ratio = len(self.codec.compress(sample)) / len(sample)
+        self.stats.compress_seconds += time.perf_counter() - started
+        return ratio < MIN_RATIO
+
+    def send_file(self, sock: socket.socket, opcode: int, name: str, file_path: str, offset: int = 0) -> int:
+        """Send a file, compressed when the codec and the content allow it.
+
+        Args:
+            offset (int): Resume point, see ``wire_protocol.send_file``.
+
+        Returns:
+            int: Number of raw bytes sent.
+        """
+        if not self.should_compress(file_path):
+            size = wp.send_file(sock, opcode, name, file_path, offset)
+            self.stats.add(size, size, compressed=False)
+            return size
+
+        flags = wp.FLAG_COMPRESSED | (wp.FLAG_APPEND if offset else 0)
+        wp.send_frame(sock, opcode, name, flags=flags)
+        compressor = self.codec.compressor()
+        raw_bytes = wire_bytes = 0
+        with open(file_path, "rb") as f:
+            f.seek(offset)
+            while True:
+                chunk = f.read(READ_SIZE)
+                started = time.perf_counter()
+                out = compressor.compress(chunk) if chunk else compressor.flush()
+                self.stats.compress_seconds += time.perf_counter() - started
+                if out:
+                    wp.send_frame(sock, wp.OP_CHUNK, payload=out)
+                    wire_bytes += len(out)
+                if not chunk:
+                    break
+                raw_bytes += len(chunk)
+        wp.send_frame(sock, wp.OP_CHUNK)
+        self.stats.add(raw_bytes, wire_bytes, compressed=True)
+        return raw_bytes
+
+    def recv_file(self, sock: socket.socket, flags: int, payload_len: int, file_path: str,
+                  buffer: bytearray = None, hasher=None, offset: int = 0, on_write=None) -> None:
+        """Receive a file frame body sent by ``send_file``.
+
+        ``offset`` and ``on_write`` have the meaning documented in ``wire_protocol.recv_file``.
+        """
+        if not flags & wp.FLAG_COMPRESSED:
+            wp.recv_file(sock, payload_len, file_path, buffer, hasher, offset, on_write)
+            self.stats.add(payload_len, payload_len, compressed=False)
+            return
+
+        if self.codec is None:
+            raise wp.ProtocolError("Compressed frame received but no codec was negotiated")
+        decompressor = self.codec.decompressor()
+        raw_bytes = wire_bytes = 0
+        with wp.open_for_write(file_path, offset) as f:
+            while True:
+                chunk = wp.expect(wp.recv_frame(sock), wp.OP_CHUNK).payload
+                if not chunk:
+                    break
+                wire_bytes += len(chunk)
+                started = time.perf_counter()
+                data = decompressor.decompress(chunk)
+                self.stats.decompress_seconds += time.perf_counter() - started
+                if hasher is not None:
+                    hasher.update(data)
+                written = 0
+                while written < len(data):
+                    written += f.write(data[written:])
+                raw_bytes += len(data)
+                if on_write is not None:
+                    on_write(f, offset + raw_bytes)
+        self.stats.add(raw_bytes, wire_bytes, compressed=True)
+
+    def send_payload(self, sock: socket.socket, opcode: int, data: bytes) -> None:
+        """Send an in-memory payload, compressed when a sample shows it pays off."""
+        if self.codec is not None and self._compressible(data[:SAMPLE_SIZE]):
+            started = time.perf_counter()
+            out = self.codec.compress(data)
+            self.stats.compress_seconds += time.perf_counter() - started
+            if len(out) < len(data):
+                wp.send_frame(sock, opcode, payload=out, flags=wp.FLAG_COMPRESSED)
+                self.stats.add(len(data), len(out), compressed=True)
+                return
+        wp.send_frame(sock, opcode, payload=data)
+        self.stats.add(len(data), len(data), compressed=False)
+
+    def decode_payload(self, flags: int, data: bytes) -> bytes:
+        """Inverse of ``send_payload`` for a received frame payload."""
+        if not flags & wp.FLAG_COMPRESSED:
+            self.stats.add(len(data), len(data), compressed=False)
+            return data
+        if self.codec is None:
+            raise wp.ProtocolError("Compressed frame received but no codec was negotiated")
+        started = time.perf_counter()
+        out = self.codec.decompress(data)
+        self.stats.decompress_seconds += time.perf_counter() - started
+        self.stats.add(len(out), len(data), compressed=True)
+        return out
+
+
+def negotiate(sock: socket.socket, enabled: bool = True) -> Transfer:
+    """Client side of the handshake: offer our codecs and use the one the worker picks."""
+    offered = available_codecs() if enabled else []
+    wp.send_frame(sock, wp.OP_HELLO, payload=json.dumps({"codecs": offered}).encode("utf-8"))
+    reply = json.loads(wp.expect(wp.recv_frame(sock), wp.OP_HELLO).payload.decode("utf-8"))
+    return Transfer(get_codec(reply.get("codec")))
+
+
+def hello_reply(frame: wp.Frame, enabled: bool = True) -> Tuple[bytes, Transfer]:
+    """Pick the first of our codecs the client also offers.
+
+    Returns:
+        Tuple[bytes, Transfer]: Payload of the ``OP_HELLO`` reply and the
+        compression state of the connection.
+    """
+    offered = json.loads(frame.payload.decode("utf-8")).get("codecs", []) if enabled else []
+    chosen = next((name for name in available_codecs() if name in offered), None)
+    return json.dumps({"codec": chosen}).encode("utf-8"), Transfer(get_codec(chosen))
+
+
+def accept_hello(sock: socket.socket, frame: wp.Frame, enabled: bool = True) -> Transfer:
+    """Worker side of the handshake: answer with the codec picked by ``hello_reply``."""
+    reply, transfer = hello_reply(frame, enabled)
+    wp.send_frame(sock, wp.OP_HELLO, payload=reply)
+    return transfer
@@ -0,0 +1,65 @@
+"""
+Dataset manifests for content-addressed uploads.
+
+A manifest lists every file of a dataset with the SHA-256 of its content.
+The worker answers with the digests it does not hold yet, so only new or
+edited files travel over the network.
+"""
+import hashlib
+import json
+import os
+import string
+from typing import Dict, Iterable, List
+
+HASH_NAME = "sha256"
+DIGEST_LENGTH = 64
+READ_SIZE = 1024 * 1024
+
+
+def file_digest(file_path: str) -> str:
+    """Return the hex SHA-256 of a file."""
+    digest = hashlib.new(HASH_NAME)
+    with open(file_path, "rb") as f:
+        while chunk := f.read(READ_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def is_valid_digest(digest: str) -> bool:
+    """Check that a string is a lowercase hex SHA-256 digest."""
+    return len(digest) == DIGEST_LENGTH and all(c in string.hexdigits[:16] for c in digest)
+
+
+def build_manifest(dataset_dir: str, file_names: Iterable[str]) -> List[Dict]:
+    """Describe the given files of a dataset directory.
+
+    Returns:
+        List[Dict]: One ``{"name", "digest", "size"}`` entry per file.
+    """
+    manifest = []
+    for file_name in file_names:
+        file_path = os.path.join(dataset_dir, file_name)
+        manifest.append({
+            "name": file_name,
+            "digest": file_digest(file_path),
+            "size": os.path.getsize(file_path),
+        })
+    return manifest
+
+
+def encode(entries) -> bytes:
+    """Serialise a manifest or a list of digests for a frame payload."""
+    return json.dumps(entries, separators=(",", ":")).encode("utf-8")
+
+
+def decode(payload: bytes):
+    """Inverse of ``encode``."""
+    return json.loads(payload.decode("utf-8"))
+
+
+def dataset_digest(entries: Iterable[Dict]) -> str:
+    """Return a SHA-256 identifying the content of a whole dataset, independent of file order."""
+    digest = hashlib.new(HASH_NAME)
+    for name, file_digest_hex in sorted((entry["name"], entry["digest"]) for entry in entries):
+        digest.update(f"{name}\0{file_digest_hex}\n".encode("utf-8"))
+    return digest.hexdigest()
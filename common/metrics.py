@@ -0,0 +1,237 @@
+"""
+Counters, gauges and histograms of the bridge and the worker servers.
+
+Recording is an addition without a lock, a fraction of a microsecond, so
+it is done inline on the hot paths. Each metric is meant to be recorded
+from one thread, e.g. the event loop; recording one from several threads
+at once may rarely lose an update, which monitoring tolerates. Figures a
+component already keeps, such as queue lengths or cache counters, are
+registered as functions instead, read only when the metrics are collected.
+A Registry is rendered in the Prometheus text format, served on its own
+local port by ``serve_prometheus``, or summarised as JSON for the
+``OP_STATS`` opcode.
+"""
+import asyncio
+import bisect
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+                   5.0, 10.0)  # Seconds, for requests and probes
+DURATION_BUCKETS = (0.1, 0.5, 1.0, 5.0, 15.0, 30.0, 60.0, 120.0, 300.0, 600.0, 1200.0, 1800.0, 3600.0, 7200.0,
+                    14400.0)  # Seconds, for transfers and job phases
+THROUGHPUT_BUCKETS = tuple(float(2 ** exponent) for exponent in range(16, 34, 2))  # Bytes per second, 64 KiB to 8 GiB
+QUANTILES = (0.5, 0.9, 0.99)  # Quantiles estimated for the JSON summary of a histogram
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"  # Prometheus text exposition format
+SCRAPE_TIMEOUT = 5.0  # Seconds a metrics client may take to send its request
+
+
+def _format_value(value: float) -> str:
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if value == int(value) and abs(value) < 1e15:
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n") for value in labels.values())
+    return "{" + ",".join(f'{name}="{value}"' for name, value in zip(labels, escaped)) + "}"
+
+
+class Counter:
+    """
+    Value that only goes up, e.g. requests answered or bytes received.
+
+    Attributes:
+        labels (Dict[str, str]): Labels of this series.
+    """
+
+    def __init__(self, labels: Dict[str, str], function: Optional[Callable[[], float]] = None) -> None:
+        self.labels = labels
+        self._function = function
+        self._value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self._value += amount
+
+    @property
+    def value(self) -> float:
+        return self._function() if self._function is not None else self._value
+
+
+class Gauge(Counter):
+    """
+    Value that goes up and down, e.g. jobs queued or connections open.
+    """
+
+    def set(self, value: float) -> None:
+        self._value = value
+
+    def dec(self, amount: float = 1) -> None:
+        self.inc(-amount)
+
+
+class Histogram:
+    """
+    Distribution of observed values, counted in buckets by upper bound.
+
+    Attributes:
+        labels (Dict[str, str]): Labels of this series.
+        buckets (Tuple[float, ...]): Upper bounds of the buckets, ascending; values above the last count in ``+Inf``.
+    """
+
+    def __init__(self, labels: Dict[str, str], buckets: Sequence[float]) -> None:
+        self.labels = labels
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self._counts[bisect.bisect_left(self.buckets, value)] += 1
+        self._sum += value
+
+    def state(self) -> Tuple[List[int], float]:
+        """Return the cumulative count of each bucket, ``+Inf`` last, and the sum of the values."""
+        counts, total = list(self._counts), self._sum
+        for index in range(1, len(counts)):
+            counts[index] += counts[index - 1]
+        return counts, total
+
+    def quantile(self, fraction: float, cumulative: Optional[List[int]] = None) -> Optional[float]:
+        """Estimate a quantile by linear interpolation within its bucket, as Prometheus does; ``None`` if empty."""
+        cumulative = cumulative if cumulative is not None else self.state()[0]
+        if not cumulative[-1]:
+            return None
+        rank = fraction * cumulative[-1]
+        index = bisect.bisect_left(cumulative, rank)
+        if index >= len(self.buckets):
+            return self.buckets[-1]  # In the +Inf bucket: the largest finite bound is the best guess
+        lower = self.buckets[index - 1] if index > 0 else 0.0
+        below = cumulative[index - 1] if index > 0 else 0
+        in_bucket = cumulative[index] - below
+        return lower + (self.buckets[index] - lower) * ((rank - below) / in_bucket if in_bucket else 1.0)
+
+
+class Registry:
+    """
+    Metrics of one process, by name; a name may have several series with different labels.
+    """
+
+    def __init__(self) -> None:
+        self._families: Dict[str, Tuple[str, str, List]] = {}  # Name -> (type, help, series)
+        self._lock = threading.Lock()
+
+    def _add(self, kind: str, name: str, help_text: str, metric):
+        with self._lock:
+            family = self._families.setdefault(name, (kind, help_text, []))
+            if family[0] != kind:
+                raise ValueError(f"Metric {name} is already registered as a {family[0]}")
+            family[2].append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None,
+                function: Optional[Callable[[], float]] = None) -> Counter:
+        """
+        Register a counter.
+
+        Args:
+            name (str): Metric name, ending in ``_total`` by convention.
+            help_text (str): What it counts.
+            labels (Optional[Dict[str, str]]): Labels telling this series apart from others of the same name.
+            function (Optional[Callable[[], float]]): Returns the value when collected, for a count kept elsewhere.
+        """
+        return self._add("counter", name, help_text, Counter(labels or {}, function))
+
+    def gauge(self, name: str, help_text: str, labels: Optional[Dict[str, str]] = None,
+              function: Optional[Callable[[], float]] = None) -> Gauge:
+        """Register a gauge, see ``counter``."""
+        return self._add("gauge", name, help_text, Gauge(labels or {}, function))
+
+    def histogram(self, name: str, help_text: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  labels: Optional[Dict[str, str]] = None) -> Histogram:
+        """Register a histogram with the given bucket upper bounds, see ``counter``."""
+        return self._add("histogram", name, help_text, Histogram(labels or {}, buckets))
+
+    def _collect(self) -> List[Tuple[str, str, str, List]]:
+        with self._lock:
+            return [(name, kind, help_text, list(series)) for name, (kind, help_text, series) in
+                    sorted(self._families.items())]
+
+    def render(self) -> str:
+        """Return every metric in the Prometheus text exposition format."""
+        lines = []
+        for name, kind, help_text, series in self._collect():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for metric in series:
+                if kind != "histogram":
+                    lines.append(f"{name}{_format_labels(metric.labels)} {_format_value(metric.value)}")
+                    continue
+                cumulative, total = metric.state()
+                for bound, count in zip(metric.buckets + (math.inf,), cumulative):
+                    labels = dict(metric.labels, le=_format_value(bound))
+                    lines.append(f"{name}_bucket{_format_labels(labels)} {count}")
+                lines.append(f"{name}_sum{_format_labels(metric.labels)} {_format_value(total)}")
+                lines.append(f"{name}_count{_format_labels(metric.labels)} {cumulative[-1]}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> Dict:
+        """
+        Return every metric as plain values, for a JSON summary.
+
+        A series without labels maps to its value; series with labels map
+        from ``"name=value,..."`` to theirs. A histogram is summarised by its
+        count, sum, mean and estimated ``QUANTILES``.
+        """
+        snapshot = {}
+        for name, kind, _, series in self._collect():
+            values = {}
+            for metric in series:
+                if kind == "histogram":
+                    cumulative, total = metric.state()
+                    count = cumulative[-1]
+                    value = {"count": count, "sum": total, "mean": total / count if count else None}
+                    value.update((f"p{round(fraction * 100)}", metric.quantile(fraction, cumulative))
+                                 for fraction in QUANTILES)
+                else:
+                    value = metric.value
+                values[",".join(f"{label}={text}" for label, text in metric.labels.items())] = value
+            snapshot[name] = values[""] if list(values) == [""] else values
+        return snapshot
+
+
+async def _answer_scrape(registry: Registry, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    """Answer one HTTP request for the metrics, then close the connection."""
+    try:
+        request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), SCRAPE_TIMEOUT)
+        path = request.split(b" ", 2)[1].split(b"?", 1)[0] if request.count(b" ") >= 2 else b""
+        if path in (b"/", b"/metrics"):
+            status, body = "200 OK", registry.render().encode("utf-8")
+        else:
+            status, body = "404 Not Found", b"Metrics are served at /metrics\n"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: close\r\n\r\n".encode("utf-8") + body)
+        await writer.drain()
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve_prometheus(registry: Registry, host: str, port: int) -> asyncio.AbstractServer:
+    """
+    Serve the metrics of a registry over HTTP for Prometheus, on the running event loop.
+
+    Args:
+        registry (Registry): Metrics to serve.
+        host (str): Address to listen on, normally a local one.
+        port (int): Port to listen on.
+
+    Returns:
+        asyncio.AbstractServer: The listening server; close it to stop serving.
+    """
+    return await asyncio.start_server(lambda reader, writer: _answer_scrape(registry, reader, writer), host, port)
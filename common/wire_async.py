@@ -0,0 +1,399 @@
+"""
+asyncio counterparts of the blocking helpers in wire_protocol, compression
+and archive_stream, for servers that run every connection on one event loop.
+
+Sockets are driven with the ``loop.sock_*`` methods, so receive buffers are
+still reused and files are still sent with ``sendfile``. Disk writes, hashing
+and (de)compression run in the loop's default executor so that a slow disk
+or a large file never stalls the other connections.
+"""
+import asyncio
+import os
+import socket
+import tarfile
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+from common import wire_protocol as wp
+from common import archive_stream
+from common import compression
+from common.compression import Transfer
+
+
+def _write_chunk(f, data, hasher, position: int, on_write) -> None:
+    """Write a received chunk; runs in an executor."""
+    if hasher is not None:
+        hasher.update(data)
+    written = 0
+    while written < len(data):
+        written += f.write(data[written:])
+    if on_write is not None:
+        on_write(f, position)
+
+
+class Connection:
+    """
+    Non-blocking socket served by the running event loop.
+
+    Attributes:
+        sock (socket.socket): The underlying socket, switched to non-blocking mode.
+        loop (asyncio.AbstractEventLoop): Loop serving the socket.
+    """
+
+    def __init__(self, sock: socket.socket) -> None:
+        """
+        Initialize the Connection.
+
+        Args:
+            sock (socket.socket): Connected socket.
+        """
+        sock.setblocking(False)
+        self.sock = sock
+        self.loop = asyncio.get_running_loop()
+
+    def close(self) -> None:
+        self.sock.close()
+
+    async def _fill(self, view: memoryview, pending: int, what: str) -> None:
+        filled = 0
+        while filled < len(view):
+            count = await self.loop.sock_recv_into(self.sock, view[filled:])
+            if count == 0:
+                raise ConnectionError(f"Connection closed with {pending - filled} bytes of {what} pending")
+            filled += count
+
+    async def recv_exact(self, size: int) -> bytes:
+        """Read exactly ``size`` bytes, see ``wire_protocol.recv_exact``."""
+        buffer = bytearray(size)
+        view = memoryview(buffer)
+        received = 0
+        while received < size:
+            count = await self.loop.sock_recv_into(self.sock, view[received:])
+            if count == 0:
+                raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+            received += count
+        return bytes(buffer)
+
+    async def recv_header(self) -> Tuple[int, int, str, int]:
+        """Read a frame header and its name, see ``wire_protocol.recv_header``."""
+        opcode, flags, name_len, payload_len = wp.HEADER.unpack(await self.recv_exact(wp.HEADER_SIZE))
+        name = (await self.recv_exact(name_len)).decode("utf-8") if name_len else ""
+        return opcode, flags, name, payload_len
+
+    async def recv_frame(self, max_payload: int = wp.MAX_CONTROL_PAYLOAD) -> wp.Frame:
+        """Read a complete frame, see ``wire_protocol.recv_frame``."""
+        opcode, flags, name, payload_len = await self.recv_header()
+        if payload_len > max_payload:
+            raise wp.ProtocolError(f"Payload of {payload_len} bytes exceeds limit for opcode {opcode:#x}")
+        payload = await self.recv_exact(payload_len) if payload_len else b""
+        return wp.Frame(opcode, flags, name, payload)
+
+    async def expect_header(self, *opcodes: int) -> Tuple[int, int, str, int]:
+        """Read a frame header with one of the expected opcodes, see ``wire_protocol.expect_header``."""
+        opcode, flags, name, payload_len = await self.recv_header()
+        if opcode == wp.OP_ERROR:
+            message = await self.recv_exact(min(payload_len, wp.MAX_CONTROL_PAYLOAD))
+            raise wp.RemoteError(message.decode("utf-8", errors="replace"))
+        if opcode not in opcodes:
+            raise wp.ProtocolError(f"Unexpected opcode {opcode:#x}")
+        return opcode, flags, name, payload_len
+
+    async def sendall(self, data: bytes) -> None:
+        await self.loop.sock_sendall(self.sock, data)
+
+    async def send_frame(self, opcode: int, name: str = "", payload: bytes = b"", flags: int = 0) -> None:
+        """Send one frame, see ``wire_protocol.send_frame``."""
+        encoded_name = name.encode("utf-8")
+        await self.sendall(wp.pack_header(opcode, len(encoded_name), len(payload), flags) + encoded_name + payload)
+
+    async def send_error(self, message: str) -> None:
+        await self.send_frame(wp.OP_ERROR, payload=message.encode("utf-8"))
+
+    async def send_file(self, opcode: int, name: str, file_path: str, offset: int = 0) -> int:
+        """Send a file as a single frame with ``loop.sock_sendfile``, see ``wire_protocol.send_file``."""
+        with open(file_path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size - offset
+            encoded_name = name.encode("utf-8")
+            flags = wp.FLAG_APPEND if offset else 0
+            await self.sendall(wp.pack_header(opcode, len(encoded_name), size, flags) + encoded_name)
+            sent = await self.loop.sock_sendfile(self.sock, f, offset, size) if size else 0
+        if sent != size:
+            raise ConnectionError(f"Sent {sent} of {size} bytes of {file_path}")
+        return size
+
+    async def recv_file(self, payload_len: int, file_path: str, buffer: bytearray = None, hasher=None,
+                        offset: int = 0, on_write=None) -> None:
+        """Write the next ``payload_len`` bytes into a file, see ``wire_protocol.recv_file``."""
+        view = memoryview(buffer if buffer is not None else wp.new_buffer())
+        remaining = payload_len
+        position = offset
+        f = await self.loop.run_in_executor(None, wp.open_for_write, file_path, offset)
+        try:
+            while remaining:
+                wanted = min(len(view), remaining)
+                await self._fill(view[:wanted], remaining, file_path)
+                remaining -= wanted
+                position += wanted
+                await self.loop.run_in_executor(None, _write_chunk, f, view[:wanted], hasher, position, on_write)
+        finally:
+            f.close()
+
+
+class StreamConnection:
+    """
+    Connection over an asyncio stream, for servers exchanging many small frames.
+
+    The stream's transport stays registered with the loop and reads ahead, so
+    a request and its reply cost about one system call each, where
+    ``Connection`` waits for every read on its own. Has the frame methods of
+    ``Connection`` but no file transfers.
+
+    Attributes:
+        reader (asyncio.StreamReader): Incoming side of the stream.
+        writer (asyncio.StreamWriter): Outgoing side of the stream.
+        loop (asyncio.AbstractEventLoop): Loop serving the stream.
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        """
+        Initialize the StreamConnection.
+
+        Args:
+            reader (asyncio.StreamReader): Incoming side of the stream.
+            writer (asyncio.StreamWriter): Outgoing side of the stream.
+        """
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+
+    def close(self) -> None:
+        self.writer.close()
+
+    async def recv_exact(self, size: int) -> bytes:
+        """Read exactly ``size`` bytes, see ``wire_protocol.recv_exact``."""
+        try:
+            return await self.reader.readexactly(size)
+        except asyncio.IncompleteReadError as e:
+            raise ConnectionError(f"Connection closed after {len(e.partial)} of {size} bytes") from None
+
+    async def sendall(self, data: bytes) -> None:
+        self.writer.write(data)
+        await self.writer.drain()
+
+    recv_header = Connection.recv_header
+    recv_frame = Connection.recv_frame
+    expect_header = Connection.expect_header
+    send_frame = Connection.send_frame
+    send_error = Connection.send_error
+
+
+async def accept_hello(conn: Connection, frame: wp.Frame, enabled: bool = True) -> Transfer:
+    """Worker side of the compression handshake, see ``compression.accept_hello``."""
+    reply, transfer = compression.hello_reply(frame, enabled)
+    await conn.send_frame(wp.OP_HELLO, payload=reply)
+    return transfer
+
+
+def _read_and_compress(f, compressor, stats: compression.TransferStats) -> Tuple[int, bytes]:
+    chunk = f.read(compression.READ_SIZE)
+    started = time.perf_counter()
+    out = compressor.compress(chunk) if chunk else compressor.flush()
+    stats.compress_seconds += time.perf_counter() - started
+    return len(chunk), out
+
+
+def _decompress_and_write(decompressor, chunk: bytes, f, hasher, position: int, on_write,
+                          stats: compression.TransferStats) -> int:
+    started = time.perf_counter()
+    data = decompressor.decompress(chunk)
+    stats.decompress_seconds += time.perf_counter() - started
+    _write_chunk(f, data, hasher, position + len(data), on_write)
+    return len(data)
+
+
+async def send_file(conn: Connection, transfer: Transfer, opcode: int, name: str, file_path: str,
+                    offset: int = 0) -> int:
+    """Send a file, compressed when worthwhile, see ``Transfer.send_file``.
+
+    Returns:
+        int: Number of raw bytes sent.
+    """
+    if not await conn.loop.run_in_executor(None, transfer.should_compress, file_path):
+        size = await conn.send_file(opcode, name, file_path, offset)
+        transfer.stats.add(size, size, compressed=False)
+        return size
+
+    await conn.send_frame(opcode, name, flags=wp.FLAG_COMPRESSED | (wp.FLAG_APPEND if offset else 0))
+    compressor = transfer.codec.compressor()
+    raw_bytes = wire_bytes = 0
+    with open(file_path, "rb") as f:
+        f.seek(offset)
+        while True:
+            read, out = await conn.loop.run_in_executor(None, _read_and_compress, f, compressor, transfer.stats)
+            if out:
+                await conn.send_frame(wp.OP_CHUNK, payload=out)
+                wire_bytes += len(out)
+            if not read:
+                break
+            raw_bytes += read
+    await conn.send_frame(wp.OP_CHUNK)
+    transfer.stats.add(raw_bytes, wire_bytes, compressed=True)
+    return raw_bytes
+
+
+async def recv_file(conn: Connection, transfer: Transfer, flags: int, payload_len: int, file_path: str,
+                    buffer: bytearray = None, hasher=None, offset: int = 0, on_write=None) -> None:
+    """Receive a file frame body sent by ``send_file``, see ``Transfer.recv_file``."""
+    if not flags & wp.FLAG_COMPRESSED:
+        await conn.recv_file(payload_len, file_path, buffer, hasher, offset, on_write)
+        transfer.stats.add(payload_len, payload_len, compressed=False)
+        return
+
+    if transfer.codec is None:
+        raise wp.ProtocolError("Compressed frame received but no codec was negotiated")
+    decompressor = transfer.codec.decompressor()
+    raw_bytes = wire_bytes = 0
+    f = await conn.loop.run_in_executor(None, wp.open_for_write, file_path, offset)
+    try:
+        while True:
+            chunk = wp.expect(await conn.recv_frame(), wp.OP_CHUNK).payload
+            if not chunk:
+                break
+            wire_bytes += len(chunk)
+            raw_bytes += await conn.loop.run_in_executor(
+                None, _decompress_and_write, decompressor, chunk, f, hasher, offset + raw_bytes, on_write,
+                transfer.stats,
+            )
+    finally:
+        f.close()
+    transfer.stats.add(raw_bytes, wire_bytes, compressed=True)
+
+
+class FrameReader:
+    """Reader over the ``OP_ARCHIVE_DATA`` frames of a connection; reaching ``OP_DONE`` is reported as end of file."""
+
+    def __init__(self, conn: Connection, transfer: Transfer) -> None:
+        self.conn = conn
+        self.transfer = transfer
+        self.pending = memoryview(b"")
+        self.finished = False
+
+    async def read(self, size: int) -> bytes:
+        """Return up to ``size`` bytes, or ``b""`` once ``OP_DONE`` was reached."""
+        while not self.pending:
+            if self.finished:
+                return b""
+            frame = wp.expect(await self.conn.recv_frame(archive_stream.ARCHIVE_CHUNK_SIZE * 2),
+                              wp.OP_ARCHIVE_DATA, wp.OP_DONE)
+            if frame.opcode == wp.OP_DONE:
+                self.finished = True
+                return b""
+            data = await self.conn.loop.run_in_executor(None, self.transfer.decode_payload, frame.flags, frame.payload)
+            self.pending = memoryview(data)
+
+        data = self.pending[:size].tobytes()
+        self.pending = self.pending[size:]
+        return data
+
+    async def read_exact(self, size: int) -> bytes:
+        chunks = []
+        while size:
+            data = await self.read(size)
+            if not data:
+                raise wp.ProtocolError("Archive stream ended in the middle of a member")
+            chunks.append(data)
+            size -= len(data)
+        return b"".join(chunks)
+
+    async def skip(self, size: int) -> None:
+        while size:
+            data = await self.read(min(size, wp.RECV_BUFFER_SIZE))
+            if not data:
+                raise wp.ProtocolError("Archive stream ended in the middle of a member")
+            size -= len(data)
+
+    async def drain(self) -> None:
+        """Consume the rest of the stream, up to and including ``OP_DONE``."""
+        while await self.read(wp.RECV_BUFFER_SIZE):
+            pass
+
+
+def _parse_pax(data: bytes) -> Dict[str, str]:
+    """Parse the ``<length> <key>=<value>\\n`` records of a PAX extended header."""
+    records = {}
+    position = 0
+    while position < len(data) and data[position] != 0:
+        space = data.index(b" ", position)
+        length = int(data[position:space])
+        key, _, value = data[space + 1:position + length - 1].partition(b"=")
+        records[key.decode("utf-8")] = value.decode("utf-8", "surrogateescape")
+        position += length
+    return records
+
+
+def _padded(size: int) -> int:
+    return -(-size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+
+
+async def receive_archive(conn: Connection, destination_for: Callable[[str], Optional[str]],
+                          transfer: Transfer = None, on_file: Callable[[str, str, int], None] = None) -> int:
+    """Unpack a streamed tar archive, sent by ``archive_stream.send_archive``, as it arrives.
+
+    The tar headers are parsed here block by block instead of with
+    ``tarfile.open``, whose file object interface would block the loop.
+
+    Args:
+        conn (Connection): Connection positioned after ``OP_ARCHIVE``.
+        destination_for (Callable[[str], Optional[str]]): Maps a member name to
+            the path it should be written to, or ``None`` to skip the member.
+        transfer (Transfer): Compression state of the connection.
+        on_file (Callable[[str, str, int], None]): Called in the default
+            executor with the member name, path and size of every file once
+            it is completely written.
+
+    Returns:
+        int: Number of files written.
+    """
+    reader = FrameReader(conn, transfer or Transfer())
+    written = 0
+    extended = {}
+    long_name = None
+    while True:
+        block = await reader.read_exact(tarfile.BLOCKSIZE)
+        if block == tarfile.NUL * tarfile.BLOCKSIZE:
+            break  # End of archive marker
+        info = tarfile.TarInfo.frombuf(block, tarfile.ENCODING, "surrogateescape")
+
+        if info.type in (tarfile.XHDTYPE, tarfile.XGLTYPE, tarfile.GNUTYPE_LONGNAME):
+            data = (await reader.read_exact(_padded(info.size)))[:info.size]
+            if info.type == tarfile.XHDTYPE:
+                extended = _parse_pax(data)
+            elif info.type == tarfile.GNUTYPE_LONGNAME:
+                long_name = data.rstrip(b"\0").decode(tarfile.ENCODING, "surrogateescape")
+            continue
+
+        name = extended.get("path") or long_name or info.name
+        size = int(extended["size"]) if "size" in extended else info.size
+        extended, long_name = {}, None
+        destination = destination_for(name) if info.isfile() else None
+        if destination is None:
+            await reader.skip(_padded(size))
+            continue
+
+        f = await conn.loop.run_in_executor(None, open, destination, "wb")
+        try:
+            remaining = size
+            while remaining:
+                data = await reader.read(min(remaining, wp.RECV_BUFFER_SIZE))
+                if not data:
+                    raise wp.ProtocolError("Archive stream ended in the middle of a member")
+                await conn.loop.run_in_executor(None, _write_chunk, f, data, None, 0, None)
+                remaining -= len(data)
+        finally:
+            f.close()
+        await reader.skip(_padded(size) - size)
+        if on_file is not None:
+            await conn.loop.run_in_executor(None, on_file, name, destination, size)
+        written += 1
+    await reader.drain()
+    return written
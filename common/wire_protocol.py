@@ -0,0 +1,274 @@
+"""
+Wire protocol shared by the client, the bridge and the worker servers.
+
+Every message is a frame made of a fixed 12-byte header followed by an
+optional UTF-8 name and an optional binary payload:
+
+    +--------+-------+----------+-------------+------+---------+
+    | opcode | flags | name_len | payload_len | name | payload |
+    |   u8   |  u8   |   u16    |     u64     |      |         |
+    +--------+-------+----------+-------------+------+---------+
+
+Because the payload length is known up front, file bodies never need an
+in-band end marker and the sender never has to wait for an ACK between files.
+"""
+import os
+import socket
+import struct
+from collections import namedtuple
+from typing import Tuple
+
+HEADER = struct.Struct("!BBHQ")
+HEADER_SIZE = HEADER.size
+RECV_BUFFER_SIZE = 1024 * 1024  # Size of the reusable per-connection receive buffer
+MAX_NAME_LEN = 0xFFFF
+MAX_CONTROL_PAYLOAD = 16 * 1024 * 1024  # Upper bound for frames read fully into memory
+
+# Frame flags
+FLAG_COMPRESSED = 0x01  # Payload (or the OP_CHUNK frames that follow) is compressed
+FLAG_APPEND = 0x02  # File body continues at the offset the receiver reported as durable
+
+# Connection setup
+OP_HELLO = 0x04
+OP_SESSION = 0x05  # Open a striped upload session (client) / session accepted (worker)
+OP_JOIN = 0x06  # Attach an extra connection to an upload session
+OP_RESUME = 0x07  # Reopen an interrupted upload session / offsets already received
+
+# Load probing (bridge <-> worker)
+OP_GET_LOAD = 0x01
+OP_LOAD = 0x02
+
+# Routing (client <-> bridge)
+OP_ROUTE = 0x03  # Ask for a server / its port, with its host as the name
+
+# Worker registration (worker -> bridge)
+OP_REGISTER = 0x08  # Announce a worker, its capacity and capabilities, as JSON / accepted
+OP_HEARTBEAT = 0x09  # Current load of a registered worker, on the registration connection
+
+# Monitoring (anyone -> bridge or worker)
+OP_STATS = 0x0A  # Ask for the metrics of a bridge or worker / their summary, as JSON
+
+# Dataset upload (client -> worker)
+OP_DATASET = 0x10
+OP_FILE = 0x11
+OP_DONE = 0x12
+OP_ARCHIVE = 0x13
+OP_ARCHIVE_DATA = 0x14
+OP_MANIFEST = 0x15
+OP_BLOB = 0x16
+OP_CHUNK = 0x17
+
+# Upload negotiation (worker -> client)
+OP_NEED = 0x18
+
+# Results (worker <-> client)
+OP_MODEL = 0x20
+OP_FETCH = 0x21  # Ask for the trained model of a dataset, from a byte offset
+OP_CHECKSUM = 0x22  # SHA-256 of the complete file that was just sent
+OP_STATUS = 0x23  # Ask for the state of a training job / the state, as JSON
+OP_PROGRESS = 0x24  # Watch the progress of a training job / one per-epoch progress event
+
+OP_ERROR = 0x7F
+
+Frame = namedtuple("Frame", ["opcode", "flags", "name", "payload"])
+
+
+class ProtocolError(Exception):
+    """Raised when the peer sends an unexpected or malformed frame."""
+
+
+class RemoteError(ProtocolError):
+    """Raised when the peer answered with an ``OP_ERROR`` frame."""
+
+
+def pack_header(opcode: int, name_len: int, payload_len: int, flags: int = 0) -> bytes:
+    """Build a frame header.
+
+    Args:
+        opcode (int): Frame type.
+        name_len (int): Length of the encoded name in bytes.
+        payload_len (int): Length of the payload in bytes.
+        flags (int): Opcode specific flags.
+
+    Returns:
+        bytes: The packed header.
+    """
+    if name_len > MAX_NAME_LEN:
+        raise ProtocolError(f"Frame name too long ({name_len} bytes)")
+    return HEADER.pack(opcode, flags, name_len, payload_len)
+
+
+def send_frame(sock: socket.socket, opcode: int, name: str = "", payload: bytes = b"", flags: int = 0) -> None:
+    """Send a complete frame in a single call.
+
+    Args:
+        sock (socket.socket): Connected socket.
+        opcode (int): Frame type.
+        name (str): Optional frame name (file name, dataset name, ...).
+        payload (bytes): Optional frame payload.
+        flags (int): Opcode specific flags.
+    """
+    encoded_name = name.encode("utf-8")
+    sock.sendall(pack_header(opcode, len(encoded_name), len(payload), flags) + encoded_name + payload)
+
+
+def send_error(sock: socket.socket, message: str) -> None:
+    """Send an error frame carrying a human readable message."""
+    send_frame(sock, OP_ERROR, payload=message.encode("utf-8"))
+
+
+def recv_exact(sock: socket.socket, size: int) -> bytes:
+    """Read exactly ``size`` bytes from the socket.
+
+    Raises:
+        ConnectionError: If the peer closes the connection early.
+    """
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        count = sock.recv_into(view[received:], size - received)
+        if count == 0:
+            raise ConnectionError(f"Connection closed after {received} of {size} bytes")
+        received += count
+    return bytes(buffer)
+
+
+def recv_header(sock: socket.socket) -> Tuple[int, int, str, int]:
+    """Read a frame header and its name, leaving the payload on the socket.
+
+    Returns:
+        Tuple[int, int, str, int]: Opcode, flags, name and payload length.
+    """
+    opcode, flags, name_len, payload_len = HEADER.unpack(recv_exact(sock, HEADER_SIZE))
+    name = recv_exact(sock, name_len).decode("utf-8") if name_len else ""
+    return opcode, flags, name, payload_len
+
+
+def recv_frame(sock: socket.socket, max_payload: int = MAX_CONTROL_PAYLOAD) -> Frame:
+    """Read a complete frame, payload included.
+
+    Args:
+        sock (socket.socket): Connected socket.
+        max_payload (int): Largest payload accepted in memory.
+
+    Returns:
+        Frame: The received frame.
+    """
+    opcode, flags, name, payload_len = recv_header(sock)
+    if payload_len > max_payload:
+        raise ProtocolError(f"Payload of {payload_len} bytes exceeds limit for opcode {opcode:#x}")
+    payload = recv_exact(sock, payload_len) if payload_len else b""
+    return Frame(opcode, flags, name, payload)
+
+
+def expect(frame: Frame, *opcodes: int) -> Frame:
+    """Check that a frame has one of the expected opcodes.
+
+    Raises:
+        ProtocolError: If the peer sent an error frame or an unexpected opcode.
+    """
+    if frame.opcode == OP_ERROR:
+        raise RemoteError(frame.payload.decode("utf-8", errors="replace"))
+    if frame.opcode not in opcodes:
+        raise ProtocolError(f"Unexpected opcode {frame.opcode:#x}")
+    return frame
+
+
+def expect_header(sock: socket.socket, *opcodes: int) -> Tuple[int, int, str, int]:
+    """Read a frame header and check it has one of the expected opcodes.
+
+    Used for frames whose payload is streamed rather than read into memory.
+
+    Raises:
+        ProtocolError: If the peer sent an error frame or an unexpected opcode.
+    """
+    opcode, flags, name, payload_len = recv_header(sock)
+    if opcode == OP_ERROR:
+        raise RemoteError(recv_exact(sock, min(payload_len, MAX_CONTROL_PAYLOAD)).decode("utf-8", errors="replace"))
+    if opcode not in opcodes:
+        raise ProtocolError(f"Unexpected opcode {opcode:#x}")
+    return opcode, flags, name, payload_len
+
+
+def new_buffer() -> bytearray:
+    """Allocate a receive buffer meant to be reused for every file of a connection."""
+    return bytearray(RECV_BUFFER_SIZE)
+
+
+def send_file(sock: socket.socket, opcode: int, name: str, file_path: str, offset: int = 0) -> int:
+    """Send a file as a single frame.
+
+    The body is handed to ``socket.sendfile`` so the kernel copies it straight
+    from the page cache to the socket; the file is never read into Python.
+
+    Args:
+        sock (socket.socket): Connected socket.
+        opcode (int): Frame type, usually ``OP_FILE`` or ``OP_MODEL``.
+        name (str): Name the receiver should store the file under.
+        file_path (str): Local path of the file.
+        offset (int): Resume point; a non-zero offset sends the rest of the
+            file flagged ``FLAG_APPEND``.
+
+    Returns:
+        int: Number of payload bytes sent.
+    """
+    with open(file_path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size - offset
+        encoded_name = name.encode("utf-8")
+        flags = FLAG_APPEND if offset else 0
+        sock.sendall(pack_header(opcode, len(encoded_name), size, flags) + encoded_name)
+        sent = sock.sendfile(f, offset, size) if size else 0
+    if sent != size:
+        raise ConnectionError(f"Sent {sent} of {size} bytes of {file_path}")
+    return size
+
+
+def open_for_write(file_path: str, offset: int = 0):
+    """Open a file for writing, keeping its first ``offset`` bytes and dropping the rest."""
+    if not offset:
+        return open(file_path, "wb", buffering=0)
+    f = open(file_path, "r+b", buffering=0)
+    f.truncate(offset)
+    f.seek(offset)
+    return f
+
+
+def recv_file(sock: socket.socket, payload_len: int, file_path: str, buffer: bytearray = None, hasher=None,
+              offset: int = 0, on_write=None) -> None:
+    """Write the next ``payload_len`` bytes of the socket into a file.
+
+    Data is received with ``recv_into`` into ``buffer`` and written out once the
+    buffer is full, so memory use stays at one buffer regardless of file size.
+
+    Args:
+        sock (socket.socket): Connected socket positioned at a frame payload.
+        payload_len (int): Payload length taken from the frame header.
+        file_path (str): Destination path.
+        buffer (bytearray): Reusable receive buffer, see ``new_buffer``.
+        hasher: Optional ``hashlib`` object updated with the received bytes.
+        offset (int): Position to continue writing at, for resumed transfers.
+        on_write: Optional ``callback(file, position)`` called after every write,
+            used to checkpoint long transfers.
+    """
+    view = memoryview(buffer if buffer is not None else new_buffer())
+    remaining = payload_len
+    position = offset
+    with open_for_write(file_path, offset) as f:
+        while remaining:
+            wanted = min(len(view), remaining)
+            filled = 0
+            while filled < wanted:
+                count = sock.recv_into(view[filled:wanted])
+                if count == 0:
+                    raise ConnectionError(f"Connection closed with {remaining - filled} bytes of {file_path} pending")
+                filled += count
+            if hasher is not None:
+                hasher.update(view[:filled])
+            written = 0
+            while written < filled:
+                written += f.write(view[written:filled])
+            remaining -= filled
+            position += filled
+            if on_write is not None:
+                on_write(f, position)
@@ -1,19 +1,87 @@
-import socket
-import threading
-from handler.client_handler import ClientHandler
+import asyncio
+import json
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+# Make the shared wire protocol importable when started from this directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from common import metrics
+from common import wire_async
+from handler.client_handler import ClientHandler, RequestMetrics
 from manager.server_manager import ServerManager
 
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bridge_config.json")  # Optional overrides
+DEFAULT_CONFIG = {
+    "servers": [],  # Worker servers that do not register themselves, e.g. {"host": "10.0.0.5", "port": 5001}
+    "probe_interval": 1.0,  # Seconds between two load probes of every unregistered server
+    "probe_timeout": 1.0,  # Seconds before a probed server counts as unreachable
+    "stale_after": 5.0,  # Seconds after which a measured load no longer counts
+    "heartbeat_timeout": 6.0,  # Seconds without a heartbeat after which a registered server is dropped
+    "load_weights": {  # Weight of each term of a server's load score, see ServerManager.score
+        "clients": 1.0,  # Per connected client
+        "queued": 4.0,  # Per queued job and training slot
+        "running": 2.0,  # Per running job and training slot
+        "remaining_minutes": 0.5,  # Per minute of training left and training slot
+        "cpu": 2.0,  # At full CPU utilisation
+        "memory": 4.0,  # With no free memory
+    },
+    "memory_comfort": 4 * 1024 ** 3,  # Free memory in bytes above which a server is not penalised
+    "min_disk_free": 1024 ** 3,  # Free disk in bytes below which a server gets no more clients
+    "locality_max_score": 8.0,  # Load score above which retrains stop going to the server holding the dataset
+    "strategy": "power_of_two",  # least_loaded, power_of_two, weighted_round_robin or consistent_hashing
+    "lease_ttl": 10.0,  # Seconds a client sent to a server counts toward its load if it never connects
+    "lease_weight": 1.0,  # Load score each client sent to a server adds until its upload starts
+    "failure_threshold": 2,  # Failed probes in a row that exclude a server; refused connections exclude at once
+    "backoff_base": 1.0,  # Seconds a failing server is excluded the first time, doubling on each failed retry
+    "backoff_max": 60.0,  # Most seconds a failing server is excluded before it is tried again
+    "backlog": 4096,  # Pending connections the kernel queues before accept, capped by net.core.somaxconn
+    "shutdown_timeout": 5.0,  # Seconds a stopping bridge waits for the requests it is answering
+    "relay_threads": 16,  # Threads relaying STATUS requests to the workers, which block on the network
+    "relay_timeout": 2.0,  # Seconds a worker may take to answer a relayed STATUS request
+    "metrics_host": "127.0.0.1",  # Address the Prometheus metrics are served on
+    "metrics_port": 12346,  # Port the Prometheus metrics are served on, at /metrics; null disables it
+}
+
+
+def load_config(path: str = CONFIG_FILE) -> dict:
+    """
+    Return the bridge configuration: DEFAULT_CONFIG updated with the keys of the JSON file at ``path``, if any.
+    """
+    config = dict(DEFAULT_CONFIG)
+    if os.path.exists(path):
+        with open(path, "r") as f:
+            config.update(json.load(f))
+        print(f"[CONFIG] Loaded {path}")
+    return config
+
 class BridgeServer:
     """
     A server that acts as a bridge between clients and available servers.
 
+    Every connection is served as a task on one event loop. Routing is
+    answered from the loads kept in memory, so one core answers tens of
+    thousands of requests per second; see bridge_benchmark.py.
+
+    Request latencies, probes and the state of the servers are recorded in
+    ``registry``, served in the Prometheus format on ``metrics_port`` and
+    as JSON to STATS requests.
+
     Attributes:
         host (str): The IP address the server listens on.
         port (int): The port the server listens on.
+        backlog (int): Pending connections the kernel queues before accept.
+        shutdown_timeout (float): Seconds a stopping bridge waits for the requests it is answering.
+        relay_threads (int): Threads relaying STATUS requests to the workers.
+        metrics_address (Optional[tuple]): Address the Prometheus metrics are served on, if any.
+        registry (metrics.Registry): Metrics of the bridge.
         server_manager (ServerManager): Manages server assignments for clients.
     """
 
-    def __init__(self, host: str = '127.0.0.1', port: int = 12345, servers: list = None):
+    def __init__(self, host: str = '127.0.0.1', port: int = 12345, servers: list = None, config: dict = None):
         """
         Initialize the BridgeServer.
 
@@ -21,46 +89,126 @@ class BridgeServer:
             host (str): The IP address to bind the server to.
             port (int): The port number to bind the server to.
             servers (list): List of available servers with their configurations.
+            config (dict): Bridge configuration, see DEFAULT_CONFIG; defaults to load_config().
         """
+        config = config if config is not None else load_config()
         if servers is None:
-            servers = [
-                {"port": 5001, "client_count": 0},
-                {"port": 5002, "client_count": 0},
-            ]
+            servers = [dict({"host": "127.0.0.1"}, **server, client_count=0, static=True) for server in config["servers"]]
         self.host = host
         self.port = port
-        self.server_manager = ServerManager(servers)
+        self.backlog = config["backlog"]
+        self.shutdown_timeout = config["shutdown_timeout"]
+        self.relay_threads = config["relay_threads"]
+        self.metrics_address = (config["metrics_host"], config["metrics_port"]) if config["metrics_port"] else None
+        self.registry = metrics.Registry()
+        self.server_manager = ServerManager(servers, probe_interval=config["probe_interval"],
+                                            probe_timeout=config["probe_timeout"], stale_after=config["stale_after"],
+                                            heartbeat_timeout=config["heartbeat_timeout"],
+                                            load_weights=config["load_weights"], memory_comfort=config["memory_comfort"],
+                                            min_disk_free=config["min_disk_free"],
+                                            locality_max_score=config["locality_max_score"],
+                                            strategy=config["strategy"], lease_ttl=config["lease_ttl"],
+                                            lease_weight=config["lease_weight"],
+                                            failure_threshold=config["failure_threshold"],
+                                            backoff_base=config["backoff_base"], backoff_max=config["backoff_max"],
+                                            relay_timeout=config["relay_timeout"], registry=self.registry)
+        self._request_metrics = RequestMetrics(self.registry)
+        self._handlers = {}  # Task serving each open connection, with its handler
+        self._connections = self.registry.counter("bridge_connections_total", "Connections accepted")
+        self.registry.gauge("bridge_open_connections", "Client and worker connections open",
+                            function=lambda: len(self._handlers))
+        self._loop = None
+        self._stopping = None
 
-    def start(self) -> None:
+    async def serve(self) -> None:
         """
-        Start the bridge server to listen for client connections.
+        Accept connections and serve each of them as a task on the event loop, until stop() is called.
+
+        On stop the bridge no longer accepts connections, drops the workers
+        registered with it, waits up to ``shutdown_timeout`` seconds for the
+        requests it is answering and cancels the rest.
         """
-        bridge_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._loop = asyncio.get_running_loop()
+        self._stopping = asyncio.Event()
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=self.relay_threads, thread_name_prefix="relay"))
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            try:
+                self._loop.add_signal_handler(signum, self._stopping.set)
+            except (NotImplementedError, RuntimeError):
+                pass  # Not supported on this platform or outside the main thread; stop() still works
+
+        handlers = self._handlers
+
+        async def serve_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+            handler = ClientHandler(wire_async.StreamConnection(reader, writer), writer.get_extra_info("peername"),
+                                    self.server_manager, self._request_metrics)
+            self._connections.inc()
+            task = asyncio.current_task()
+            handlers[task] = handler
+            try:
+                await handler.handle()
+            except asyncio.CancelledError:
+                pass  # Cancelled on shutdown; start_server would log a connection task that ends cancelled
+            finally:
+                del handlers[task]
+
         try:
-            bridge_socket.bind((self.host, self.port))
-            bridge_socket.listen(5)
+            # The first probe round blocks on the static servers, so it runs off the loop
+            await self._loop.run_in_executor(None, self.server_manager.start_polling)
+            server = await asyncio.start_server(serve_client, self.host, self.port, backlog=self.backlog)
             print(f"[STARTING] Bridge listening on {self.host}:{self.port}")
+            metrics_server = await self._serve_metrics()
 
-            while True:
-                try:
-                    client_socket, client_address = bridge_socket.accept()
-                    print(f"[CONNECTED] Client connected from {client_address}")
-                    handler = ClientHandler(client_socket, client_address, self.server_manager)
-                    thread = threading.Thread(target=handler.handle, daemon=True)
-                    thread.start()
-                except Exception as e:
-                    print(f"[ERROR] Failed to handle client connection: {e}")
+            await self._stopping.wait()
+            server.close()
+            if metrics_server is not None:
+                metrics_server.close()
+            print(f"[SHUTTING DOWN] Bridge stopped accepting, answering {len(handlers)} open connections.")
+            for task, handler in list(handlers.items()):
+                if handler.worker:
+                    task.cancel()  # Heartbeats never end on their own
+            if handlers:
+                _, pending = await asyncio.wait(list(handlers), timeout=self.shutdown_timeout)
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+        finally:
+            self.server_manager.stop_polling()
+            print("[CLOSED] Bridge socket closed.")
 
+    async def _serve_metrics(self) -> Optional[asyncio.AbstractServer]:
+        """
+        Serve the metrics in the Prometheus format, unless disabled; a port already taken only loses the metrics.
+        """
+        if self.metrics_address is None:
+            return None
+        host, port = self.metrics_address
+        try:
+            metrics_server = await metrics.serve_prometheus(self.registry, host, port)
+        except OSError as e:
+            print(f"[WARNING] Metrics not served on {host}:{port}: {e}")
+            return None
+        print(f"[METRICS] Serving metrics on http://{host}:{port}/metrics")
+        return metrics_server
+
+    def stop(self) -> None:
+        """
+        Ask a running bridge to shut down gracefully; safe to call from any thread.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopping.set)
+
+    def start(self) -> None:
+        """
+        Start the bridge server to listen for client connections, until interrupted.
+        """
+        try:
+            asyncio.run(self.serve())
         except KeyboardInterrupt:
             print("\n[SHUTTING DOWN] Bridge stopped by user.")
-
         except Exception as e:
             print(f"[ERROR] An unexpected error occurred: {e}")
 
-        finally:
-            bridge_socket.close()
-            print("[CLOSED] Bridge socket closed.")
-
 if __name__ == "__main__":
     try:
         bridge = BridgeServer()
@@ -0,0 +1,194 @@
+"""
+Measure how many routing decisions per second the bridge answers.
+
+Starts a bridge in a child process on a free port, or targets a running one
+with --bridge, and registers fake workers that keep sending heartbeats. Load
+generator processes then send ROUTE requests, each keeping --concurrency of
+them in flight: one connection per request, as the client does, or with
+--keep-alive many requests per connection. Besides the throughput seen by
+the clients, the CPU time the bridge used is reported when it was started
+here, so the figure per core holds even when the load generators share its
+machine.
+
+Usage:
+    python servers/bridge_benchmark.py --requests 200000 --concurrency 64 --processes 2 --keep-alive
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+# Make the bridge and the shared wire protocol importable when run as a script
+SERVERS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path[:0] = [SERVERS_DIR, os.path.dirname(SERVERS_DIR)]
+
+from bridge import DEFAULT_CONFIG, BridgeServer
+from common import wire_protocol as wp
+
+FAKE_WORKER_PORT = 20000  # Port announced by the first fake worker; nothing listens on it
+
+
+def run_bridge(port: int, strategy: str) -> None:
+    """Run a bridge with no static servers until it is terminated; the target of the bridge process."""
+    BridgeServer("127.0.0.1", port, servers=[], config=dict(DEFAULT_CONFIG, strategy=strategy)).start()
+
+
+def free_port() -> int:
+    """Return a local TCP port nothing listens on."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_bridge(address: tuple, timeout: float = 10.0) -> None:
+    """Wait until the bridge accepts connections."""
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            socket.create_connection(address, timeout=1.0).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+
+
+def cpu_seconds(pid: int) -> Optional[float]:
+    """Return the user and system CPU time a process used so far, from /proc."""
+    try:
+        with open(f"/proc/{pid}/stat", "r") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")  # utime and stime
+
+
+def register_workers(address: tuple, count: int, stop: threading.Event) -> None:
+    """Register ``count`` fake workers with the bridge and send their heartbeats until ``stop`` is set."""
+    connections = []
+    for index in range(count):
+        load = {"clients": 0, "capacity": 2, "uploads_started": 0, "queued": index % 3, "running": 1,
+                "remaining_seconds": 60 * index, "cpu": 0.5, "memory_free": 8 * 1024 ** 3, "disk_free": 100 * 1024 ** 3}
+        info = {"host": "127.0.0.1", "port": FAKE_WORKER_PORT + index, "capacity": 2, "capabilities": {},
+                "load": load, "datasets": []}
+        sock = socket.create_connection(address)
+        wp.send_frame(sock, wp.OP_REGISTER, payload=json.dumps(info).encode('utf-8'))
+        wp.expect(wp.recv_frame(sock), wp.OP_REGISTER)
+        connections.append((sock, json.dumps({"load": load}).encode('utf-8')))
+    try:
+        while not stop.wait(1.0):
+            for sock, heartbeat in connections:
+                wp.send_frame(sock, wp.OP_HEARTBEAT, payload=heartbeat)
+    finally:
+        for sock, _ in connections:
+            sock.close()
+
+
+async def send_requests(address: tuple, count: int, keep_alive: bool, datasets: int, seed: int,
+                        latencies: List[float]) -> int:
+    """Send ``count`` ROUTE requests one after the other, recording their latencies; return the failures."""
+    rng = random.Random(seed)
+    reader = writer = None
+    failures = 0
+    for _ in range(count):
+        payload = json.dumps({"dataset": f"dataset-{rng.randrange(datasets)}"}).encode('utf-8') if datasets else b""
+        started = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(*address)
+            writer.write(wp.pack_header(wp.OP_ROUTE, 0, len(payload)) + payload)
+            opcode, _, name_len, payload_len = wp.HEADER.unpack(await reader.readexactly(wp.HEADER_SIZE))
+            await reader.readexactly(name_len + payload_len)
+            if opcode != wp.OP_ROUTE:
+                failures += 1
+        except (OSError, asyncio.IncompleteReadError):
+            failures += 1
+            keep_alive = False  # Reconnect below
+        latencies.append(time.perf_counter() - started)
+        if not keep_alive and writer is not None:
+            writer.close()
+            reader = writer = None
+    if writer is not None:
+        writer.close()
+    return failures
+
+
+def generate_load(address: tuple, requests: int, concurrency: int, keep_alive: bool, datasets: int,
+                  seed: int) -> Dict:
+    """Send ``requests`` ROUTE requests, ``concurrency`` at a time; the work of one load generator process."""
+    async def run() -> Dict:
+        latencies = []
+        shares = [requests // concurrency + (index < requests % concurrency) for index in range(concurrency)]
+        started = time.time()
+        failures = await asyncio.gather(*(send_requests(address, share, keep_alive, datasets, seed * 1000 + index,
+                                                        latencies) for index, share in enumerate(shares)))
+        return {"started": started, "finished": time.time(), "failures": sum(failures), "latencies": latencies}
+    return asyncio.run(run())
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the value below which ``fraction`` of the sorted ``values`` fall."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure the routing throughput of the bridge.")
+    parser.add_argument("--bridge", help="host:port of a running bridge; by default one is started here")
+    parser.add_argument("--strategy", default=DEFAULT_CONFIG["strategy"], help="Strategy of the bridge started here")
+    parser.add_argument("--workers", type=int, default=8, help="Fake workers to register")
+    parser.add_argument("--requests", type=int, default=100000, help="ROUTE requests to send")
+    parser.add_argument("--concurrency", type=int, default=64, help="Requests in flight per load generator")
+    parser.add_argument("--processes", type=int, default=2, help="Load generator processes")
+    parser.add_argument("--keep-alive", action="store_true", help="Send many requests per connection")
+    parser.add_argument("--datasets", type=int, default=0, help="Route by dataset among this many names; 0 for plain routes")
+    args = parser.parse_args()
+
+    bridge_process = None
+    if args.bridge:
+        host, port = args.bridge.rsplit(":", 1)
+        address = (host, int(port))
+    else:
+        address = ("127.0.0.1", free_port())
+        bridge_process = multiprocessing.Process(target=run_bridge, args=(address[1], args.strategy), daemon=True)
+        bridge_process.start()
+    stop = threading.Event()
+    try:
+        wait_for_bridge(address)
+        heartbeats = threading.Thread(target=register_workers, args=(address, args.workers, stop), daemon=True)
+        heartbeats.start()
+        time.sleep(0.5)  # Let the registrations land
+
+        cpu_before = cpu_seconds(bridge_process.pid) if bridge_process else None
+        shares = [args.requests // args.processes + (index < args.requests % args.processes)
+                  for index in range(args.processes)]
+        with multiprocessing.Pool(args.processes) as pool:
+            results = pool.starmap(generate_load, [(address, share, args.concurrency, args.keep_alive, args.datasets,
+                                                    index) for index, share in enumerate(shares)])
+        cpu_after = cpu_seconds(bridge_process.pid) if bridge_process else None
+    finally:
+        stop.set()
+        if bridge_process is not None:
+            bridge_process.terminate()  # SIGTERM: the bridge shuts down gracefully
+            bridge_process.join(10)
+
+    elapsed = max(r["finished"] for r in results) - min(r["started"] for r in results)
+    latencies = sorted(latency for r in results for latency in r["latencies"])
+    failures = sum(r["failures"] for r in results)
+    mode = "keep-alive" if args.keep_alive else "one connection per request"
+    print(f"{len(latencies)} routes ({mode}, {args.processes}x{args.concurrency} in flight, {args.workers} workers) "
+          f"in {elapsed:.2f}s: {len(latencies) / elapsed:,.0f} routes/s, {failures} failed")
+    print(f"latency ms  p50 {percentile(latencies, 0.5) * 1000:.2f}  p99 {percentile(latencies, 0.99) * 1000:.2f}  "
+          f"max {latencies[-1] * 1000:.2f}")
+    if cpu_before is not None and cpu_after is not None and cpu_after > cpu_before:
+        print(f"bridge CPU {cpu_after - cpu_before:.2f}s: {len(latencies) / (cpu_after - cpu_before):,.0f} routes "
+              f"per CPU second")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,63 +1,249 @@
+import asyncio
+import json
 import logging
+import time
 from typing import Any
 
+from common import metrics
+from common import wire_async
+from common import wire_protocol as wp
+
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
 
+REQUEST_KINDS = ("route", "dataset", "job", "status", "stats")  # Plain, by dataset and by job routes, relays, metrics
+OPCODE_KINDS = {wp.OP_STATUS: "status", wp.OP_STATS: "stats"}  # Kind of the requests that are not routes
+
+
+class RequestMetrics:
+    """
+    Latencies and errors of the requests the bridge answers, shared by every ClientHandler.
+
+    Attributes:
+        registry (metrics.Registry): Registry holding these and the bridge's other metrics.
+        seconds (Dict[str, metrics.Histogram]): Seconds from a request to its answer, by kind.
+        errors (Dict[str, metrics.Counter]): Requests answered with an error, by kind.
+    """
+
+    def __init__(self, registry: metrics.Registry) -> None:
+        """
+        Initialize RequestMetrics.
+
+        Args:
+            registry (metrics.Registry): Registry to record the metrics in.
+        """
+        self.registry = registry
+        self.seconds = {kind: registry.histogram("bridge_request_seconds", "Seconds from a request to its answer",
+                                                 labels={"kind": kind}) for kind in REQUEST_KINDS}
+        self.errors = {kind: registry.counter("bridge_request_errors_total", "Requests answered with an error",
+                                              {"kind": kind}) for kind in REQUEST_KINDS}
+
+
 class ClientHandler:
     """
     Handles client connections, processes their requests, and redirects them to the least loaded server.
+
+    A ROUTE request naming a training job is answered with the server that owns
+    the job instead, and STATUS requests are relayed to that server. A ROUTE
+    request about a dataset, ``{"dataset": ..., "purpose": "train" | "model"}``
+    as payload, is answered with the server holding the dataset if any. A worker
+    server that REGISTERs keeps the connection open and sends its heartbeats
+    on it until it stops. A STATS request is answered with the bridge's
+    metrics as JSON.
+
+    Handlers run on the bridge's event loop. Routes are answered from the
+    loads the poller and the heartbeats keep in memory, so they never wait on
+    the network; only STATUS relays query a worker, in the loop's executor.
+    A client may send several requests on one connection, each answered in
+    turn, until it closes it.
     """
 
-    def __init__(self, client_socket: Any, client_address: tuple, server_manager: Any) -> None:
+    def __init__(self, conn: wire_async.StreamConnection, client_address: tuple, server_manager: Any,
+                 request_metrics: RequestMetrics) -> None:
         """
         Initialize ClientHandler.
 
         Args:
-            client_socket (Any): The client's socket object.
+            conn (wire_async.StreamConnection): The client's connection.
             client_address (tuple): The client's address (IP, port).
             server_manager (Any): The server manager instance to determine server load.
+            request_metrics (RequestMetrics): Where to record the requests answered.
         """
-        self.client_socket = client_socket
+        self.conn = conn
         self.client_address = client_address
         self.server_manager = server_manager
+        self.metrics = request_metrics
+        self.worker = False  # Whether the connection carries the heartbeats of a registered worker
 
-    def handle(self) -> None:
+    async def handle(self) -> None:
         """
-        Handle the client's request and redirect them to the least loaded server.
+        Answer the client's requests until it disconnects.
         """
-        logging.info(f"[NEW CLIENT] {self.client_address} connected to Bridge.")
+        logging.debug(f"[NEW CLIENT] {self.client_address} connected to Bridge.")
         try:
-            # Update server loads
-            self.server_manager.update_server_loads()
+            while True:
+                try:
+                    frame = await self.conn.recv_frame()
+                except ConnectionError:
+                    break  # The client is done
+                if frame.opcode == wp.OP_REGISTER:
+                    await self._serve_worker(frame)
+                    break
+                await self._answer(frame)
+        except (OSError, wp.ProtocolError) as e:
+            logging.error(f"[ERROR] Invalid request from {self.client_address}: {e}")
+        except Exception as e:
+            logging.exception(f"[ERROR] Unexpected error while handling {self.client_address}: {e}")
+        finally:
+            self.conn.close()
+            logging.debug(f"[DISCONNECT] {self.client_address} disconnected from Bridge.")
+
+    async def _answer(self, frame: wp.Frame) -> None:
+        """
+        Answer a ROUTE, STATUS or STATS request, replying with an error frame when it cannot be served.
+
+        Args:
+            frame (wp.Frame): The request.
+        """
+        started = time.perf_counter()
+        kind = OPCODE_KINDS.get(frame.opcode, "route")
+        try:
+            if frame.opcode == wp.OP_STATS:
+                stats = self.metrics.registry.snapshot()
+                await self.conn.send_frame(wp.OP_STATS, payload=json.dumps(stats).encode('utf-8'))
+                return
+            if frame.opcode == wp.OP_STATUS:
+                await self._relay_job_status(frame.name)
+                return
+            wp.expect(frame, wp.OP_ROUTE)
+            if frame.name:
+                kind = "job"
+                await self._route_to_job_owner(frame.name)
+                return
 
-            # Choose the least loaded server
-            chosen_server = self.server_manager.get_least_loaded_server()
+            # Choose the server holding the dataset, or let the strategy choose, from the loads kept by the poller
+            request = self._parse_route_request(frame.payload)
+            if request.get("dataset"):
+                kind = "dataset"
+                chosen_server = self.server_manager.get_server_for_dataset(request["dataset"],
+                                                                           request.get("purpose", "train"))
+            else:
+                chosen_server = self.server_manager.choose_server()
 
             if chosen_server["port"] is None:
                 raise ValueError("No available servers to handle the request.")
 
             # Inform the client about the chosen server
-            logging.info(f"[REDIRECT] Sending {self.client_address} to server on port {chosen_server['port']}")
-            self._send_response(str(chosen_server["port"]))
+            logging.debug(f"[REDIRECT] Sending {self.client_address} to server on port {chosen_server['port']}")
+            await self._send_route(chosen_server)
 
         except ValueError as ve:
             logging.error(f"[ERROR] {ve}")
-            self._send_response("No available servers, please try again later.")
-        except Exception as e:
-            logging.exception(f"[ERROR] Unexpected error while handling {self.client_address}: {e}")
+            self.metrics.errors[kind].inc()
+            await self._send_response(wp.OP_ERROR, "No available servers, please try again later.")
+        except (LookupError, wp.RemoteError) as e:
+            logging.error(f"[ERROR] {e}")
+            self.metrics.errors[kind].inc()
+            await self._send_response(wp.OP_ERROR, str(e))
+        finally:
+            self.metrics.seconds[kind].observe(time.perf_counter() - started)
+
+    def _parse_route_request(self, payload: bytes) -> dict:
+        """
+        Decode the optional JSON payload of a ROUTE request.
+
+        Args:
+            payload (bytes): The payload, empty for a plain request for the least loaded server.
+
+        Returns:
+            dict: The request, empty for a plain one.
+        """
+        if not payload:
+            return {}
+        try:
+            request = json.loads(payload)
+        except ValueError as e:
+            raise wp.ProtocolError(f"Invalid route request: {e}") from None
+        if not isinstance(request, dict):
+            raise wp.ProtocolError("Invalid route request: not an object")
+        return request
+
+    async def _route_to_job_owner(self, job_id: str) -> None:
+        """
+        Send the client to the server that owns a training job.
+
+        Args:
+            job_id (str): The job the client wants to reach.
+        """
+        server = self.server_manager.get_job_owner(job_id)
+        logging.debug(f"[REDIRECT] Sending {self.client_address} to server on port {server['port']} for job {job_id}")
+        await self._send_route(server)
+
+    async def _relay_job_status(self, job_id: str) -> None:
+        """
+        Relay the state of a training job from its owning server to the client.
+
+        The query blocks on the owning server, so it runs in the loop's executor.
+
+        Args:
+            job_id (str): The job the client asks about.
+        """
+        try:
+            status = await self.conn.loop.run_in_executor(None, self.server_manager.query_job_status, job_id)
+        except wp.RemoteError:
+            raise
+        except (OSError, wp.ProtocolError) as e:
+            raise LookupError(f"Server owning job {job_id} is unavailable: {e}") from None
+        await self.conn.send_frame(wp.OP_STATUS, job_id, status)
+
+    async def _serve_worker(self, frame: wp.Frame) -> None:
+        """
+        Register a worker server and record its heartbeats until they stop.
+
+        The worker is dropped as soon as the connection breaks or no heartbeat
+        arrived for ``heartbeat_timeout`` seconds.
+
+        Args:
+            frame (wp.Frame): The REGISTER frame, with the worker's details as JSON.
+        """
+        try:
+            info = json.loads(frame.payload)
+        except ValueError as e:
+            raise wp.ProtocolError(f"Invalid registration: {e}") from None
+        server = self.server_manager.register(info, self.client_address[0])
+        self.worker = True
+        try:
+            await self.conn.send_frame(wp.OP_REGISTER)
+            while True:
+                heartbeat = wp.expect(await asyncio.wait_for(self.conn.recv_frame(),
+                                                             self.server_manager.heartbeat_timeout), wp.OP_HEARTBEAT)
+                self.server_manager.heartbeat(server, json.loads(heartbeat.payload))
+        except (OSError, asyncio.TimeoutError, wp.ProtocolError, ValueError, KeyError) as e:
+            logging.info(f"[HEARTBEAT LOST] {self.client_address}: {e or 'timed out'}")
         finally:
-            self.client_socket.close()
-            logging.info(f"[DISCONNECT] {self.client_address} disconnected from Bridge.")
+            self.server_manager.unregister(server)
+
+    async def _send_route(self, server: dict) -> None:
+        """
+        Send the client the address of a server: its port, with its host as the frame name.
+
+        Args:
+            server (dict): The chosen server.
+        """
+        try:
+            await self.conn.send_frame(wp.OP_ROUTE, server["host"], str(server["port"]).encode('utf-8'))
+        except Exception as e:
+            logging.error(f"[ERROR] Failed to send message to {self.client_address}: {e}")
 
-    def _send_response(self, message: str) -> None:
+    async def _send_response(self, opcode: int, message: str) -> None:
         """
-        Send a response to the client.
+        Send a response frame to the client.
 
         Args:
+            opcode (int): Frame opcode, ``OP_ROUTE`` or ``OP_ERROR``.
             message (str): The message to send to the client.
         """
         try:
-            self.client_socket.sendall(message.encode('utf-8'))
+            await self.conn.send_frame(opcode, payload=message.encode('utf-8'))
         except Exception as e:
             logging.error(f"[ERROR] Failed to send message to {self.client_address}: {e}")
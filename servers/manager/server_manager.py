@@ -1,57 +1,832 @@
+import abc
+import bisect
+import hashlib
+import json
+import random
 import socket
-from typing import List, Dict, Union
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Dict, Optional, Tuple, Union
+
+from common import metrics
+from common import wire_protocol as wp
+
+
+class Strategy(abc.ABC):
+    """
+    Picks the server a new client goes to.
+
+    Strategies only see servers that are available, each with a ``load``
+    function giving its current load score; ``key`` is the dataset the
+    request is about, if any.
+    """
+
+    @abc.abstractmethod
+    def choose(self, servers: List[Dict], load: Callable[[Dict], float], key: Optional[str] = None) -> Dict:
+        """
+        Return one of ``servers``, which is never empty.
+
+        Args:
+            servers (List[Dict]): Available servers.
+            load (Callable[[Dict], float]): Current load score of a server.
+            key (Optional[str]): Dataset the request is about.
+
+        Returns:
+            Dict: The chosen server.
+        """
+
+
+class LeastLoaded(Strategy):
+    """
+    Sends every client to the server with the lowest load score.
+
+    Exact while loads are fresh, but every client arriving between two load
+    reports goes to the same server.
+    """
+
+    def choose(self, servers: List[Dict], load: Callable[[Dict], float], key: Optional[str] = None) -> Dict:
+        return min(servers, key=load)
+
+
+class PowerOfTwoChoices(Strategy):
+    """
+    Samples two servers at random and sends the client to the less loaded one.
+
+    Nearly as good as the least loaded server when loads are fresh, and
+    spreads a burst of clients instead of herding them when they are not.
+    """
+
+    def __init__(self, rng: Optional[random.Random] = None) -> None:
+        """
+        Initialize the PowerOfTwoChoices strategy.
+
+        Args:
+            rng (Optional[random.Random]): Source of randomness, e.g. seeded for a simulation.
+        """
+        self._rng = rng or random.Random()
+
+    def choose(self, servers: List[Dict], load: Callable[[Dict], float], key: Optional[str] = None) -> Dict:
+        if len(servers) == 1:
+            return servers[0]
+        return min(self._rng.sample(servers, 2), key=load)
+
+
+class WeightedRoundRobin(Strategy):
+    """
+    Hands out servers in turn, each in proportion to its capacity, ignoring loads.
+
+    Uses smooth weighted round-robin, so a server with capacity 3 among
+    servers of capacity 1 gets every other client rather than three in a row.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize the WeightedRoundRobin strategy.
+        """
+        self._current: Dict[Tuple, float] = {}  # Running weight of each server, by address
+        self._lock = threading.Lock()
+
+    def choose(self, servers: List[Dict], load: Callable[[Dict], float], key: Optional[str] = None) -> Dict:
+        with self._lock:
+            total = 0
+            best, best_weight = None, None
+            for server in servers:
+                address = (server.get("host"), server["port"])
+                weight = max(1, server.get("capacity") or 1)
+                total += weight
+                self._current[address] = self._current.get(address, 0) + weight
+                if best is None or self._current[address] > best_weight:
+                    best, best_weight = server, self._current[address]
+            self._current[(best.get("host"), best["port"])] -= total
+            if len(self._current) > 2 * len(servers):
+                # Forget servers that left
+                addresses = {(server.get("host"), server["port"]) for server in servers}
+                self._current = {address: value for address, value in self._current.items() if address in addresses}
+            return best
+
+
+class ConsistentHashing(Strategy):
+    """
+    Sends all requests about a dataset to the same server, by hashing its name onto a ring of servers.
+
+    When a server joins or leaves, only the datasets on its part of the ring
+    move. Each server gets ``replicas`` points on the ring per unit of
+    capacity. Requests that name no dataset go to the least loaded server.
+
+    Attributes:
+        replicas (int): Points on the ring per unit of server capacity.
+    """
+
+    def __init__(self, replicas: int = 64) -> None:
+        """
+        Initialize the ConsistentHashing strategy.
+
+        Args:
+            replicas (int): Points on the ring per unit of server capacity.
+        """
+        self.replicas = replicas
+        self._ring: Tuple[List[int], List[Dict]] = ([], [])
+        self._members: Tuple = ()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _hash(value: str) -> int:
+        return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], "big")
+
+    def _ring_for(self, servers: List[Dict]) -> Tuple[List[int], List[Dict]]:
+        members = tuple((server.get("host"), server["port"], server.get("capacity") or 1) for server in servers)
+        with self._lock:
+            if members != self._members:
+                points = sorted((self._hash(f"{host}:{port}#{i}"), index)
+                                for index, (host, port, capacity) in enumerate(members)
+                                for i in range(self.replicas * max(1, capacity)))
+                self._ring = ([point for point, _ in points], [servers[index] for _, index in points])
+                self._members = members
+            return self._ring
+
+    def choose(self, servers: List[Dict], load: Callable[[Dict], float], key: Optional[str] = None) -> Dict:
+        if key is None:
+            return min(servers, key=load)
+        points, owners = self._ring_for(servers)
+        index = bisect.bisect(points, self._hash(key)) % len(points)
+        return owners[index]
+
+
+STRATEGIES = {
+    "least_loaded": LeastLoaded,
+    "power_of_two": PowerOfTwoChoices,
+    "weighted_round_robin": WeightedRoundRobin,
+    "consistent_hashing": ConsistentHashing,
+}
+
+
+def make_strategy(name: str) -> Strategy:
+    """
+    Return a new strategy by its configuration name, one of STRATEGIES.
+
+    Raises:
+        ValueError: If no strategy has that name.
+    """
+    if name not in STRATEGIES:
+        raise ValueError(f"Unknown load balancing strategy {name!r}, expected one of {', '.join(STRATEGIES)}")
+    return STRATEGIES[name]()
+
+
+class CircuitBreaker:
+    """
+    Health of one server, as a circuit breaker.
+
+    While the circuit is closed the server is used. It opens at once when the
+    server refuses a connection, or after ``failure_threshold`` failures in a
+    row otherwise. An open server gets no clients and no connections until
+    its backoff runs out: then the circuit is half open and a single trial
+    connection decides whether it closes again, or opens for twice as long,
+    up to ``backoff_max`` seconds.
+
+    Attributes:
+        state (str): ``closed``, ``open`` or ``half-open``.
+        failures (int): Failures in a row.
+        failure_threshold (int): Failures in a row that open the circuit.
+        backoff_base (float): Seconds the circuit stays open the first time.
+        backoff_max (float): Most seconds the circuit stays open.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold: int = 2, backoff_base: float = 1.0, backoff_max: float = 60.0,
+                 clock: Callable[[], float] = time.monotonic, rng: Optional[random.Random] = None) -> None:
+        """
+        Initialize the CircuitBreaker, closed.
+
+        Args:
+            failure_threshold (int): Failures in a row that open the circuit.
+            backoff_base (float): Seconds the circuit stays open the first time.
+            backoff_max (float): Most seconds the circuit stays open.
+            clock (Callable[[], float]): Current time in seconds, e.g. a fake one in tests.
+            rng (Optional[random.Random]): Source of the backoff jitter, e.g. seeded in tests.
+        """
+        self.state = self.CLOSED
+        self.failures = 0
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._clock = clock
+        self._rng = rng or random.Random()
+        self._opened = 0  # Times the circuit opened since it was last closed
+        self._retry_at = 0.0
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Return whether a connection to the server may be tried now; half opens the circuit when its backoff ran out."""
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and self._clock() >= self._retry_at:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def success(self) -> bool:
+        """Record a successful connection; return whether this closed the circuit."""
+        with self._lock:
+            recovered = self.state != self.CLOSED
+            self.state = self.CLOSED
+            self.failures = 0
+            self._opened = 0
+            return recovered
+
+    def failure(self, refused: bool = False) -> Optional[float]:
+        """
+        Record a failed connection.
+
+        Args:
+            refused (bool): Whether the server actively refused the connection.
+
+        Returns:
+            Optional[float]: Seconds until the next trial if this opened the circuit, else ``None``.
+        """
+        with self._lock:
+            self.failures += 1
+            if self.state == self.CLOSED and not refused and self.failures < self.failure_threshold:
+                return None
+            # Jittered, so that servers that failed together are not retried together
+            backoff = min(self.backoff_max, self.backoff_base * 2 ** self._opened * self._rng.uniform(0.8, 1.2))
+            self._opened += 1
+            self.state = self.OPEN
+            self._retry_at = self._clock() + backoff
+            return backoff
+
+    @property
+    def available(self) -> bool:
+        """Whether clients may be sent to the server."""
+        return self.state == self.CLOSED
 
 
 class ServerManager:
     """
     Manage server loads and provide server assignments based on current loads.
 
+    Worker servers register themselves and push their load in heartbeats.
+    Servers listed in the configuration that do not register are probed by a
+    background poller, all at once. Either way loads are kept with the time
+    they were measured, so routing a client never waits on a server. A load
+    older than ``stale_after`` no longer counts: the server is treated as
+    unavailable until a heartbeat or a probe succeeds again.
+
+    A load is a report of the server's clients, training backlog and free
+    resources, which ``score`` weighs into the single figure routing compares.
+
+    Registered servers also report the datasets they trained, by name and
+    content hash, so requests about a dataset go to the server holding its
+    model and blobs. Other clients go where the configured ``Strategy`` sends them.
+
+    A client sent to a server to upload holds a lease on it, which counts
+    toward the server's load at once, so a burst of clients arriving between
+    two load reports spreads over the servers. A lease ends when the server
+    reports that an upload started, or after ``lease_ttl`` seconds.
+
+    Every server has a ``CircuitBreaker``. A server that fails is excluded at
+    once and only probed again, and its jobs only asked about, after an
+    exponentially growing backoff.
+
+    Probes, heartbeats and the state of the servers are recorded as metrics
+    in ``registry``.
+
     Attributes:
         servers (List[Dict[str, Union[int, float]]]): List of servers with their load details.
+        probe_interval (float): Seconds between two probes of every server.
+        probe_timeout (float): Seconds a probe may take before the server counts as unreachable.
+        stale_after (float): Age in seconds after which a measured load is ignored.
+        heartbeat_timeout (float): Seconds without a heartbeat after which a registered server is dropped.
+        load_weights (Dict[str, float]): Weight of each term of the load score.
+        memory_comfort (float): Free memory in bytes above which a server is not penalised for memory.
+        min_disk_free (float): Free disk in bytes below which a server gets no more clients.
+        locality_max_score (float): Load score above which a retrain no longer goes to the server holding the dataset.
+        strategy (Strategy): Picks the server of clients not bound to a server by their dataset.
+        lease_ttl (float): Seconds a lease counts toward a server's load if the upload never starts.
+        lease_weight (float): Load score added by each lease.
+        failure_threshold (int): Failures in a row, other than refused connections, that exclude a server.
+        backoff_base (float): Seconds a failing server is excluded the first time.
+        backoff_max (float): Most seconds a failing server is excluded before it is tried again.
+        relay_timeout (float): Seconds a server may take to answer a relayed status request.
+        registry (metrics.Registry): Metrics of the servers and of their load reports.
     """
 
-    def __init__(self, servers: List[Dict[str, Union[int, float]]]) -> None:
+    def __init__(self, servers: List[Dict[str, Union[int, float]]], probe_interval: float = 1.0,
+                 probe_timeout: float = 1.0, stale_after: float = 5.0, heartbeat_timeout: float = 6.0,
+                 load_weights: Optional[Dict[str, float]] = None, memory_comfort: float = 4 * 1024 ** 3,
+                 min_disk_free: float = 1024 ** 3, locality_max_score: float = 8.0,
+                 strategy: str = "least_loaded", lease_ttl: float = 10.0, lease_weight: float = 1.0,
+                 failure_threshold: int = 2, backoff_base: float = 1.0, backoff_max: float = 60.0,
+                 relay_timeout: float = 2.0, registry: Optional[metrics.Registry] = None) -> None:
         """
         Initialize ServerManager with a list of servers.
 
         Args:
             servers (List[Dict[str, Union[int, float]]]): List of servers with initial configurations.
+            probe_interval (float): Seconds between two probes of every server.
+            probe_timeout (float): Seconds a probe may take before the server counts as unreachable.
+            stale_after (float): Age in seconds after which a measured load is ignored.
+            heartbeat_timeout (float): Seconds without a heartbeat after which a registered server is dropped.
+            load_weights (Optional[Dict[str, float]]): Weight of each term of the
+                load score, see ``score``; terms without a weight do not count.
+            memory_comfort (float): Free memory in bytes above which a server is not penalised for memory.
+            min_disk_free (float): Free disk in bytes below which a server gets no more clients.
+            locality_max_score (float): Load score above which a retrain no
+                longer goes to the server holding the dataset.
+            strategy (str): Name of the load balancing strategy, one of STRATEGIES.
+            lease_ttl (float): Seconds a lease counts toward a server's load if the upload never starts.
+            lease_weight (float): Load score added by each lease.
+            failure_threshold (int): Failures in a row, other than refused connections, that exclude a server.
+            backoff_base (float): Seconds a failing server is excluded the first time.
+            backoff_max (float): Most seconds a failing server is excluded before it is tried again.
+            relay_timeout (float): Seconds a server may take to answer a relayed status request.
+            registry (Optional[metrics.Registry]): Where to record metrics; a registry of its own if omitted.
         """
         self.servers = servers
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.stale_after = stale_after
+        self.heartbeat_timeout = heartbeat_timeout
+        self.load_weights = load_weights if load_weights is not None else {"clients": 1.0}
+        self.memory_comfort = memory_comfort
+        self.min_disk_free = min_disk_free
+        self.locality_max_score = locality_max_score
+        self.strategy = make_strategy(strategy)
+        self.lease_ttl = lease_ttl
+        self.lease_weight = lease_weight
+        self._lease_lock = threading.RLock()  # Makes choosing a server and leasing it one step
+        self.failure_threshold = failure_threshold
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.relay_timeout = relay_timeout
+        self._dataset_servers: Dict[str, Dict] = {}  # Server holding the latest model, by dataset name and content hash
+        self._lock = threading.Lock()  # Serializes changes to the server list, which readers never wait for
+        self._stop = threading.Event()
+        self._poller = None
+        self._probes = None
+        self.registry = registry if registry is not None else metrics.Registry()
+        self._probe_seconds = self.registry.histogram("bridge_load_probe_seconds",
+                                                      "Seconds each load probe of an unregistered server took")
+        self._probe_failures = self.registry.counter("bridge_load_probe_failures_total",
+                                                     "Load probes that failed or timed out")
+        self._heartbeats = self.registry.counter("bridge_heartbeats_total",
+                                                 "Heartbeats received from registered servers")
+        self._locality_routes = self.registry.counter("bridge_locality_routes_total",
+                                                      "Requests sent to the server holding their dataset")
+        self.registry.gauge("bridge_servers", "Servers known to the bridge", function=lambda: len(self.servers))
+        self.registry.gauge("bridge_servers_available", "Servers with a fresh load and a closed circuit",
+                            function=lambda: sum(self._routable(s, time.monotonic()) for s in self.servers))
+        self.registry.gauge("bridge_leases", "Clients sent to a server whose upload has not started yet",
+                            function=lambda: sum(self._live_leases(s) for s in self.servers))
+
+    def register(self, info: Dict, peer_host: str) -> Dict[str, Union[int, float]]:
+        """
+        Add a worker server that announced itself, or refresh it if already known.
+
+        Args:
+            info (Dict): ``port``, ``capacity``, ``capabilities``, ``load`` and
+                optionally ``host``, the address clients reach the worker at.
+            peer_host (str): Address the registration came from, used when the
+                worker did not name its host.
+
+        Returns:
+            Dict[str, Union[int, float]]: The registered server.
+        """
+        host, port = info.get("host") or peer_host, int(info["port"])
+        with self._lock:
+            server = next((s for s in self.servers if s["host"] == host and s["port"] == port), None)
+            if server is None:
+                server = {"host": host, "port": port, "client_count": float('inf')}
+                self.servers = self.servers + [server]  # Replaced, never mutated: readers iterate without the lock
+            server.update(capacity=info.get("capacity", 1), capabilities=info.get("capabilities", {}),
+                          registered=True)
+        self.health(server).success()
+        self.heartbeat(server, info)
+        self._learn_datasets(server, info.get("datasets", []))
+        print(f"[REGISTERED] Server {host}:{port}, capacity {server['capacity']}.")
+        return server
+
+    def heartbeat(self, server: Dict[str, Union[int, float]], info: Dict) -> None:
+        """
+        Store the load a registered server reported.
+
+        A heartbeat shows the server is up, so it also closes a circuit
+        opened by failed relays to it.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server, as returned by ``register``.
+            info (Dict): The heartbeat, with the current ``load``.
+        """
+        self._store_load(server, info["load"])
+        self._record_success(server)
+        self._learn_datasets(server, info.get("datasets", []))
+        self._heartbeats.inc()
+
+    def _learn_datasets(self, server: Dict[str, Union[int, float]], datasets: List[Dict]) -> None:
+        """
+        Remember that a server holds the model and blobs of some datasets.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server that trained them.
+            datasets (List[Dict]): ``name`` and ``content_hash`` of each dataset.
+        """
+        with self._lock:
+            for dataset in datasets:
+                for key in (dataset.get("name"), dataset.get("content_hash")):
+                    if key:
+                        self._dataset_servers[key] = server
+
+    def unregister(self, server: Dict[str, Union[int, float]]) -> None:
+        """
+        Forget a server whose heartbeats stopped; configured servers go back to being probed.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server, as returned by ``register``.
+        """
+        with self._lock:
+            server["registered"] = False
+            server.pop("updated", None)
+            self.health(server).failure(refused=True)  # A configured server is probed again after a backoff
+            if not server.get("static"):
+                self.servers = [s for s in self.servers if s is not server]
+            for key in [key for key, holder in self._dataset_servers.items() if holder is server]:
+                del self._dataset_servers[key]
+        print(f"[UNREGISTERED] Server {server['host']}:{server['port']} stopped sending heartbeats.")
+
+    def health(self, server: Dict[str, Union[int, float]]) -> CircuitBreaker:
+        """
+        Return the circuit breaker of a server, creating it on first use.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server.
+        """
+        breaker = server.get("health")
+        if breaker is None:
+            breaker = server.setdefault("health", CircuitBreaker(self.failure_threshold, self.backoff_base,
+                                                                 self.backoff_max))
+        return breaker
+
+    def _record_failure(self, server: Dict[str, Union[int, float]], error: Exception) -> None:
+        """
+        Count a failed connection to a server, logging it if this excludes the server.
 
-    def query_server_load(self, server_port: int) -> float:
+        Args:
+            server (Dict[str, Union[int, float]]): The server that failed.
+            error (Exception): Why.
         """
-        Query a server for its current client count.
+        backoff = self.health(server).failure(refused=isinstance(error, ConnectionRefusedError))
+        if backoff is not None:
+            print(f"[CIRCUIT OPEN] Server {server['host']}:{server['port']} excluded ({error}), "
+                  f"next try in {backoff:.1f}s.")
+
+    def _record_success(self, server: Dict[str, Union[int, float]]) -> None:
+        if self.health(server).success():
+            print(f"[CIRCUIT CLOSED] Server {server['host']}:{server['port']} answers again.")
+
+    def query_server_load(self, server_port: int, host: str = "127.0.0.1") -> Union[Dict, float]:
+        """
+        Query a server for its current load.
 
         Args:
             server_port (int): Port of the server to query.
+            host (str): Address of the server.
 
         Returns:
-            float: Current client count or a high load value on failure.
+            Union[Dict, float]: The load report, or the bare client count older servers send.
+
+        Raises:
+            OSError: If the server cannot be reached in ``probe_timeout`` seconds.
+            wp.ProtocolError: If the server answers something else than a load.
+        """
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+            s.settimeout(self.probe_timeout)  # Add timeout to prevent hanging connections
+            s.connect((host, server_port))
+            wp.send_frame(s, wp.OP_GET_LOAD)
+            frame = wp.expect(wp.recv_frame(s), wp.OP_LOAD)
+            try:
+                return json.loads(frame.payload)
+            except ValueError:
+                raise wp.ProtocolError(f"Invalid load report {frame.payload!r}") from None
+
+    def _probe(self, server: Dict[str, Union[int, float]]) -> None:
         """
+        Measure the load of one server and store it with the time it was measured.
+
+        A server whose circuit is open is skipped until its backoff runs out.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server to probe.
+        """
+        if not self.health(server).allow():
+            return
+        started = time.perf_counter()
         try:
-            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-                s.settimeout(5)  # Add timeout to prevent hanging connections
-                s.connect(("127.0.0.1", server_port))
-                s.sendall(b"GET_LOAD")  # Use consistent byte encoding
-                load = float(s.recv(1024).decode('utf-8'))
-                return load
-        except (socket.timeout, socket.error) as e:
-            print(f"[ERROR] Could not query server {server_port}: {e}")
-            return float('inf')  # High load on failure
+            load = self.query_server_load(server["port"], server["host"])
+        except (OSError, wp.ProtocolError) as e:
+            self._probe_seconds.observe(time.perf_counter() - started)
+            self._probe_failures.inc()
+            self._record_failure(server, e)
+            server["client_count"] = server["score"] = float('inf')  # High load on failure
+            return
+        self._probe_seconds.observe(time.perf_counter() - started)
+        self._record_success(server)
+        self._store_load(server, load)
+
+    def _store_load(self, server: Dict[str, Union[int, float]], load: Union[Dict, float]) -> None:
+        """
+        Keep the load report of a server with its score and the time it was measured.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server that reported.
+            load (Union[Dict, float]): Its load report, or a bare client count.
+        """
+        report = load if isinstance(load, dict) else {"clients": float(load)}
+        server["load"] = report
+        server["client_count"] = report.get("clients", 0)
+        server["score"] = self.score(report, server.get("capacity"))
+        server["updated"] = time.monotonic()
+        if report.get("worker_id"):
+            server["worker_id"] = report["worker_id"]
+        uploads_started = report.get("uploads_started")
+        if uploads_started is not None:
+            previous = server.get("uploads_started")
+            server["uploads_started"] = uploads_started
+            if previous is not None:
+                self._end_leases(server, uploads_started - previous)
+
+    def _reserve(self, server: Dict[str, Union[int, float]]) -> None:
+        """
+        Lease a server to a client that is about to upload to it.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server the client is sent to.
+        """
+        with self._lease_lock:
+            server.setdefault("leases", deque()).append(time.monotonic() + self.lease_ttl)
+
+    def _end_leases(self, server: Dict[str, Union[int, float]], count: int) -> None:
+        """
+        End the oldest leases of a server, whose clients started their uploads.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server that reported the uploads.
+            count (int): Uploads started since its previous report.
+        """
+        with self._lease_lock:
+            leases = server.get("leases")
+            for _ in range(min(max(0, count), len(leases or ()))):
+                leases.popleft()
+
+    def _live_leases(self, server: Dict[str, Union[int, float]]) -> int:
+        """
+        Return the leases of a server that have not expired.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server to look at.
+        """
+        leases = server.get("leases")
+        if not leases:
+            return 0
+        with self._lease_lock:
+            now = time.monotonic()
+            while leases and leases[0] <= now:
+                leases.popleft()
+            return len(leases)
+
+    def score(self, report: Dict, capacity: Optional[int] = None) -> float:
+        """
+        Weigh a load report into a single figure; lower is less loaded.
+
+        Terms, each multiplied by its weight in ``load_weights``: ``clients``
+        connected, ``queued`` and ``running`` jobs per training slot, minutes
+        of training left per slot (``remaining_minutes``), ``cpu`` utilisation
+        from 0 to 1, and ``memory``, from 0 with ``memory_comfort`` bytes free
+        or more to 1 with none. Figures missing from the report count as 0.
+
+        Args:
+            report (Dict): Load report of a server.
+            capacity (Optional[int]): Training slots of the server, if the report does not say.
+
+        Returns:
+            float: The score, ``inf`` if the server is short of disk for new datasets.
+        """
+        disk_free = report.get("disk_free")
+        if disk_free is not None and disk_free < self.min_disk_free:
+            return float('inf')
+        slots = max(1, report.get("capacity") or capacity or 1)
+        memory_free = report.get("memory_free")
+        terms = {
+            "clients": report.get("clients", 0),
+            "queued": report.get("queued", 0) / slots,
+            "running": report.get("running", 0) / slots,
+            "remaining_minutes": report.get("remaining_seconds", 0) / 60 / slots,
+            "cpu": report.get("cpu") or 0,
+            "memory": max(0.0, 1 - memory_free / self.memory_comfort) if memory_free is not None else 0,
+        }
+        return sum(weight * terms.get(name, 0) for name, weight in self.load_weights.items())
 
     def update_server_loads(self) -> None:
         """
-        Update the load for all servers by querying their current client count.
+        Update the load of the servers that do not send heartbeats by querying their current client count, all at once.
+        """
+        polled = [server for server in self.servers if not server.get("registered")]
+        if not polled:
+            return
+        if self._probes is None:
+            self._probes = ThreadPoolExecutor(max_workers=len(polled), thread_name_prefix="load-probe")
+        list(self._probes.map(self._probe, polled))
+
+    def _poll(self) -> None:
+        while not self._stop.wait(self.probe_interval):
+            self.update_server_loads()
+
+    def start_polling(self) -> None:
+        """
+        Probe every server once, then keep probing them in the background every ``probe_interval`` seconds.
+        """
+        self.update_server_loads()
+        self._poller = threading.Thread(target=self._poll, name="load-poller", daemon=True)
+        self._poller.start()
+
+    def stop_polling(self) -> None:
+        """
+        Stop the background poller.
+        """
+        self._stop.set()
+        if self._probes is not None:
+            self._probes.shutdown(wait=False)
+
+    def current_load(self, server: Dict[str, Union[int, float]]) -> float:
+        """
+        Return the last load score of a server with its leases, or ``inf`` if it is unknown, stale or failing.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server to look at.
+
+        Returns:
+            float: The load routing decisions should use.
+        """
+        if not self._routable(server, time.monotonic()):
+            return float('inf')
+        return server["score"] + self.lease_weight * self._live_leases(server)
+
+    def _routable(self, server: Dict[str, Union[int, float]], now: float) -> bool:
+        """
+        Return whether a server has a fresh, finite load score and a closed circuit, without counting its leases.
+
+        Args:
+            server (Dict[str, Union[int, float]]): The server to look at.
+            now (float): Current ``time.monotonic()``.
+        """
+        updated = server.get("updated")
+        return (updated is not None and now - updated <= self.stale_after and server["score"] != float('inf')
+                and self.health(server).available)
+
+    def get_job_owner(self, job_id: str) -> Dict[str, Union[int, float]]:
+        """
+        Return the server that owns a training job, named by the prefix of its id.
+
+        Args:
+            job_id (str): Job id handed out by a worker server, "<worker id>-<id>".
+
+        Returns:
+            Dict[str, Union[int, float]]: The owning server.
+
+        Raises:
+            LookupError: If no known server owns the job, or its circuit is open.
+        """
+        server = self._find_job_owner(job_id)
+        if not self.health(server).available:
+            raise LookupError(f"Server owning job {job_id} is unavailable, please try again later")
+        return server
+
+    def _find_job_owner(self, job_id: str) -> Dict[str, Union[int, float]]:
+        """
+        Return the server whose worker id prefixes a job id.
+
+        Workers reporting no id, and jobs of workers that named them by port,
+        are matched on the port, as long as a single server has it.
+        """
+        prefix = job_id.split("-", 1)[0]
+        servers = self.servers
+        for server in servers:
+            if server.get("worker_id") == prefix:
+                return server
+        by_port = [server for server in servers if str(server["port"]) == prefix]
+        if len(by_port) == 1:
+            return by_port[0]
+        raise LookupError(f"No server owns training job {job_id}")
+
+    def query_job_status(self, job_id: str) -> bytes:
+        """
+        Ask the owning server for the state of a training job.
+
+        Args:
+            job_id (str): Job id handed out by a worker server.
+
+        Returns:
+            bytes: JSON status reported by the server.
+
+        Raises:
+            LookupError: If no known server owns the job, or its circuit is open.
+            wp.RemoteError: If the server does not know the job.
+        """
+        server = self._find_job_owner(job_id)
+        if not self.health(server).allow():
+            raise LookupError(f"Server owning job {job_id} is unavailable, please try again later")
+        try:
+            with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                s.settimeout(self.relay_timeout)
+                s.connect((server["host"], server["port"]))
+                wp.send_frame(s, wp.OP_STATUS, job_id)
+                frame = wp.recv_frame(s)
+        except (OSError, wp.ProtocolError) as e:
+            self._record_failure(server, e)
+            raise
+        self._record_success(server)
+        return wp.expect(frame, wp.OP_STATUS).payload
+
+    def get_dataset_server(self, dataset: str) -> Optional[Dict[str, Union[int, float]]]:
+        """
+        Return the server holding the latest model of a dataset, if it is known and available.
+
+        Args:
+            dataset (str): Dataset name or content hash.
+
+        Returns:
+            Optional[Dict[str, Union[int, float]]]: The server, or ``None``.
+        """
+        server = self._dataset_servers.get(dataset)
+        if server is None or self.current_load(server) == float('inf'):
+            return None
+        return server
+
+    def get_server_for_dataset(self, dataset: str, purpose: str = "train") -> Dict[str, Union[int, float]]:
+        """
+        Return the server a request about a dataset should go to.
+
+        A request for an existing model goes to the server holding it. A
+        retrain goes there too, where the blobs of the dataset are already
+        stored, unless that server's load score is above ``locality_max_score``.
+        Otherwise, or if no server holds the dataset, the strategy decides.
+        A client sent to upload gets a lease on the server.
+
+        Args:
+            dataset (str): Dataset name or content hash.
+            purpose (str): ``"model"`` to download the trained model, ``"train"`` to upload and train.
+
+        Returns:
+            Dict[str, Union[int, float]]: The chosen server, or ``{"port": None}`` if none is available.
+        """
+        with self._lease_lock:
+            server = self.get_dataset_server(dataset)
+            if server is not None and purpose == "model":
+                self._locality_routes.inc()
+                return server
+            if server is not None and self.current_load(server) <= self.locality_max_score:
+                self._reserve(server)
+                self._locality_routes.inc()
+                return server
+            return self.choose_server(dataset)
+
+    def choose_server(self, dataset: Optional[str] = None) -> Dict[str, Union[int, float]]:
+        """
+        Return the server for a new client, picked by the strategy among the servers with a fresh load.
+
+        The client gets a lease on the server, taken along with the choice so
+        that concurrent clients see each other's leases.
+
+        Args:
+            dataset (Optional[str]): Dataset the client's request is about, if any.
+
+        Returns:
+            Dict[str, Union[int, float]]: The chosen server, or ``{"port": None}`` if none is available.
         """
-        for server in self.servers:
-            server["client_count"] = self.query_server_load(server["port"])
+        with self._lease_lock:
+            now = time.monotonic()
+            # Leases are only counted for the servers the strategy compares, e.g. two of them
+            available = [server for server in self.servers if self._routable(server, now)]
+            if not available:
+                return {"port": None, "client_count": float('inf')}
+            server = self.strategy.choose(available, self.current_load, dataset)
+            self._reserve(server)
+            return server
 
     def get_least_loaded_server(self) -> Dict[str, Union[int, float]]:
         """
-        Return the server with the least load.
+        Return the server with the least load, from the loads measured by the poller.
 
         Returns:
-            Dict[str, Union[int, float]]: Server with the least client count.
+            Dict[str, Union[int, float]]: Server with the least client count, or
+            ``{"port": None}`` if no server has a fresh load.
         """
-        return min(self.servers, key=lambda s: s["client_count"], default={"port": None, "client_count": float('inf')})
+        loads = [(self.current_load(server), server) for server in self.servers]
+        load, server = min(loads, key=lambda pair: pair[0], default=(float('inf'), None))
+        if load == float('inf'):
+            return {"port": None, "client_count": float('inf')}
+        return server
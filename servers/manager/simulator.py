@@ -0,0 +1,109 @@
+"""
+Compare the load balancing strategies of the bridge on a synthetic trace of training jobs.
+
+Every strategy in STRATEGIES routes the same arrivals: clients come in
+bursts, each uploads one of a set of datasets (a few of them popular) and
+trains it for a log-normally distributed time on a slot of the server it was
+sent to. Like the bridge, strategies only see loads as of the last refresh,
+so a burst arriving in between shows whether a strategy herds it onto one
+server. The job completion time is the time from arrival to the end of
+training, queueing included.
+
+Usage:
+    python servers/manager/simulator.py --servers 1,2,4,1 --jobs 20000 --refresh 2
+"""
+import argparse
+import heapq
+import itertools
+import math
+import os
+import random
+import sys
+from typing import Dict, List
+
+# Make the manager and the shared wire protocol importable when run as a script
+SERVERS_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [SERVERS_DIR, os.path.dirname(SERVERS_DIR)]
+
+from manager.server_manager import STRATEGIES, PowerOfTwoChoices, make_strategy
+
+
+def make_trace(args: argparse.Namespace, total_capacity: int) -> List[Dict]:
+    """Return the arrivals of the simulation: time, dataset and training duration of each job."""
+    rng = random.Random(args.seed)
+    # Bursts arrive as a Poisson process sized so that trainings keep the slots busy at the target utilisation
+    burst_rate = args.utilisation * total_capacity / args.mean_training / args.burst_size
+    sigma = args.training_spread
+    mu = math.log(args.mean_training) - sigma ** 2 / 2  # Log-normal with the requested mean
+    names = [f"dataset-{rank}" for rank in range(1, args.datasets + 1)]
+    popularity = list(itertools.accumulate(1 / rank for rank in range(1, args.datasets + 1)))  # Zipf
+    trace, now = [], 0.0
+    while len(trace) < args.jobs:
+        now += rng.expovariate(burst_rate)
+        burst = 1 + int(rng.expovariate(1 / (args.burst_size - 1))) if args.burst_size > 1 else 1
+        for dataset in rng.choices(names, cum_weights=popularity, k=burst):
+            trace.append({"time": now, "dataset": dataset, "duration": rng.lognormvariate(mu, sigma)})
+    return trace[:args.jobs]
+
+
+def simulate(strategy_name: str, capacities: List[int], trace: List[Dict], refresh: float, seed: int) -> List[float]:
+    """Route a trace with one strategy and return the completion time of every job."""
+    strategy = make_strategy(strategy_name)
+    if isinstance(strategy, PowerOfTwoChoices):
+        strategy = PowerOfTwoChoices(random.Random(seed))
+    servers = [{"host": "sim", "port": index, "capacity": capacity} for index, capacity in enumerate(capacities)]
+    slots = [[0.0] * capacity for capacity in capacities]  # Time each training slot becomes free
+    ends = [[] for _ in capacities]  # End times of the jobs on each server, to count those not done yet
+    loads = {server["port"]: 0.0 for server in servers}  # Load scores as of the last refresh
+    next_refresh = 0.0
+    completion_times = []
+    for job in trace:
+        while job["time"] >= next_refresh:
+            for server in servers:
+                pending = ends[server["port"]]
+                while pending and pending[0] <= next_refresh:
+                    heapq.heappop(pending)
+                loads[server["port"]] = len(pending) / server["capacity"]
+            next_refresh += refresh
+        server = strategy.choose(servers, lambda s: loads[s["port"]], job["dataset"])
+        index = server["port"]
+        start = max(job["time"], heapq.heappop(slots[index]))
+        end = start + job["duration"]
+        heapq.heappush(slots[index], end)
+        heapq.heappush(ends[index], end)
+        completion_times.append(end - job["time"])
+    return completion_times
+
+
+def percentile(values: List[float], fraction: float) -> float:
+    """Return the value below which ``fraction`` of the sorted ``values`` fall."""
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare load balancing strategies on a synthetic job trace.")
+    parser.add_argument("--servers", default="1,2,4,1", help="Training slots of each server, comma separated")
+    parser.add_argument("--jobs", type=int, default=20000, help="Jobs in the trace")
+    parser.add_argument("--utilisation", type=float, default=0.8, help="Share of the slots the trace keeps busy")
+    parser.add_argument("--mean-training", type=float, default=60.0, help="Mean training duration in seconds")
+    parser.add_argument("--training-spread", type=float, default=1.0, help="Sigma of the log-normal training durations")
+    parser.add_argument("--burst-size", type=float, default=5.0, help="Mean number of clients arriving together")
+    parser.add_argument("--datasets", type=int, default=200, help="Distinct datasets, a few of them popular")
+    parser.add_argument("--refresh", type=float, default=2.0, help="Seconds between two load refreshes")
+    parser.add_argument("--strategies", default=",".join(STRATEGIES), help="Strategies to compare, comma separated")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    capacities = [int(capacity) for capacity in args.servers.split(",")]
+    trace = make_trace(args, sum(capacities))
+    print(f"{len(trace)} jobs over {trace[-1]['time']:.0f}s on servers with {capacities} slots, "
+          f"loads refreshed every {args.refresh:g}s")
+    print(f"{'strategy':<22}{'p50':>10}{'p95':>10}{'p99':>10}{'mean':>10}")
+    for name in args.strategies.split(","):
+        times = sorted(simulate(name, capacities, trace, args.refresh, args.seed))
+        print(f"{name:<22}{percentile(times, 0.5):>10.1f}{percentile(times, 0.95):>10.1f}"
+              f"{percentile(times, 0.99):>10.1f}{sum(times) / len(times):>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
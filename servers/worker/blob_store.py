@@ -0,0 +1,116 @@
+import asyncio
+import hashlib
+import os
+import shutil
+import threading
+import uuid
+from typing import Iterable, List
+
+from common import manifest
+from common import wire_async
+from common import wire_protocol as wp
+
+
+class BlobStore:
+    """
+    Content-addressed store for received dataset files.
+
+    Every file is kept once under ``<root>/<first two hex digits>/<digest>`` and
+    datasets are assembled from hardlinks to these blobs. Blobs are made
+    read-only so one dataset can never modify a file shared with another.
+
+    Attributes:
+        root (str): Directory holding the blobs.
+    """
+
+    def __init__(self, root: str) -> None:
+        """
+        Initialize the BlobStore.
+
+        Args:
+            root (str): Directory holding the blobs, created if needed.
+        """
+        self.root = root
+        self._tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self._tmp_dir, exist_ok=True)
+        self._lock = threading.Lock()
+
+    def path(self, digest: str) -> str:
+        """Return the path of a blob."""
+        if not manifest.is_valid_digest(digest):
+            raise wp.ProtocolError(f"Invalid digest: {digest!r}")
+        return os.path.join(self.root, digest[:2], digest)
+
+    def has(self, digest: str) -> bool:
+        """Check whether a blob is stored."""
+        return os.path.exists(self.path(digest))
+
+    def missing(self, digests: Iterable[str]) -> List[str]:
+        """Return the digests that are not stored yet, without duplicates."""
+        return [d for d in dict.fromkeys(digests) if not self.has(d)]
+
+    async def receive(self, conn, digest: str, flags: int, payload_len: int, buffer: bytearray, transfer,
+                      part_path: str = None, offset: int = 0, on_write=None) -> None:
+        """Receive a blob from the connection, verify its digest and store it.
+
+        Args:
+            conn (wire_async.Connection): Connection positioned at the blob body.
+            part_path (str): Where to keep the blob while it is incomplete, so
+                an interrupted transfer can be resumed. A throwaway file is
+                used when omitted.
+            offset (int): Bytes of ``part_path`` already received; the transfer
+                continues after them.
+            on_write: Checkpoint callback, see ``wire_protocol.recv_file``.
+
+        Raises:
+            ProtocolError: If the received content does not match the digest.
+        """
+        loop = asyncio.get_running_loop()
+        destination = self.path(digest)
+        tmp_path = part_path or os.path.join(self._tmp_dir, uuid.uuid4().hex)
+        hasher = hashlib.new(manifest.HASH_NAME)
+        if offset:
+            # Resume the digest over the part received before the interruption
+            await loop.run_in_executor(None, self._hash_prefix, tmp_path, offset, hasher)
+        keep_part = part_path is not None
+        try:
+            await wire_async.recv_file(conn, transfer, flags, payload_len, tmp_path, buffer, hasher, offset, on_write)
+            if hasher.hexdigest() != digest:
+                keep_part = False  # Corrupt content cannot be resumed
+                raise wp.ProtocolError(f"Content of blob {digest} does not match its digest")
+            await loop.run_in_executor(None, self._store, tmp_path, destination)
+            keep_part = False
+        finally:
+            if not keep_part and os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _hash_prefix(self, file_path: str, size: int, hasher) -> None:
+        with open(file_path, "rb") as f:
+            remaining = size
+            while remaining:
+                chunk = f.read(min(remaining, manifest.READ_SIZE))
+                if not chunk:
+                    raise wp.ProtocolError(f"Partial blob {file_path} is shorter than {size} bytes")
+                hasher.update(chunk)
+                remaining -= len(chunk)
+
+    def _store(self, tmp_path: str, destination: str) -> None:
+        # A stored blob must be complete even after a crash, since it is never checked again
+        fd = os.open(tmp_path, os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.chmod(tmp_path, 0o444)
+        os.makedirs(os.path.dirname(destination), exist_ok=True)
+        with self._lock:
+            if not os.path.exists(destination):
+                os.replace(tmp_path, destination)
+
+    def link(self, digest: str, destination: str) -> None:
+        """Materialise a blob at ``destination``, as a hardlink when possible."""
+        try:
+            os.link(self.path(digest), destination)
+        except OSError:
+            # Different filesystem or no hardlink support: fall back to a copy
+            shutil.copyfile(self.path(digest), destination)
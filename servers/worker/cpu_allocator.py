@@ -0,0 +1,56 @@
+import os
+import threading
+from typing import List, Optional
+
+
+def available_cpus() -> List[int]:
+    """Return the cores this process may run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+class CpuAllocator:
+    """
+    Hands out disjoint sets of cores to the trainings running on a worker.
+
+    Without a GPU every training would otherwise start torch and OpenMP on all
+    cores, and concurrent trainings would thrash each other. The cores are
+    split into ``slots`` slices, one per training that may run at once, so a
+    job gets ``cores_per_job`` cores, by default ``len(cpus) // slots``, and
+    only free ones. Only when more jobs run than there are slices, e.g. with
+    ``cores_per_job`` set too high, do jobs share the least used cores.
+
+    Attributes:
+        cpus (List[int]): Cores available to the trainings.
+        cores_per_job (int): Cores given to each job.
+    """
+
+    def __init__(self, cores_per_job: Optional[int] = None, slots: int = 1,
+                 cpus: Optional[List[int]] = None) -> None:
+        """
+        Initialize the CpuAllocator.
+
+        Args:
+            cores_per_job (Optional[int]): Cores per job; by default an equal slice of the cores for each slot.
+            slots (int): Trainings that may run at once, e.g. the size of the training pool.
+            cpus (Optional[List[int]]): Cores to hand out; defaults to those this process may use.
+        """
+        self.cpus = cpus or available_cpus()
+        self.cores_per_job = min(cores_per_job or max(1, len(self.cpus) // max(1, slots)), len(self.cpus))
+        self._users = {cpu: 0 for cpu in self.cpus}  # Jobs currently pinned to each core
+        self._lock = threading.Lock()
+
+    def acquire(self) -> List[int]:
+        """Reserve the cores of a job that is starting, free ones first."""
+        with self._lock:
+            cpus = sorted(self.cpus, key=lambda cpu: (self._users[cpu], cpu))[:self.cores_per_job]
+            for cpu in cpus:
+                self._users[cpu] += 1
+        return sorted(cpus)
+
+    def release(self, cpus: List[int]) -> None:
+        """Return the cores of a job that ended."""
+        with self._lock:
+            for cpu in cpus:
+                self._users[cpu] -= 1
@@ -0,0 +1,185 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS datasets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL,
+    content_hash TEXT,
+    size INTEGER,
+    file_count INTEGER,
+    created REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS datasets_name ON datasets (name);
+CREATE INDEX IF NOT EXISTS datasets_content_hash ON datasets (content_hash);
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    dataset_id INTEGER NOT NULL REFERENCES datasets (id),
+    state TEXT NOT NULL,
+    submitted REAL NOT NULL,
+    received REAL,
+    started REAL,
+    finished REAL,
+    model_size INTEGER,
+    error TEXT,
+    result_key TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_dataset ON jobs (dataset_id);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+BUSY_TIMEOUT = 30.0  # Seconds a writer waits for another one before failing
+ADDED_COLUMNS = {"jobs": {"result_key": "TEXT"}}  # Columns added since the first version, to databases without them
+
+
+class JobIndex:
+    """
+    Transactional index of the datasets and training jobs of a worker, in SQLite.
+
+    Dataset ids are allocated by the database, so concurrent uploads never
+    get the same directory, and registering a dataset or a job is a single
+    indexed insert however many the worker already handled. The database runs
+    in WAL mode, so status queries never wait for writers. Each thread uses
+    its own connection.
+
+    Attributes:
+        path (str): Location of the database file.
+    """
+
+    def __init__(self, path: str, legacy_mapping: Optional[str] = None) -> None:
+        """
+        Initialize the JobIndex, creating the database if needed.
+
+        Args:
+            path (str): Location of the database file.
+            legacy_mapping (Optional[str]): ``directory_mapping.json`` of older
+                workers, imported once and then renamed to ``*.migrated``.
+        """
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as db:
+            db.executescript(SCHEMA)
+            self._add_columns(db)
+        if legacy_mapping and os.path.exists(legacy_mapping):
+            self._migrate(legacy_mapping)
+
+    def _connect(self) -> sqlite3.Connection:
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT)
+            db.row_factory = sqlite3.Row
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=NORMAL")
+            self._local.db = db
+        return db
+
+    def _add_columns(self, db: sqlite3.Connection) -> None:
+        for table, columns in ADDED_COLUMNS.items():
+            existing = {row["name"] for row in db.execute(f"PRAGMA table_info({table})")}
+            for name, column_type in columns.items():
+                if name not in existing:
+                    db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {column_type}")
+
+    def _migrate(self, mapping_path: str) -> None:
+        with open(mapping_path, "r") as f:
+            mapping = json.load(f)
+        with self._connect() as db:
+            db.executemany(
+                "INSERT OR IGNORE INTO datasets (id, name, created) VALUES (?, ?, ?)",
+                [(int(dir_number), name, time.time()) for dir_number, name in mapping.items()],
+            )
+        os.replace(mapping_path, mapping_path + ".migrated")
+        print(f"[MIGRATED] Imported {len(mapping)} datasets from {mapping_path}.")
+
+    def worker_id(self) -> str:
+        """Return the id of this worker, which prefixes its job ids; created once and kept across restarts."""
+        with self._connect() as db:
+            db.execute("INSERT OR IGNORE INTO settings (name, value) VALUES ('worker_id', ?)", (uuid.uuid4().hex[:12],))
+            return db.execute("SELECT value FROM settings WHERE name = 'worker_id'").fetchone()["value"]
+
+    def create_dataset(self, name: str, content_hash: Optional[str] = None) -> str:
+        """Register a new dataset and return its id, the name of its directory."""
+        with self._connect() as db:
+            cursor = db.execute("INSERT INTO datasets (name, content_hash, created) VALUES (?, ?, ?)",
+                                (name, content_hash, time.time()))
+        return str(cursor.lastrowid)
+
+    def dataset_received(self, dataset_id: str, size: int, file_count: int, content_hash: str) -> None:
+        """Record the size and content hash of a dataset once it is completely received."""
+        with self._connect() as db:
+            db.execute("UPDATE datasets SET size = ?, file_count = ?, content_hash = ? WHERE id = ?",
+                       (size, file_count, content_hash, int(dataset_id)))
+
+    def delete_dataset(self, dataset_id: str) -> None:
+        """Forget a dataset and its jobs, e.g. an abandoned upload."""
+        with self._connect() as db:
+            db.execute("DELETE FROM jobs WHERE dataset_id = ?", (int(dataset_id),))
+            db.execute("DELETE FROM datasets WHERE id = ?", (int(dataset_id),))
+
+    def dataset_ids(self, name: str) -> List[str]:
+        """Return the ids of every upload of a dataset, newest first."""
+        rows = self._connect().execute("SELECT id FROM datasets WHERE name = ? ORDER BY id DESC", (name,))
+        return [str(row["id"]) for row in rows]
+
+    def save_job(self, job) -> None:
+        """Insert or update the record of a training job."""
+        with self._connect() as db:
+            db.execute(
+                """INSERT INTO jobs (job_id, dataset_id, state, submitted, received, started, finished, model_size,
+                                     error, result_key)
+                   VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                   ON CONFLICT (job_id) DO UPDATE SET state = excluded.state, received = excluded.received,
+                       started = excluded.started, finished = excluded.finished,
+                       model_size = excluded.model_size, error = excluded.error, result_key = excluded.result_key""",
+                (job.job_id, int(job.dir_number), job.state, job.submitted, job.received, job.started,
+                 job.finished, job.model_size, job.error, job.key),
+            )
+
+    def get_job(self, job_id: str) -> Optional[Dict]:
+        """Return the record of a job joined with its dataset, or ``None``."""
+        row = self._connect().execute(
+            """SELECT jobs.*, datasets.name AS dataset_name FROM jobs JOIN datasets ON datasets.id = jobs.dataset_id
+               WHERE job_id = ?""", (job_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def latest_job_id(self, dataset_id: str) -> Optional[str]:
+        """Return the id of the latest job on a dataset, or ``None``."""
+        row = self._connect().execute("SELECT job_id FROM jobs WHERE dataset_id = ? ORDER BY submitted DESC LIMIT 1",
+                                      (int(dataset_id),)).fetchone()
+        return row["job_id"] if row is not None else None
+
+    def mean_training_seconds(self, recent: int = 20) -> Optional[float]:
+        """Return the mean duration of the latest trainings that ran, or ``None`` if none did."""
+        row = self._connect().execute(
+            """SELECT AVG(finished - started) AS mean FROM (
+                   SELECT started, finished FROM jobs
+                   WHERE state = 'done' AND finished - started >= 1  -- not the jobs answered from the result cache
+                   ORDER BY finished DESC LIMIT ?)""", (recent,)).fetchone()
+        return row["mean"]
+
+    def trained_datasets(self, since: Optional[float] = None) -> List[Dict]:
+        """Return the names and content hashes of the datasets with a trained model.
+
+        Args:
+            since (Optional[float]): Only datasets whose training finished after this time.
+        """
+        rows = self._connect().execute(
+            """SELECT DISTINCT datasets.name, datasets.content_hash FROM jobs JOIN datasets ON datasets.id = jobs.dataset_id
+               WHERE jobs.state = 'done' AND jobs.finished > ?""", (since or 0,))
+        return [{"name": row["name"], "content_hash": row["content_hash"]} for row in rows]
+
+    def unfinished_jobs(self) -> List[Dict]:
+        """Return the jobs that were queued or training, e.g. when the worker stopped."""
+        rows = self._connect().execute(
+            """SELECT jobs.*, datasets.name AS dataset_name, datasets.content_hash FROM jobs
+               JOIN datasets ON datasets.id = jobs.dataset_id
+               WHERE state IN ('queued', 'training') ORDER BY received""")
+        return [dict(row) for row in rows]
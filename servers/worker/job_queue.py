@@ -0,0 +1,520 @@
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Callable, Dict, List, Optional, Tuple
+
+from common import metrics
+from common import wire_protocol as wp
+
+PROGRESS_FILE = "progress.jsonl"  # Per-epoch metrics of a job, inside its dataset directory
+PROGRESS_POLL_INTERVAL = 1.0  # Seconds between two reads of the progress file of a running job
+TRAINING_ESTIMATE = 600.0  # Seconds a training is assumed to take until one finished on this worker
+ESTIMATE_SMOOTHING = 0.3  # Weight of the latest training in the running estimate of training durations
+RETAINED_JOBS = 1000  # Ended jobs kept in memory with an index; older ones are read back from it when asked about
+
+
+def read_progress(path: str, offset: int = 0) -> Tuple[List[bytes], int]:
+    """Read the complete progress lines written after ``offset``.
+
+    Returns:
+        Tuple[List[bytes], int]: The new events and the offset to read from next time.
+    """
+    if not os.path.exists(path):
+        return [], offset
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read()
+    complete = data[:data.rfind(b"\n") + 1]  # A line still being written is read next time
+    return complete.splitlines(), offset + len(complete)
+
+
+class TrainingJob:
+    """
+    One dataset upload and the training run on it.
+
+    Attributes:
+        job_id (str): Identifier returned to the client.
+        dataset_name (str): Name the client gave the dataset.
+        new_dir (str): Dataset directory to train on.
+        dir_number (str): Dataset id, the number of ``new_dir``.
+        state (str): "receiving", "queued", "training", "done" or "failed".
+        submitted (float): Time the upload started.
+        received (Optional[float]): Time the dataset was complete and the job queued.
+        started (Optional[float]): Time the training started.
+        finished (Optional[float]): Time the training ended.
+        model_path (Optional[str]): Trained model, once done.
+        model_size (Optional[int]): Size of the trained model in bytes, once done.
+        error (Optional[str]): Failure reason, once failed.
+        progress (List[bytes]): Per-epoch progress events, each a compact JSON document.
+        key (Optional[str]): Result cache key of the dataset and training parameters.
+        leader (Optional[TrainingJob]): Identical job in flight whose result this one takes.
+    """
+
+    RECEIVING = "receiving"
+    QUEUED = "queued"
+    TRAINING = "training"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id: str, dataset_name: str, new_dir: str, dir_number: str) -> None:
+        """
+        Initialize the TrainingJob.
+
+        Args:
+            job_id (str): Identifier returned to the client.
+            dataset_name (str): Name the client gave the dataset.
+            new_dir (str): Dataset directory to train on.
+            dir_number (str): Dataset id, the number of ``new_dir``.
+        """
+        self.job_id = job_id
+        self.dataset_name = dataset_name
+        self.new_dir = new_dir
+        self.dir_number = dir_number
+        self.state = self.RECEIVING
+        self.submitted = time.time()
+        self.received = None
+        self.started = None
+        self.finished = None
+        self.model_path = None
+        self.model_size = None
+        self.error = None
+        self.progress: List[bytes] = []
+        self.key = None
+        self.leader = None
+        self._progress_offset = 0  # Bytes of the progress file already read
+        self._progress_changed = asyncio.Event()  # Replaced by a new event every time it is set
+        self._finished = asyncio.Event()
+
+    @property
+    def progress_path(self) -> str:
+        return os.path.join(self.new_dir, PROGRESS_FILE)
+
+    def eta(self) -> Optional[float]:
+        """Return the seconds of training left as of the latest progress event, if any."""
+        if not self.progress:
+            return None
+        try:
+            return float(json.loads(self.progress[-1])["eta"])
+        except (ValueError, KeyError, TypeError):
+            return None
+
+    def add_progress(self, events: List[bytes]) -> None:
+        """Record progress events and wake up the watchers."""
+        if events:
+            self.progress.extend(events)
+            self._notify()
+
+    def _notify(self) -> None:
+        changed, self._progress_changed = self._progress_changed, asyncio.Event()
+        changed.set()
+
+    async def follow(self, start: int = 0) -> AsyncIterator[bytes]:
+        """Yield the progress events from index ``start`` on, until the job ends.
+
+        Every watcher reads the same shared list of encoded events, so watching
+        costs the trainer nothing and a watcher costs one wake-up per epoch.
+        """
+        index = max(0, start)
+        while True:
+            changed = self._progress_changed
+            while index < len(self.progress):
+                yield self.progress[index]
+                index += 1
+            if self._finished.is_set():
+                return
+            await changed.wait()
+
+    async def wait(self) -> str:
+        """Wait for the job to end and return the trained model.
+
+        Raises:
+            ProtocolError: If the training failed.
+        """
+        await self._finished.wait()
+        if self.state == self.FAILED:
+            raise wp.ProtocolError(f"Training job {self.job_id} failed: {self.error}")
+        return self.model_path
+
+    def timings(self) -> Dict[str, float]:
+        """Return the seconds spent in each state so far."""
+        now = time.time()
+        timings = {"receiving": (self.received or now) - self.submitted}
+        if self.received is not None:
+            timings["queued"] = (self.started or now) - self.received
+        if self.started is not None:
+            timings["training"] = (self.finished or now) - self.started
+        return timings
+
+
+class JobQueue:
+    """
+    Per-worker queue of training jobs, at most ``concurrency`` of which run at a time.
+
+    A job is opened when its upload starts and submitted once the dataset is
+    complete. Jobs start in submission order. Trainings run in a thread pool
+    sized to the concurrency limit, so a burst of uploads waits in the queue
+    instead of slowing every training down by oversubscribing the CPU. The
+    queue lives on the worker's event loop.
+
+    A job submitted with the same result key as a job already queued or
+    training does not train again: it follows that job and adopts its model,
+    or takes its place in the queue if it fails.
+
+    With an index, every state change is recorded in it, and jobs of earlier
+    runs of the worker are looked up there. Recording is a single small WAL
+    transaction without fsync, so it is done inline on the loop. Only the
+    latest ``retain`` ended jobs then stay in memory; older ones are read
+    back from the index when asked about.
+
+    The time ended jobs spent in each phase, and the length of the queue,
+    are recorded as metrics in ``registry``.
+
+    Attributes:
+        concurrency (int): Most trainings running at the same time.
+        id_prefix (str): Prefix of the job ids, naming the worker that owns them.
+        training_estimate (float): Running estimate of how long a training takes, in seconds.
+        registry (metrics.Registry): Metrics of the jobs.
+    """
+
+    def __init__(self, concurrency: int, run: Callable[[TrainingJob], str], id_prefix: str = "",
+                 index=None, data_dir: str = "", adopt: Optional[Callable[[TrainingJob, str], str]] = None,
+                 registry: Optional[metrics.Registry] = None, retain: int = RETAINED_JOBS) -> None:
+        """
+        Initialize the JobQueue.
+
+        Args:
+            concurrency (int): Most trainings running at the same time.
+            run (Callable[[TrainingJob], str]): Blocking function that trains a
+                job and returns the path of the model.
+            id_prefix (str): Prefix of the job ids, naming the worker that owns them.
+            index (Optional[JobIndex]): Durable record of the jobs.
+            data_dir (str): Directory holding the dataset directories, to find
+                the jobs of earlier runs.
+            adopt (Optional[Callable[[TrainingJob, str], str]]): Blocking function
+                giving a job an existing model, e.g. of the job it followed;
+                returns the job's model path.
+            registry (Optional[metrics.Registry]): Where to record metrics; a registry of its own if omitted.
+            retain (int): Ended jobs kept in memory when there is an index.
+        """
+        self.concurrency = max(1, concurrency)
+        self.id_prefix = id_prefix
+        self._index = index
+        self._data_dir = data_dir
+        self._run = run
+        self._adopt = adopt
+        self._in_flight: Dict[str, TrainingJob] = {}  # Job training each result key
+        self._followers: Dict[str, List[TrainingJob]] = {}  # Jobs waiting for the result of each key
+        self.coalesced = 0
+        self.training_estimate = (index.mean_training_seconds() if index is not None else None) or TRAINING_ESTIMATE
+        self._jobs: Dict[str, TrainingJob] = {}  # Jobs in memory, by id
+        self._dataset_jobs: Dict[str, TrainingJob] = {}  # Latest job in memory of each dataset, by dataset id
+        self._retain = retain
+        self._ended_ids = deque()  # Ids of the ended jobs in memory, oldest first
+        self._waiting = deque()
+        self._running: List[TrainingJob] = []
+        self._queue = asyncio.Queue()
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="training")
+        self._runners = []
+        self.registry = registry if registry is not None else metrics.Registry()
+        self._phase_seconds = {phase: self.registry.histogram("worker_job_phase_seconds",
+                                                              "Seconds ended jobs spent receiving, queued and training",
+                                                              metrics.DURATION_BUCKETS, {"phase": phase})
+                               for phase in (TrainingJob.RECEIVING, TrainingJob.QUEUED, TrainingJob.TRAINING)}
+        self._ended = {state: self.registry.counter("worker_jobs_total", "Jobs ended, by final state", {"state": state})
+                       for state in (TrainingJob.DONE, TrainingJob.FAILED)}
+        self.registry.counter("worker_jobs_coalesced_total", "Jobs that took the result of an identical job in flight",
+                              function=lambda: self.coalesced)
+        self.registry.gauge("worker_jobs_queued", "Jobs waiting for a training slot", function=lambda: len(self._waiting))
+        self.registry.gauge("worker_jobs_running", "Jobs training", function=lambda: len(self._running))
+        self.registry.gauge("worker_training_estimate_seconds", "Running estimate of how long a training takes",
+                            function=lambda: self.training_estimate)
+
+    def start(self) -> None:
+        """Start the runners; must be called from the event loop."""
+        self._runners = [asyncio.create_task(self._runner()) for _ in range(self.concurrency)]
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def open(self, dataset_name: str, new_dir: str, dir_number: str, job_id: Optional[str] = None) -> TrainingJob:
+        """Return the job of an upload that is starting or resuming, creating it if needed.
+
+        Args:
+            job_id (Optional[str]): Id the job was given when its upload
+                started, e.g. before the worker restarted; a new one when omitted.
+        """
+        if job_id in self._jobs:
+            return self._jobs[job_id]
+        job = TrainingJob(job_id or self.id_prefix + uuid.uuid4().hex[:16], dataset_name, new_dir, dir_number)
+        self._keep(job)
+        self._record(job)
+        return job
+
+    def _keep(self, job: TrainingJob) -> None:
+        """Hold a job in memory, by id and as the latest job of its dataset if it is."""
+        self._jobs[job.job_id] = job
+        latest = self._dataset_jobs.get(job.dir_number)
+        if latest is None or job.submitted >= latest.submitted:
+            self._dataset_jobs[job.dir_number] = job
+        if job.state in (job.DONE, job.FAILED):
+            self._retire(job)
+
+    def _retire(self, job: TrainingJob) -> None:
+        """Count a job as ended, dropping the oldest ended jobs from memory beyond ``retain`` if the index has them."""
+        if self._index is None:
+            return
+        self._ended_ids.append(job.job_id)
+        while len(self._ended_ids) > self._retain:
+            old = self._jobs.get(self._ended_ids.popleft())
+            if old is None or old.state not in (old.DONE, old.FAILED):
+                continue
+            del self._jobs[old.job_id]
+            if self._dataset_jobs.get(old.dir_number) is old:
+                del self._dataset_jobs[old.dir_number]
+
+    def submit(self, job: TrainingJob, key: Optional[str] = None) -> None:
+        """Queue the training of a job whose dataset is complete.
+
+        Args:
+            key (Optional[str]): Result cache key; a job in flight with the same
+                key is followed instead of training again.
+        """
+        job.state = job.QUEUED
+        job.received = time.time()
+        job.key = key
+        self._record(job)
+        self._enqueue(job)
+
+    def _enqueue(self, job: TrainingJob) -> None:
+        leader = self._in_flight.get(job.key) if job.key else None
+        if leader is not None:
+            job.leader = leader
+            self._followers.setdefault(job.key, []).append(job)
+            self.coalesced += 1
+            print(f"[JOB COALESCED] Job {job.job_id} follows identical job {leader.job_id}.")
+            return
+        if job.key:
+            self._in_flight[job.key] = job
+        self._waiting.append(job)
+        self._queue.put_nowait(job)
+
+    def complete(self, job: TrainingJob, model_path: str) -> None:
+        """End a job with an existing model, e.g. found in the result cache."""
+        job.model_path = model_path
+        job.model_size = os.path.getsize(model_path)
+        job.state = job.DONE
+        job.received = job.received or time.time()
+        job.started = job.started or time.time()
+        self._end(job)
+
+    def _end(self, job: TrainingJob) -> None:
+        job.finished = time.time()
+        self._record(job)
+        job._finished.set()
+        job._notify()
+        self._retire(job)
+        timings = job.timings()
+        for phase in (job.RECEIVING, job.QUEUED):  # Training is recorded by the runner, for jobs that trained
+            if phase in timings:
+                self._phase_seconds[phase].observe(timings[phase])
+        self._ended[job.state].inc()
+
+    async def _release_followers(self, leader: TrainingJob) -> None:
+        """Hand the result of a job to the identical jobs that waited for it."""
+        if not leader.key:
+            return
+        self._in_flight.pop(leader.key, None)
+        loop = asyncio.get_running_loop()
+        for job in self._followers.pop(leader.key, []):
+            job.leader = None
+            if leader.state != leader.DONE:
+                self._enqueue(job)  # Try again with this job's own copy of the dataset
+                continue
+            try:
+                self.complete(job, await loop.run_in_executor(None, self._adopt, job, leader.model_path))
+            except Exception as e:
+                self.fail(job, str(e))
+
+    def requeue_unfinished(self, key_for: Optional[Callable[[str], str]] = None) -> List[TrainingJob]:
+        """Queue again the jobs the index shows as queued or training, e.g. after the worker restarted.
+
+        Jobs keep their result key, so they are still coalesced with identical
+        jobs and their model is still cached.
+
+        Args:
+            key_for (Optional[Callable[[str], str]]): Returns the result key of
+                a dataset content hash, for jobs recorded without their key.
+        """
+        if self._index is None:
+            return []
+        jobs = []
+        for row in self._index.unfinished_jobs():
+            dir_number = str(row["dataset_id"])
+            job = self.open(row["dataset_name"], os.path.join(self._data_dir, dir_number), dir_number, row["job_id"])
+            job.submitted = row["submitted"]
+            key = row["result_key"]
+            if key is None and key_for is not None and row["content_hash"]:
+                key = key_for(row["content_hash"])
+            self.submit(job, key)
+            jobs.append(job)
+        return jobs
+
+    def fail(self, job: TrainingJob, error: str) -> None:
+        """End a job that will never be trained, e.g. because its upload was abandoned."""
+        job.state = job.FAILED
+        job.error = error
+        self._end(job)
+
+    def get(self, job_id: str) -> TrainingJob:
+        """Return a job by id.
+
+        Raises:
+            ProtocolError: If the job is unknown.
+        """
+        job = self.find_job(job_id)
+        if job is None:
+            raise wp.ProtocolError(f"Unknown training job {job_id}")
+        return job
+
+    def find_job(self, job_id: str) -> Optional[TrainingJob]:
+        """Return a job by id, or ``None`` if the worker does not know it."""
+        job = self._jobs.get(job_id)
+        if job is None and self._index is not None:
+            job = self._load(job_id)
+        return job
+
+    def _load(self, job_id: str) -> Optional[TrainingJob]:
+        """Rebuild a job of an earlier run of the worker from the index."""
+        row = self._index.get_job(job_id)
+        if row is None:
+            return None
+        dir_number = str(row["dataset_id"])
+        job = TrainingJob(job_id, row["dataset_name"], os.path.join(self._data_dir, dir_number), dir_number)
+        for field in ("state", "submitted", "received", "started", "finished", "model_size", "error"):
+            setattr(job, field, row[field])
+        job.key = row["result_key"]
+        if job.state == job.DONE:
+            job.model_path = os.path.join(job.new_dir, "best.pt")
+        if job.state in (job.DONE, job.FAILED):
+            job.progress, job._progress_offset = read_progress(job.progress_path)
+            job._finished.set()
+        self._keep(job)
+        return job
+
+    def find(self, dir_number: str) -> Optional[TrainingJob]:
+        """Return the latest job training a given dataset, if any."""
+        job = self._dataset_jobs.get(str(dir_number))
+        if job is None and self._index is not None:
+            job_id = self._index.latest_job_id(str(dir_number))
+            job = self.find_job(job_id) if job_id is not None else None
+        return job
+
+    def status(self, job: TrainingJob) -> Dict:
+        """Describe a job for a status query."""
+        return {
+            "job_id": job.job_id,
+            "state": job.state,
+            "dataset_name": job.dataset_name,
+            "dataset_id": job.dir_number,
+            "position": self.position(job),
+            "submitted": job.submitted,
+            "received": job.received,
+            "started": job.started,
+            "finished": job.finished,
+            "timings": job.timings(),
+            "error": job.error,
+            "follows": job.leader.job_id if job.leader is not None else None,
+        }
+
+    def position(self, job: TrainingJob) -> int:
+        """Return how many jobs run before this one starts, counting itself; 0 once started."""
+        if job.leader is not None:
+            return self.position(job.leader)
+        try:
+            return self._waiting.index(job) + 1
+        except ValueError:
+            return 0
+
+    def load(self) -> Dict:
+        """Return the queued and running job counts and the training seconds left before the queue is empty.
+
+        A running job counts for the ETA of its latest progress event, or the
+        training estimate minus the time it already ran; a queued job for the
+        training estimate. Seconds are summed over jobs, not divided by the
+        concurrency.
+        """
+        now = time.time()
+        remaining = len(self._waiting) * self.training_estimate
+        for job in self._running:
+            eta = job.eta()
+            remaining += eta if eta is not None else max(0.0, self.training_estimate - (now - job.started))
+        return {"queued": len(self._waiting), "running": len(self._running), "remaining_seconds": round(remaining, 1)}
+
+    def describe(self, job: TrainingJob) -> str:
+        """Summarise the state of a job for the client."""
+        if job.state == job.RECEIVING:
+            return f"Training job {job.job_id} is still receiving its dataset"
+        if job.state == job.QUEUED:
+            return f"Training job {job.job_id} is queued at position {self.position(job)}"
+        if job.state == job.TRAINING:
+            return f"Training job {job.job_id} is training for {time.time() - job.started:.0f}s"
+        if job.state == job.FAILED:
+            return f"Training job {job.job_id} failed: {job.error}"
+        return f"Training job {job.job_id} is done"
+
+    def _record(self, job: TrainingJob) -> None:
+        if self._index is None:
+            return
+        try:
+            self._index.save_job(job)
+        except Exception as e:
+            print(f"[ERROR] Recording job {job.job_id} in the index failed: {e}")
+
+    async def _watch_progress(self, job: TrainingJob) -> None:
+        while True:
+            await asyncio.sleep(PROGRESS_POLL_INTERVAL)
+            await self._read_progress(job)
+
+    async def _read_progress(self, job: TrainingJob) -> None:
+        try:
+            events, job._progress_offset = await asyncio.get_running_loop().run_in_executor(
+                None, read_progress, job.progress_path, job._progress_offset)
+        except OSError as e:
+            print(f"[ERROR] Reading the progress of job {job.job_id} failed: {e}")
+            return
+        job.add_progress(events)
+
+    async def _runner(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self._queue.get()
+            self._waiting.remove(job)
+            self._running.append(job)
+            job.state = job.TRAINING
+            job.started = time.time()
+            self._record(job)
+            print(f"[JOB STARTED] Job {job.job_id} for dataset '{job.dataset_name}' "
+                  f"after {job.started - job.received:.1f}s in the queue.")
+            watcher = asyncio.create_task(self._watch_progress(job))
+            try:
+                job.model_path = await loop.run_in_executor(self._executor, self._run, job)
+                job.model_size = os.path.getsize(job.model_path)
+                job.state = job.DONE
+            except Exception as e:
+                job.state = job.FAILED
+                job.error = str(e)
+            finally:
+                watcher.cancel()
+                self._running.remove(job)
+            await self._read_progress(job)
+            self._end(job)
+            self._phase_seconds[job.TRAINING].observe(job.finished - job.started)
+            if job.state == job.DONE:
+                duration = job.finished - job.started
+                self.training_estimate += ESTIMATE_SMOOTHING * (duration - self.training_estimate)
+            print(f"[JOB {job.state.upper()}] Job {job.job_id} after {job.finished - job.started:.1f}s of training.")
+            await self._release_followers(job)
@@ -0,0 +1,138 @@
+import os
+import shutil
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from common import manifest
+from common import metrics
+
+
+class ResultCache:
+    """
+    Trained models kept by the hash of the dataset and training parameters they came from.
+
+    Each entry is ``<root>/<key>.pt``, a hardlink to the ``best.pt`` of the
+    job that trained it, so storing a result copies nothing. Entries are
+    evicted least recently used first once they take more than ``max_bytes``;
+    recency survives restarts through the file access times.
+
+    Attributes:
+        root (str): Directory holding the cached models.
+        max_bytes (int): Size above which entries are evicted; 0 disables the cache.
+        hits (int): Lookups answered from the cache.
+        misses (int): Lookups that needed a training run.
+        evictions (int): Entries removed to stay under ``max_bytes``.
+    """
+
+    def __init__(self, root: str, max_bytes: int, registry: Optional[metrics.Registry] = None) -> None:
+        """
+        Initialize the ResultCache.
+
+        Args:
+            root (str): Directory holding the cached models, created if needed.
+            max_bytes (int): Size above which entries are evicted; 0 disables the cache.
+            registry (Optional[metrics.Registry]): Where to expose the counters and size of the cache, if anywhere.
+        """
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        entries = []
+        for file_name in os.listdir(root):
+            if file_name.endswith(".pt"):
+                stat = os.stat(os.path.join(root, file_name))
+                entries.append((stat.st_atime, file_name[:-len(".pt")], stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(entries))  # Least recently used first
+        self._size = sum(self._entries.values())
+        if registry is not None:
+            registry.counter("worker_result_cache_hits_total", "Trainings answered from the result cache",
+                             function=lambda: self.hits)
+            registry.counter("worker_result_cache_misses_total", "Lookups that needed a training",
+                             function=lambda: self.misses)
+            registry.counter("worker_result_cache_evictions_total", "Cached models evicted",
+                             function=lambda: self.evictions)
+            registry.gauge("worker_result_cache_bytes", "Size of the cached models", function=lambda: self._size)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key + ".pt")
+
+    def lookup(self, key: str) -> Optional[str]:
+        """Return the cached model for a key, counting a hit or a miss.
+
+        The entry is touched under the lock, so a concurrent ``store`` cannot
+        evict it in between; a file removed behind the cache's back is a miss.
+        """
+        with self._lock:
+            if key in self._entries:
+                try:
+                    os.utime(self._path(key))
+                except FileNotFoundError:
+                    self._size -= self._entries.pop(key)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return self._path(key)
+            self.misses += 1
+            return None
+
+    def store(self, key: str, model_path: str) -> None:
+        """Keep a trained model under its key, evicting older entries if the cache grows too large."""
+        size = os.path.getsize(model_path)
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        tmp_path = path + ".tmp"
+        try:
+            os.link(model_path, tmp_path)
+        except OSError:
+            # Different filesystem or no hardlink support: fall back to a copy
+            shutil.copyfile(model_path, tmp_path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._size += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            while self._size > self.max_bytes:
+                evicted, evicted_size = self._entries.popitem(last=False)
+                self._size -= evicted_size
+                self.evictions += 1
+                try:
+                    os.remove(self._path(evicted))
+                except FileNotFoundError:
+                    pass
+
+    def stats(self) -> Dict[str, int]:
+        """Return the counters and the current size of the cache."""
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self._entries), "bytes": self._size}
+
+
+def dataset_content_hash(dataset_dir: str, known_digests: Optional[Dict] = None) -> str:
+    """Return the canonical hash of the training data of a dataset directory.
+
+    Covers ``images/``, ``labels/`` and ``labels.json`` by relative path and
+    content, so it does not depend on how the dataset was uploaded.
+
+    Args:
+        dataset_dir (str): Received dataset directory.
+        known_digests (Optional[Dict]): Digests of files already hashed, by
+            ``(st_dev, st_ino)``, e.g. blobs hardlinked from the blob store;
+            only other files are read.
+    """
+    known_digests = known_digests or {}
+    entries = []
+    paths = [os.path.join(dataset_dir, "labels.json")]
+    for sub_dir in ("images", "labels"):
+        for root, _, files in os.walk(os.path.join(dataset_dir, sub_dir)):
+            paths.extend(os.path.join(root, file_name) for file_name in files)
+    for path in paths:
+        if not os.path.isfile(path):
+            continue
+        stat = os.stat(path)
+        digest = known_digests.get((stat.st_dev, stat.st_ino)) or manifest.file_digest(path)
+        entries.append({"name": os.path.relpath(path, dataset_dir).replace(os.sep, "/"), "digest": digest})
+    return manifest.dataset_digest(entries)
@@ -0,0 +1,78 @@
+"""
+Resource usage of the machine a worker runs on, for its load reports.
+
+Uses psutil when it is installed and reads /proc otherwise; a figure that
+cannot be measured on the platform is reported as ``None``.
+"""
+import os
+import shutil
+from typing import Optional, Tuple
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def _proc_cpu_times() -> Optional[Tuple[float, float]]:
+    """Return the busy and total CPU time of the machine from /proc/stat."""
+    try:
+        with open("/proc/stat", "r") as f:
+            fields = [float(value) for value in f.readline().split()[1:]]
+    except (OSError, ValueError):
+        return None
+    idle = fields[3] + (fields[4] if len(fields) > 4 else 0.0)  # idle + iowait
+    total = sum(fields)
+    return total - idle, total
+
+
+class CpuUsage:
+    """
+    CPU utilisation of the machine between two samples.
+
+    The first sample covers the time since the object was created, so it is
+    meaningful as soon as a load report is asked for.
+    """
+
+    def __init__(self) -> None:
+        """
+        Initialize the CpuUsage and take the reference sample.
+        """
+        self._last = _proc_cpu_times()
+        if psutil is not None:
+            psutil.cpu_percent(interval=None)
+
+    def sample(self) -> Optional[float]:
+        """Return the share of CPU time in use since the previous sample, from 0 to 1."""
+        if psutil is not None:
+            return psutil.cpu_percent(interval=None) / 100
+        current = _proc_cpu_times()
+        if current is not None and self._last is not None:
+            busy, total = current[0] - self._last[0], current[1] - self._last[1]
+            self._last = current
+            return busy / total if total > 0 else 0.0
+        if hasattr(os, "getloadavg"):
+            return min(1.0, os.getloadavg()[0] / (os.cpu_count() or 1))
+        return None
+
+
+def free_memory() -> Optional[int]:
+    """Return the memory available to new processes, in bytes."""
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def free_disk(path: str) -> Optional[int]:
+    """Return the free space of the filesystem holding ``path``, in bytes."""
+    try:
+        return shutil.disk_usage(path).free
+    except OSError:
+        return None
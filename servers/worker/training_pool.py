@@ -0,0 +1,169 @@
+"""
+Long-lived training processes.
+
+Each process imports ultralytics once when it starts, then trains the jobs
+it is handed, so a job pays for the training alone instead of a fresh
+interpreter plus the torch and ultralytics imports.
+"""
+import json
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, List, Optional, Tuple
+
+YOLO = None  # Model class, imported once in each training process by _warm_up
+torch = None  # Imported along with ultralytics when installed, to set thread counts
+THREAD_VARIABLES = ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS")  # Read when OpenMP and BLAS start
+
+
+def _set_thread_variables(threads: int) -> None:
+    for name in THREAD_VARIABLES:
+        os.environ[name] = str(threads)
+
+
+def _warm_up(threads: Optional[int] = None) -> None:
+    """Import ultralytics, with the thread pools of OpenMP, BLAS, OpenCV and torch sized to ``threads`` first.
+
+    The pools are created on import and sized to the whole machine unless told
+    otherwise; ``_pin`` resizes the intra-op pool of torch for every job.
+    """
+    global YOLO, torch
+    if threads:
+        _set_thread_variables(threads)
+        try:
+            import cv2
+            cv2.setNumThreads(threads)  # ultralytics may lower it further for its dataloader
+        except ImportError:
+            pass
+    try:
+        import torch as torch_module
+        torch = torch_module
+        if threads:
+            torch.set_num_interop_threads(threads)  # Only possible before any parallel work
+    except ImportError:
+        pass
+    from ultralytics import YOLO as yolo
+    YOLO = yolo
+
+
+def _pin(cpus: List[int]) -> None:
+    """Run the current training on the given cores only, with as many threads."""
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    _set_thread_variables(len(cpus))  # For the dataloader processes this training starts
+    if torch is not None:
+        torch.set_num_threads(len(cpus))
+
+
+def _progress_recorder(path: str):
+    """Return ultralytics callbacks appending one JSON line per epoch to ``path``.
+
+    Writing a line is all the trainer pays for progress reporting; the worker
+    reads the file and streams it to the clients.
+    """
+    times = {"started": time.time()}
+
+    def on_train_start(trainer):
+        times["started"] = times["epoch"] = time.time()
+
+    def on_fit_epoch_end(trainer):
+        now = time.time()
+        epoch = trainer.epoch + 1
+        metrics = dict(trainer.label_loss_items(trainer.tloss, prefix="train"))
+        metrics.update(trainer.metrics or {})
+        event = {
+            "epoch": epoch,
+            "epochs": trainer.epochs,
+            "epoch_time": round(now - times.get("epoch", times["started"]), 3),
+            "eta": round((now - times["started"]) / epoch * (trainer.epochs - epoch), 1),
+            "metrics": {name: round(float(value), 5) for name, value in metrics.items()},
+        }
+        times["epoch"] = now
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(event, separators=(",", ":")) + "\n")
+
+    return {"on_train_start": on_train_start, "on_fit_epoch_end": on_fit_epoch_end}
+
+
+def _ready() -> int:
+    return os.getpid()
+
+
+def _train(spec: Dict) -> Tuple[str, str]:
+    params = dict(spec.get("params", {}))
+    if spec.get("cpus"):
+        _pin(spec["cpus"])
+        params.setdefault("workers", len(spec["cpus"]))  # Dataloader processes inherit the affinity
+    model = YOLO(spec["model"])
+    if spec.get("progress"):
+        for event, callback in _progress_recorder(spec["progress"]).items():
+            model.add_callback(event, callback)
+    model.train(data=spec["data"], **params)
+    return str(model.trainer.best), str(model.trainer.save_dir)
+
+
+class TrainingPool:
+    """
+    Pool of training processes with ultralytics already imported.
+
+    Processes are started with ``spawn``, so they do not inherit the threads
+    and sockets of the worker, and are all started up front so that the first
+    jobs find them warm. A process that dies takes the pool down with it; the
+    pool is then replaced and only the jobs running at the time fail.
+
+    Attributes:
+        processes (int): Number of training processes.
+        threads (Optional[int]): Threads the libraries of each process start with, before a job pins it.
+    """
+
+    def __init__(self, processes: int, threads: Optional[int] = None) -> None:
+        """
+        Initialize the TrainingPool.
+
+        Args:
+            processes (int): Number of training processes.
+            threads (Optional[int]): Threads the OpenMP, BLAS, OpenCV and torch pools of each process
+                start with; sized to the whole machine by the libraries when omitted.
+        """
+        self.processes = max(1, processes)
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._executor = self._start()
+
+    def _start(self) -> ProcessPoolExecutor:
+        executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_warm_up, initargs=(self.threads,))
+        # Processes are spawned on demand: one task each brings all of them up now
+        for _ in range(self.processes):
+            executor.submit(_ready)
+        return executor
+
+    def train(self, spec: Dict) -> Tuple[str, str]:
+        """Train a model in one of the processes, blocking until it is done.
+
+        Args:
+            spec (Dict): ``data`` (dataset config path), ``model`` (architecture
+                or weights to start from), ``params`` (training hyperparameters)
+                and optionally ``cpus``, the cores to train on, and ``progress``,
+                the file per-epoch metrics are appended to as JSON lines.
+
+        Returns:
+            Tuple[str, str]: Path of the best weights and the run directory holding them.
+
+        Raises:
+            RuntimeError: If the training process died.
+        """
+        executor = self._executor
+        try:
+            return executor.submit(_train, spec).result()
+        except BrokenProcessPool:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = self._start()
+            raise RuntimeError("Training process died, check that ultralytics imports and the job fits in memory") from None
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=False, cancel_futures=True)
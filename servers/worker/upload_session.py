@@ -0,0 +1,348 @@
+import asyncio
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from common import wire_protocol as wp
+
+META_FILE = "session.json"
+JOURNAL_FILE = "journal"
+PARTS_DIR = "parts"
+CHECKPOINT_BYTES = 8 * 1024 * 1024  # Received bytes after which progress is made durable
+CHECKPOINT_SECONDS = 2.0  # Longest time progress may stay unsynced while data keeps arriving
+SESSION_ID_PATTERN = re.compile(r"[0-9A-Za-z_-]{1,64}")
+
+
+def sync_files(paths: Iterable[str]) -> None:
+    """Flush the files received since the last checkpoint to disk, and only those.
+
+    Unlike ``os.sync``, this never waits on the writes of other uploads and
+    trainings running on the machine.
+    """
+    for path in dict.fromkeys(paths):
+        fd = os.open(path, os.O_RDWR)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
+class UploadJournal:
+    """
+    Append-only record of how far each file of a session has been received.
+
+    Every line is a JSON ``[offset, name]`` pair and the last line for a name wins. The
+    data of a file is synced before a line referring to it is written, so every
+    offset in the journal is backed by bytes on disk. Completed files are
+    committed in groups to keep fsync off the per-file path.
+
+    Attributes:
+        path (str): Location of the journal file.
+    """
+
+    def __init__(self, path: str) -> None:
+        """
+        Initialize the UploadJournal.
+
+        Args:
+            path (str): Location of the journal file, created on first commit.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._pending: List[Tuple[str, int, str]] = []  # (name, offset, path) not committed yet
+        self._tracked: Dict[str, int] = {}  # Last position seen for files being received
+        self._unsynced_bytes = 0
+        self._last_commit = time.monotonic()
+
+    def offsets(self) -> Dict[str, int]:
+        """Replay the journal into the durable offset of every file."""
+        offsets = {}
+        if not os.path.exists(self.path):
+            return offsets
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                if not line.endswith("\n"):
+                    break  # Torn last line of a crash
+                offset, name = json.loads(line)
+                offsets[name] = offset
+        return offsets
+
+    def tracker(self, name: str, offset: int = 0):
+        """Return an ``on_write`` callback that checkpoints a file while it is being received.
+
+        Args:
+            name (str): Name the file is journaled under.
+            offset (int): Position the transfer starts at.
+        """
+        self._tracked[name] = offset
+
+        def on_write(f, position):
+            with self._lock:
+                self._unsynced_bytes += position - self._tracked.get(name, position)
+                self._tracked[name] = position
+                if self._due():
+                    os.fsync(f.fileno())
+                    self._commit([(name, position)])
+        return on_write
+
+    def file_done(self, name: str, size: int, path: str) -> None:
+        """Record a completely received file; it becomes durable with the next commit."""
+        with self._lock:
+            self._unsynced_bytes += size - self._tracked.pop(name, 0)
+            self._pending.append((name, size, path))
+            if self._due():
+                self._commit()
+
+    def commit(self) -> None:
+        """Make everything received so far durable."""
+        with self._lock:
+            self._commit()
+
+    def _due(self) -> bool:
+        return (self._unsynced_bytes >= CHECKPOINT_BYTES
+                or time.monotonic() - self._last_commit >= CHECKPOINT_SECONDS)
+
+    def _commit(self, extra: Iterable[Tuple[str, int]] = ()) -> None:
+        sync_files(path for _, _, path in self._pending if os.path.exists(path))
+        records = [(name, offset) for name, offset, _ in self._pending] + list(extra)
+        lines = [json.dumps([offset, name]) + "\n" for name, offset in records]
+        if lines:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+        self._pending.clear()
+        self._unsynced_bytes = 0
+        self._last_commit = time.monotonic()
+
+
+class SessionStore:
+    """
+    On-disk state of upload sessions, kept until the upload completes so that
+    an interrupted upload can be resumed by a new connection.
+
+    Each session owns ``<root>/<session id>/`` holding ``session.json`` (what
+    is being uploaded and where to), the journal and partially received blobs.
+
+    Attributes:
+        root (str): Directory holding one subdirectory per session.
+        ttl (float): Seconds of inactivity after which a session is abandoned.
+    """
+
+    def __init__(self, root: str, ttl: float) -> None:
+        """
+        Initialize the SessionStore.
+
+        Args:
+            root (str): Directory holding the sessions, created if needed.
+            ttl (float): Seconds of inactivity after which a session is abandoned.
+        """
+        self.root = root
+        self.ttl = ttl
+        os.makedirs(root, exist_ok=True)
+
+    def state_dir(self, session_id: str) -> str:
+        """Return the state directory of a session."""
+        if not SESSION_ID_PATTERN.fullmatch(session_id):
+            raise wp.ProtocolError(f"Invalid session id: {session_id!r}")
+        return os.path.join(self.root, session_id)
+
+    def create(self, session_id: str, meta: Dict) -> UploadJournal:
+        """Persist a new session and return its journal."""
+        state_dir = self.state_dir(session_id)
+        os.makedirs(os.path.join(state_dir, PARTS_DIR))
+        tmp_path = os.path.join(state_dir, META_FILE + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, os.path.join(state_dir, META_FILE))
+        return UploadJournal(os.path.join(state_dir, JOURNAL_FILE))
+
+    def load(self, session_id: str) -> Tuple[Dict, UploadJournal]:
+        """Return the description and journal of a session that was interrupted.
+
+        Raises:
+            ProtocolError: If the session is unknown, completed or expired.
+        """
+        state_dir = self.state_dir(session_id)
+        try:
+            with open(os.path.join(state_dir, META_FILE), "r", encoding="utf-8") as f:
+                meta = json.load(f)
+        except FileNotFoundError:
+            raise wp.ProtocolError(f"Unknown upload session {session_id}") from None
+        return meta, UploadJournal(os.path.join(state_dir, JOURNAL_FILE))
+
+    def part_path(self, session_id: str, name: str) -> str:
+        """Return where a partially received blob of a session is kept."""
+        return os.path.join(self.state_dir(session_id), PARTS_DIR, name)
+
+    def discard(self, session_id: str) -> None:
+        """Forget a session, once completed or abandoned."""
+        shutil.rmtree(self.state_dir(session_id), ignore_errors=True)
+
+    def expired(self) -> List[Tuple[str, Dict]]:
+        """Return the sessions that saw no progress for longer than the TTL."""
+        sessions = []
+        now = time.time()
+        for session_id in os.listdir(self.root):
+            state_dir = os.path.join(self.root, session_id)
+            paths = [os.path.join(state_dir, name) for name in (META_FILE, JOURNAL_FILE)]
+            mtimes = [os.path.getmtime(path) for path in paths if os.path.exists(path)]
+            if mtimes and now - max(mtimes) < self.ttl:
+                continue
+            try:
+                meta, _ = self.load(session_id)
+            except (wp.ProtocolError, ValueError):
+                meta = {}
+            sessions.append((session_id, meta))
+        return sessions
+
+
+class UploadSession:
+    """
+    Shared state of one dataset upload, possibly striped over several connections.
+
+    The connection that opened the session owns it: it receives its own share
+    of the files, then waits until every other stream has finished before the
+    dataset is assembled and trained. All streams run on the worker's event
+    loop, so the session is only touched from that loop.
+
+    Attributes:
+        session_id (str): Identifier chosen by the client.
+        new_dir (str): Dataset directory the streams write into.
+        mode (str): Upload mode, "files", "incremental" or "archive".
+        streams (int): Number of connections taking part, the owner included.
+        journal (UploadJournal): Durable progress of the session.
+        entries (Optional[list]): Manifest of an incremental upload.
+        offsets (Dict[str, int]): Durable offsets found when the session was resumed.
+    """
+
+    def __init__(self, session_id: str, new_dir: str, mode: str, streams: int, journal: UploadJournal,
+                 entries: Optional[list] = None, offsets: Optional[Dict[str, int]] = None) -> None:
+        """
+        Initialize the UploadSession.
+
+        Args:
+            session_id (str): Identifier chosen by the client.
+            new_dir (str): Dataset directory the streams write into.
+            mode (str): Upload mode, "files", "incremental" or "archive".
+            streams (int): Number of connections taking part, the owner included.
+            journal (UploadJournal): Durable progress of the session.
+            entries (Optional[list]): Manifest of an incremental upload.
+            offsets (Optional[Dict[str, int]]): Durable offsets of a resumed session.
+        """
+        self.session_id = session_id
+        self.new_dir = new_dir
+        self.mode = mode
+        self.streams = streams
+        self.journal = journal
+        self.entries = entries
+        self.offsets = offsets or {}
+        self._pending_blobs = set()
+        self._received_names = set()
+        self._finished_streams = 0
+        self._error = None
+        self._finished = asyncio.Event()  # Set once every stream is done or one failed
+
+    def expect_blobs(self, digests: Iterable[str]) -> None:
+        """Record the blobs the client has been asked to send."""
+        self._pending_blobs.update(digests)
+
+    def resume_offset(self, name: str) -> int:
+        """Return where an appended file continues.
+
+        Raises:
+            ProtocolError: If nothing of the file was durably received before.
+        """
+        if not self.offsets.get(name):
+            raise wp.ProtocolError(f"Nothing to append to for {name!r} in session {self.session_id}")
+        return self.offsets[name]
+
+    def claim_blob(self, digest: str) -> None:
+        """Mark a requested blob as taken by one stream.
+
+        Raises:
+            ProtocolError: If the blob was not requested or another stream already sent it.
+        """
+        self._check_open()
+        if digest not in self._pending_blobs:
+            raise wp.ProtocolError(f"Blob {digest!r} was not requested or was already sent")
+        self._pending_blobs.remove(digest)
+
+    def claim_name(self, file_name: str) -> None:
+        """Make sure no two streams write the same file.
+
+        Raises:
+            ProtocolError: If the file was already received on this session.
+        """
+        self._check_open()
+        if file_name in self._received_names:
+            raise wp.ProtocolError(f"File {file_name!r} sent twice in session {self.session_id}")
+        self._received_names.add(file_name)
+
+    def stream_finished(self, error: Optional[Exception] = None) -> None:
+        """Report that one stream is done, successfully or not."""
+        self._finished_streams += 1
+        if error is not None and self._error is None:
+            self._error = error
+        if self._error is not None or self._finished_streams >= self.streams:
+            self._finished.set()
+
+    def close(self, error: Exception) -> None:
+        """Stop the streams still attached, e.g. because the owner connection was lost."""
+        if self._error is None:
+            self._error = error
+        self._finished.set()
+
+    def _check_open(self) -> None:
+        if self._error is not None:
+            raise wp.ProtocolError(f"Session {self.session_id} was aborted: {self._error}")
+
+    async def wait(self, timeout: float) -> None:
+        """Wait until every stream has finished.
+
+        Raises:
+            ProtocolError: If a stream failed, blobs are missing or the streams time out.
+        """
+        try:
+            await asyncio.wait_for(self._finished.wait(), timeout)
+        except asyncio.TimeoutError:
+            raise wp.ProtocolError(f"Only {self._finished_streams} of {self.streams} streams finished in time") from None
+        if self._error is not None:
+            raise wp.ProtocolError(f"Stream of session {self.session_id} failed: {self._error}")
+        if self._pending_blobs:
+            raise wp.ProtocolError(f"{len(self._pending_blobs)} requested blobs were never sent")
+
+
+class SessionRegistry:
+    """Thread-safe lookup of the upload sessions in progress."""
+
+    def __init__(self) -> None:
+        self._sessions: Dict[str, UploadSession] = {}
+        self._lock = threading.Lock()
+
+    def add(self, session: UploadSession) -> None:
+        with self._lock:
+            if session.session_id in self._sessions:
+                raise wp.ProtocolError(f"Session {session.session_id} already exists")
+            self._sessions[session.session_id] = session
+
+    def get(self, session_id: str) -> UploadSession:
+        with self._lock:
+            session = self._sessions.get(session_id)
+        if session is None:
+            raise wp.ProtocolError(f"Unknown upload session {session_id}")
+        return session
+
+    def has(self, session_id: str) -> bool:
+        with self._lock:
+            return session_id in self._sessions
+
+    def remove(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
@@ -0,0 +1,807 @@
+import asyncio
+import hashlib
+import socket
+import os
+import json
+import shutil
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from common import wire_protocol as wp
+from common import wire_async
+from common import manifest
+from common import compression
+from common import metrics
+from worker.blob_store import BlobStore
+from worker.job_index import JobIndex
+from worker.job_queue import JobQueue
+from worker.result_cache import ResultCache, dataset_content_hash
+from worker.cpu_allocator import CpuAllocator, available_cpus
+from worker.system_load import CpuUsage, free_disk, free_memory
+from worker.training_pool import TrainingPool
+from worker.upload_session import SessionRegistry, SessionStore, UploadSession
+
+# Server configuration
+DATA_DIR = "received_datasets"
+IMAGE_EXTENSIONS = ('.png', '.jpg')
+INDEX_FILE = "jobs.sqlite3"  # Index of the datasets and training jobs of this worker
+MAPPING_FILE = "directory_mapping.json"  # Dataset index of older versions, migrated into INDEX_FILE
+BLOB_DIR = "blob_store"
+COMPRESSION_ENABLED = True  # Accept the codecs offered by clients
+MAX_STREAMS = 16  # Most connections a single upload session may use
+STREAM_TIMEOUT = 3600  # Seconds the session owner waits for the other streams
+SESSION_DIR = "upload_sessions"  # Durable state of uploads that are not complete yet
+SESSION_TTL = 24 * 3600  # Seconds an interrupted upload stays resumable
+SESSION_SWEEP_INTERVAL = 600  # Seconds between two sweeps for abandoned uploads
+IO_THREADS = 16  # Executor threads for disk work: writes, fsync, hashing, file reorganisation
+CORES_PER_TRAINING = None  # Cores pinned to each training; None gives each of the pool's trainings an equal slice
+MIN_CORES_PER_TRAINING = 4  # Cores per training the default pool size allows for
+MAX_TRAININGS = max(1, len(available_cpus()) // (CORES_PER_TRAINING or MIN_CORES_PER_TRAINING))  # Default pool size
+TRAINING_MODEL = "yolov8n.yaml"  # Architecture every job trains
+TRAINING_PARAMS = {"epochs": 1}  # Hyperparameters passed to YOLO.train
+WORKSPACE_DIR = "runs"  # Training workspace of a job, inside its dataset directory
+RESULT_CACHE_DIR = "result_cache"  # Trained models by dataset content and training parameters
+RESULT_CACHE_BYTES = 10 * 1024 ** 3  # Size above which cached models are evicted; 0 disables the cache
+LISTEN_BACKLOG = 1024  # Pending connections the kernel queues before accept
+UPLOAD_MODES = {wp.OP_DATASET: "files", wp.OP_ARCHIVE: "archive", wp.OP_MANIFEST: "incremental"}
+BRIDGE_ADDRESS = ("127.0.0.1", 12345)  # Bridge this worker registers with; None disables registration
+ADVERTISED_HOST = None  # Host clients reach this worker at; None means the bound host, or the address the bridge sees
+HEARTBEAT_INTERVAL = 2.0  # Seconds between two heartbeats to the bridge
+METRICS_HOST = "127.0.0.1"  # Address the Prometheus metrics are served on
+METRICS_PORT_OFFSET = 1000  # Metrics are served at /metrics on the worker port plus this; None disables them
+
+# Global variables
+client_count = 0  # Track connected clients
+uploads_started = 0  # Uploads started since this worker started, for the bridge to end its leases
+blob_store = None  # Content-addressed store, created by start_server
+session_store = None  # Resumable upload state, created by start_server
+upload_sessions = SessionRegistry()  # Upload sessions in progress, by session id
+job_queue = None  # Training jobs of this worker, created by serve
+training_pool = None  # Warm training processes, created by start_server
+cpu_allocator = None  # Cores of the running trainings, created by start_server
+job_index = None  # Datasets and jobs of this worker, created by start_server
+worker_id = None  # Prefix of the job ids of this worker, for the bridge to find their owner; set by start_server
+result_cache = None  # Models of earlier trainings, created by start_server
+cpu_usage = None  # CPU utilisation between two load reports, created by start_server
+
+# Metrics, served in the Prometheus format and as JSON on OP_STATS; the job queue and result cache add their own
+metrics_registry = metrics.Registry()
+REQUEST_KINDS = {wp.OP_GET_LOAD: "load", wp.OP_STATUS: "status", wp.OP_PROGRESS: "progress", wp.OP_DATASET: "upload",
+                 wp.OP_ARCHIVE: "upload", wp.OP_MANIFEST: "upload", wp.OP_RESUME: "resume", wp.OP_JOIN: "join",
+                 wp.OP_FETCH: "fetch", wp.OP_STATS: "stats"}
+request_counts = {kind: metrics_registry.counter("worker_requests_total", "Connections served, by request",
+                                                 {"kind": kind}) for kind in sorted(set(REQUEST_KINDS.values()))}
+upload_bytes = metrics_registry.counter("worker_upload_bytes_total", "Bytes of datasets received, uncompressed")
+upload_wire_bytes = metrics_registry.counter("worker_upload_wire_bytes_total", "Bytes of datasets received on the wire")
+upload_seconds = metrics_registry.histogram("worker_upload_seconds", "Seconds each upload stream took",
+                                            metrics.DURATION_BUCKETS)
+upload_throughput = metrics_registry.histogram("worker_upload_bytes_per_second",
+                                               "Uncompressed bytes per second of each upload stream",
+                                               metrics.THROUGHPUT_BUCKETS)
+download_bytes = metrics_registry.counter("worker_download_bytes_total", "Bytes of trained models sent, uncompressed")
+metrics_registry.gauge("worker_clients", "Clients uploading or downloading", function=lambda: client_count)
+metrics_registry.counter("worker_uploads_started_total", "Uploads started", function=lambda: uploads_started)
+
+def safe_file_name(file_name):
+    """Strip any directory component a client may have put in a file name."""
+    base_name = os.path.basename(file_name.replace("\\", "/"))
+    if base_name in ("", ".", ".."):
+        raise wp.ProtocolError(f"Invalid file name: {file_name!r}")
+    return base_name
+
+def dataset_path_for(new_dir, file_name):
+    """Return where a received file belongs in the training layout, or None to skip it."""
+    file_name = safe_file_name(file_name)
+    lower_name = file_name.lower()
+    if lower_name.endswith(IMAGE_EXTENSIONS):
+        return os.path.join(new_dir, 'images', 'train', file_name)
+    if lower_name.endswith('.txt'):
+        return os.path.join(new_dir, 'labels', 'train', file_name)
+    if file_name == 'labels.json':
+        return os.path.join(new_dir, file_name)
+    return None
+
+def create_dataset_dir(dataset_name):
+    """Register a new dataset in the index and create its numbered directory."""
+    dir_number = job_index.create_dataset(dataset_name)
+    new_dir = os.path.join(DATA_DIR, dir_number)
+    os.makedirs(new_dir)
+    print(f"[DIRECTORY CREATED] Directory {new_dir} for dataset '{dataset_name}'.")
+
+    os.makedirs(os.path.join(new_dir, 'images', 'train'))
+    os.makedirs(os.path.join(new_dir, 'labels', 'train'))
+    return dir_number, new_dir
+
+def in_executor(func, *args):
+    """Run blocking disk work in the I/O executor so the event loop keeps serving other connections."""
+    return asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+async def receive_file_frames(conn, session, transfer):
+    """Receive OP_FILE frames into the dataset root until the stream sends DONE."""
+    buffer = wp.new_buffer()
+    while True:
+        opcode, flags, file_name, payload_len = await conn.recv_header()
+        if opcode == wp.OP_DONE:
+            break
+        if opcode != wp.OP_FILE:
+            raise wp.ProtocolError(f"Unexpected opcode {opcode:#x} during upload")
+
+        file_name = safe_file_name(file_name)
+        session.claim_name(file_name)
+        file_path = os.path.join(session.new_dir, file_name)
+        offset = session.resume_offset(file_name) if flags & wp.FLAG_APPEND else 0
+        await wire_async.recv_file(conn, transfer, flags, payload_len, file_path, buffer, offset=offset,
+                                   on_write=session.journal.tracker(file_name, offset))
+        await in_executor(session.journal.file_done, file_name, os.path.getsize(file_path), file_path)
+        print(f"[FILE SAVED] {file_name} saved to {file_path}.")
+
+def organize_files(new_dir):
+    """Sort files received into the dataset root into images/ and labels/."""
+    for filename in os.listdir(new_dir):
+        source_file = os.path.join(new_dir, filename)
+
+        if os.path.isfile(source_file):
+            destination_file = dataset_path_for(new_dir, filename)
+            if destination_file is None or destination_file == source_file:
+                continue  # Skip files that are not images or labels
+            shutil.move(source_file, destination_file)
+        else:
+            print(f"[WARNING] skipping non-file: {source_file}")
+
+    print("Files moved successfully!")
+
+def link_dataset(new_dir, entries):
+    """Hardlink an incremental upload together from the blob store."""
+    for entry in entries:
+        destination = dataset_path_for(new_dir, entry["name"])
+        if destination is not None and not os.path.exists(destination):
+            blob_store.link(entry["digest"], destination)
+    print(f"[DATASET ASSEMBLED] {len(entries)} files linked from the blob store.")
+
+async def receive_blob_frames(conn, session, transfer):
+    """Receive requested OP_BLOB frames into the blob store until the stream sends DONE."""
+    buffer = wp.new_buffer()
+    while True:
+        opcode, flags, digest, payload_len = await conn.recv_header()
+        if opcode == wp.OP_DONE:
+            break
+        if opcode != wp.OP_BLOB:
+            raise wp.ProtocolError(f"Unexpected opcode {opcode:#x} during incremental upload")
+        session.claim_blob(digest)
+        offset = session.resume_offset(digest) if flags & wp.FLAG_APPEND else 0
+        await blob_store.receive(conn, digest, flags, payload_len, buffer, transfer,
+                                 session_store.part_path(session.session_id, digest), offset,
+                                 session.journal.tracker(digest, offset))
+
+async def receive_stream(conn, session, transfer):
+    """Receive this connection's share of a session and report it to the session."""
+    error = None
+    try:
+        if session.mode == "incremental":
+            await receive_blob_frames(conn, session, transfer)
+        elif session.mode == "files":
+            await receive_file_frames(conn, session, transfer)
+        else:
+            raise wp.ProtocolError(f"Upload mode {session.mode} cannot be striped")
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        session.stream_finished(error)
+
+async def receive_archive(conn, session, transfer):
+    """Unpack a streamed dataset archive straight into images/ and labels/."""
+    count = await wire_async.receive_archive(
+        conn, lambda name: dataset_path_for(session.new_dir, name), transfer,
+        lambda name, path, size: session.journal.file_done(name, size, path)
+    )
+    print(f"[TRANSFER COMPLETE] {count} files unpacked from archive.")
+
+async def receive_dataset(conn, session, transfer, reply=None):
+    """Receive a whole dataset, waiting for every stream of a striped session.
+
+    ``reply`` is the (opcode, payload) frame that tells the client the session
+    is ready, when the client waits for one.
+    """
+    if session.mode == "archive":
+        if session.streams != 1:
+            raise wp.ProtocolError("Archive uploads use a single stream")
+        if reply:
+            await conn.send_frame(reply[0], session.session_id, reply[1])
+        await receive_archive(conn, session, transfer)
+        return
+
+    needed = None
+    if session.mode == "incremental":
+        # Ask only for the blobs we do not hold yet
+        needed = await in_executor(blob_store.missing, [entry["digest"] for entry in session.entries])
+        session.expect_blobs(needed)
+        print(f"[MANIFEST] {len(session.entries)} files, {len(needed)} blobs missing.")
+
+    if reply:
+        # The client opens the other streams once the session is known
+        await conn.send_frame(reply[0], session.session_id, reply[1])
+    if needed is not None:
+        await conn.send_frame(wp.OP_NEED, payload=manifest.encode(needed))
+
+    await receive_stream(conn, session, transfer)
+    await session.wait(STREAM_TIMEOUT)
+    print(f"[TRANSFER COMPLETE] All {session.streams} stream(s) of session {session.session_id} received.")
+
+    if session.entries is not None:
+        await in_executor(link_dataset, session.new_dir, session.entries)
+    else:
+        await in_executor(organize_files, session.new_dir)
+
+async def receive_upload(conn, session, transfer, reply=None):
+    """Receive the dataset of a session, then forget the session.
+
+    If the upload breaks off, the session and everything durably received stay
+    on disk so the client can resume it with OP_RESUME.
+    """
+    upload_sessions.add(session)
+    try:
+        await receive_dataset(conn, session, transfer, reply)
+    except Exception as e:
+        session.close(e)
+        await in_executor(session.journal.commit)
+        print(f"[SESSION SUSPENDED] Session {session.session_id} can be resumed: {e}")
+        raise
+    finally:
+        upload_sessions.remove(session.session_id)
+    await in_executor(session_store.discard, session.session_id)
+    record_upload(transfer.stats)
+    print(f"[TRANSFER STATS] Upload: {transfer.stats.report()}")
+
+def record_upload(stats):
+    """Record the bytes and throughput of an upload stream that completed."""
+    elapsed = time.perf_counter() - stats.started
+    upload_bytes.inc(stats.raw_bytes)
+    upload_wire_bytes.inc(stats.wire_bytes)
+    upload_seconds.observe(elapsed)
+    if elapsed > 0:
+        upload_throughput.observe(stats.raw_bytes / elapsed)
+
+async def queue_training(conn, session, job, transfer, detach=False):
+    """Queue the training of a received dataset and acknowledge the upload with the job id.
+
+    The job runs whether or not the client keeps waiting on this connection.
+    Unless the client asked to detach, the model is sent here once trained; a
+    client that detaches polls OP_STATUS and downloads with OP_FETCH.
+    """
+    key = await in_executor(record_dataset, session)
+    cached = await in_executor(result_cache.lookup, key)
+    if cached is not None:
+        try:
+            model_path = await in_executor(adopt_model, job, cached)
+        except FileNotFoundError:
+            cached = None  # Evicted since the lookup: train it again
+    if cached is not None:
+        job_queue.complete(job, model_path)
+        print(f"[CACHE HIT] Job {job.job_id} reuses an earlier training, {result_cache.stats()}.")
+    else:
+        job_queue.submit(job, key)
+        print(f"[CACHE MISS] Job {job.job_id} needs a training, {result_cache.stats()}.")
+    position = job_queue.position(job)
+    reply = {"dataset_id": job.dir_number, "job_id": job.job_id, "position": position}
+    await conn.send_frame(wp.OP_DONE, session.session_id, json.dumps(reply).encode('utf-8'))
+    if cached is None:
+        print(f"[JOB QUEUED] Job {job.job_id} for dataset '{job.dataset_name}' at position {position}.")
+    if detach:
+        return
+
+    model_path = await job.wait()
+    await send_model(conn, model_path, transfer)
+
+def record_dataset(session):
+    """Record a completely received dataset in the index and return its result cache key.
+
+    The key covers the content of the training data and the training
+    parameters. Files linked from the blob store are not read again: their
+    digest is already known.
+    """
+    known_digests = {}
+    for entry in session.entries or []:
+        stat = os.stat(blob_store.path(entry["digest"]))
+        known_digests[(stat.st_dev, stat.st_ino)] = entry["digest"]
+    content_hash = dataset_content_hash(session.new_dir, known_digests)
+
+    size = file_count = 0
+    for root, _, files in os.walk(session.new_dir):
+        for file_name in files:
+            size += os.path.getsize(os.path.join(root, file_name))
+            file_count += 1
+    job_index.dataset_received(os.path.basename(session.new_dir), size, file_count, content_hash)
+
+    return result_key(content_hash)
+
+def result_key(content_hash):
+    """Return the result cache key of a training of the current model and parameters on a dataset."""
+    training = {"dataset": content_hash, "model": TRAINING_MODEL, "params": TRAINING_PARAMS}
+    return hashlib.sha256(json.dumps(training, sort_keys=True).encode('utf-8')).hexdigest()
+
+def adopt_model(job, model_path):
+    """Give a job an already trained model, linked into its dataset directory."""
+    destination = os.path.join(job.new_dir, "best.pt")
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(model_path, destination)
+    except OSError:
+        # Different filesystem or no hardlink support: fall back to a copy
+        shutil.copyfile(model_path, destination)
+    model_checksum(destination)
+    return destination
+
+def durable_offsets(session):
+    """Return the journaled offsets of a session that are still backed by data on disk."""
+    offsets = {}
+    for name, offset in session.journal.offsets().items():
+        if session.mode == "incremental":
+            path = session_store.part_path(session.session_id, name)
+        elif session.mode == "files":
+            path = os.path.join(session.new_dir, safe_file_name(name))
+        else:
+            path = dataset_path_for(session.new_dir, name)
+        if path is not None and os.path.exists(path) and os.path.getsize(path) >= offset:
+            offsets[name] = offset
+    return offsets
+
+def model_checksum(model_path):
+    """Return the SHA-256 of a model, cached in a file next to it."""
+    checksum_path = model_path + ".sha256"
+    if os.path.exists(checksum_path) and os.path.getmtime(checksum_path) >= os.path.getmtime(model_path):
+        with open(checksum_path, "r") as f:
+            return f.read().strip()
+    checksum = manifest.file_digest(model_path)
+    with open(checksum_path, "w") as f:
+        f.write(checksum)
+    return checksum
+
+async def send_model(conn, model_path, transfer, offset=0):
+    """Send a model from ``offset`` on, followed by the checksum of the whole file."""
+    transfer.stats = compression.TransferStats()
+    await wire_async.send_file(conn, transfer, wp.OP_MODEL, os.path.basename(model_path), model_path, offset)
+    checksum = await in_executor(model_checksum, model_path)
+    await conn.send_frame(wp.OP_CHECKSUM, payload=checksum.encode('utf-8'))
+    download_bytes.inc(transfer.stats.raw_bytes)
+    print(f"Best model {model_path} sent to client from byte {offset}.")
+    print(f"[TRANSFER STATS] Download: {transfer.stats.report()}")
+
+def find_model(dataset_name, dataset_id=None):
+    """Return the most recent trained model of a dataset, or of one upload of it, or None."""
+    dir_numbers = job_index.dataset_ids(dataset_name)
+    if dataset_id is not None:
+        dir_numbers = [k for k in dir_numbers if k == str(dataset_id)]
+    for dir_number in dir_numbers:
+        model_path = os.path.join(DATA_DIR, dir_number, "best.pt")
+        if os.path.exists(model_path):
+            return model_path
+    return None
+
+def train_dataset(new_dir, dir_number, progress_path=None):
+    """Train on a received dataset and return the path of the resulting best.pt.
+
+    Blocks for the whole training, so it runs in the job queue's executor.
+    Per-epoch metrics are appended to ``progress_path`` when given.
+    """
+    # Add dummy model file
+    model_path = os.path.join(new_dir, "model.txt")
+    with open(model_path, "w") as f:
+        f.write(f"""path: {os.getcwd()}/{new_dir}
+train: images/train
+val: images/train
+
+names:
+""")
+
+    # Write labels.json and config.yaml
+    labels_json_path = os.path.join(new_dir, 'labels.json')
+    with open(labels_json_path, 'r') as f:
+        labels = json.load(f)
+
+    to_write = f"""path: {os.getcwd()}/{new_dir}
+train: images/train
+val: images/train
+
+names:
+"""
+    to_write = to_write.replace("\\", "/")
+    for i in range(len(labels)):
+        to_write += f"  {i}: {labels[i]['name']}\n"
+
+    with open(os.path.join(new_dir, "config.yaml"), "w") as f:
+        f.write(to_write)
+        print("config.yaml written.")
+
+    # Run training in one of the warm training processes, inside the job's own workspace
+    workspace = os.path.abspath(os.path.join(new_dir, WORKSPACE_DIR))
+    shutil.rmtree(workspace, ignore_errors=True)  # Leftovers of an earlier, interrupted training
+    if progress_path and os.path.exists(progress_path):
+        os.remove(progress_path)
+    spec = {
+        "data": os.path.abspath(os.path.join(new_dir, "config.yaml")),
+        "model": TRAINING_MODEL,
+        "params": dict(TRAINING_PARAMS, project=workspace, name="train", exist_ok=True),
+        "cpus": cpu_allocator.acquire(),
+        "progress": os.path.abspath(progress_path) if progress_path else None,
+    }
+    try:
+        print(f"Training dataset {dir_number} on cores {spec['cpus']}.")
+        best_model_path, _ = training_pool.train(spec)
+        print(f"Training of dataset {dir_number} complete.")
+
+        # Move the best.pt model to the correct destination
+        destination_best_model = os.path.join(new_dir, "best.pt")
+        shutil.move(best_model_path, destination_best_model)
+        model_checksum(destination_best_model)
+        print(f"Best model moved to {destination_best_model}.")
+    finally:
+        cpu_allocator.release(spec["cpus"])
+        # Remove the workspace of this training only
+        shutil.rmtree(workspace, ignore_errors=True)
+        print(f"Removed the training workspace at {workspace}.")
+    return destination_best_model
+
+def train_job(job):
+    """Run a queued training job and keep its model in the result cache; called in the job queue's executor."""
+    model_path = train_dataset(job.new_dir, job.dir_number, job.progress_path)
+    if job.key:
+        result_cache.store(job.key, model_path)
+    return model_path
+
+def worker_info(host, port, datasets):
+    """Return the registration of this worker with the bridge, with its current load and the datasets it holds."""
+    advertised_host = ADVERTISED_HOST or (host if host not in ("", "0.0.0.0") else None)
+    return {
+        "host": advertised_host,
+        "port": port,
+        "capacity": training_pool.processes,
+        "capabilities": {"upload_modes": sorted(UPLOAD_MODES.values()), "compression": compression.available_codecs()},
+        "load": load_report(),
+        "datasets": datasets,
+    }
+
+def load_report():
+    """Return the load of this worker: connected clients, training backlog and free resources."""
+    report = {"clients": client_count, "capacity": training_pool.processes, "uploads_started": uploads_started,
+              "worker_id": worker_id}
+    report.update(job_queue.load())
+    cpu = cpu_usage.sample()
+    report.update(cpu=round(cpu, 3) if cpu is not None else None, memory_free=free_memory(), disk_free=free_disk(DATA_DIR))
+    return report
+
+async def heartbeat_forever(host, port):
+    """Register with the bridge, then send it the load of this worker every HEARTBEAT_INTERVAL seconds.
+
+    The registration lists the datasets this worker holds a trained model of,
+    and every heartbeat those trained since the previous one, so the bridge
+    can send clients to the data. The registration connection stays open for
+    the heartbeats: the bridge drops this worker when it breaks. If the
+    bridge goes away, registration is retried every HEARTBEAT_INTERVAL seconds.
+    """
+    loop = asyncio.get_running_loop()
+    bridge_lost = False
+    while True:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(False)
+        try:
+            await asyncio.wait_for(loop.sock_connect(sock, BRIDGE_ADDRESS), HEARTBEAT_INTERVAL)
+            conn = wire_async.Connection(sock)
+            since = time.time()
+            info = worker_info(host, port, await in_executor(job_index.trained_datasets))
+            await conn.send_frame(wp.OP_REGISTER, payload=json.dumps(info).encode('utf-8'))
+            wp.expect(await asyncio.wait_for(conn.recv_frame(), HEARTBEAT_INTERVAL), wp.OP_REGISTER)
+            print(f"[REGISTERED] Bridge at {BRIDGE_ADDRESS[0]}:{BRIDGE_ADDRESS[1]} routes clients to this worker.")
+            bridge_lost = False
+            while True:
+                await asyncio.sleep(HEARTBEAT_INTERVAL)
+                # Jobs finishing while the index is read are reported again next time, which is harmless
+                now, datasets = time.time(), await in_executor(job_index.trained_datasets, since)
+                since = now
+                heartbeat = {"load": load_report(), "datasets": datasets}
+                await conn.send_frame(wp.OP_HEARTBEAT, payload=json.dumps(heartbeat).encode('utf-8'))
+        except (OSError, asyncio.TimeoutError, wp.ProtocolError) as e:
+            if not bridge_lost:
+                print(f"[WARNING] Bridge unreachable ({e or 'timed out'}), retrying every {HEARTBEAT_INTERVAL:.0f}s.")
+            bridge_lost = True
+        finally:
+            sock.close()
+        await asyncio.sleep(HEARTBEAT_INTERVAL)
+
+async def handle_load_request(conn):
+    """Handle bridge request for server load, answered with load_report() as JSON."""
+    try:
+        await conn.send_frame(wp.OP_LOAD, payload=json.dumps(load_report()).encode('utf-8'))
+    except Exception as e:
+        print(f"[ERROR] Sending load failed: {e}")
+    finally:
+        conn.close()
+
+async def handle_stats(conn):
+    """Answer a request for the metrics of this worker with their summary as JSON."""
+    try:
+        await conn.send_frame(wp.OP_STATS, payload=json.dumps(metrics_registry.snapshot()).encode('utf-8'))
+    except OSError as e:
+        print(f"[ERROR] Sending stats failed: {e}")
+    finally:
+        conn.close()
+
+async def handle_client(conn, addr, first_frame, transfer, session_request=None):
+    """Receive a new dataset upload, train on it and send the model back."""
+    dataset_name = first_frame.name
+    print(f"[NEW CONNECTION] {addr} connected.")
+    print(f"[DATASET RECEIVED] Dataset name: {dataset_name}")
+
+    mode = UPLOAD_MODES[first_frame.opcode]
+    entries = manifest.decode(first_frame.payload) if mode == "incremental" else None
+    dir_number, new_dir = await in_executor(create_dataset_dir, dataset_name)
+
+    # Receive the dataset file by file, as a single archive stream or as a manifest,
+    # over this connection and any other connection that joins the session
+    session_id, streams, detach = session_request or (uuid.uuid4().hex, 1, False)
+    job = job_queue.open(dataset_name, new_dir, dir_number)
+    journal = await in_executor(session_store.create, session_id, {
+        "dataset_name": dataset_name, "dir_number": dir_number, "mode": mode, "entries": entries,
+        "job_id": job.job_id,
+    })
+    session = UploadSession(session_id, new_dir, mode, streams, journal, entries)
+    reply = json.dumps({"job_id": job.job_id}).encode('utf-8')
+    await receive_upload(conn, session, transfer, (wp.OP_SESSION, reply) if session_request else None)
+
+    await queue_training(conn, session, job, transfer, detach)
+
+async def handle_resume(conn, addr, frame, transfer):
+    """Continue an interrupted upload session, then train as for a new upload."""
+    session_id = frame.name
+    streams, detach = parse_session_request(frame.payload)
+    meta, journal = await in_executor(session_store.load, session_id)
+    new_dir = os.path.join(DATA_DIR, meta["dir_number"])
+    job = job_queue.open(meta["dataset_name"], new_dir, meta["dir_number"], meta.get("job_id"))
+    session = UploadSession(session_id, new_dir, meta["mode"], streams, journal, meta.get("entries"))
+    session.offsets = await in_executor(durable_offsets, session)
+    print(f"[RESUME] {addr} resumed session {session_id} of dataset '{meta['dataset_name']}', "
+          f"{len(session.offsets)} files already (partly) received.")
+
+    reply = json.dumps({"offsets": session.offsets, "job_id": job.job_id}).encode('utf-8')
+    await receive_upload(conn, session, transfer, (wp.OP_RESUME, reply))
+
+    await queue_training(conn, session, job, transfer, detach)
+
+async def handle_join(conn, addr, session_id, transfer):
+    """Receive an extra stream of a striped upload session."""
+    print(f"[JOIN] {addr} joined upload session {session_id}.")
+    await receive_stream(conn, upload_sessions.get(session_id), transfer)
+    await conn.send_frame(wp.OP_DONE)
+    record_upload(transfer.stats)
+    print(f"[TRANSFER STATS] Stream of {session_id}: {transfer.stats.report()}")
+
+async def handle_fetch(conn, addr, frame, transfer):
+    """Send the trained model of a job or dataset, continuing a download the client already started."""
+    dataset_name = frame.name
+    request = json.loads(frame.payload.decode('utf-8') or "{}")
+    offset = int(request.get("offset", 0))
+    dataset_id = request.get("dataset_id")
+    job = job_queue.find_job(request["job_id"]) if request.get("job_id") else None
+    if job is not None:
+        if job.state != job.DONE:
+            raise wp.ProtocolError(job_queue.describe(job))
+        dataset_id = job.dir_number
+    model_path = await in_executor(find_model, dataset_name, dataset_id)
+    if model_path is None:
+        job = job_queue.find(dataset_id) if dataset_id is not None else None
+        if job is not None:
+            raise wp.ProtocolError(job_queue.describe(job))
+        raise wp.ProtocolError(f"No trained model for dataset '{dataset_name}' yet")
+    if not 0 <= offset <= os.path.getsize(model_path):
+        offset = 0  # The client holds part of some other file: start over
+    print(f"[FETCH] {addr} fetching {model_path}.")
+    await send_model(conn, model_path, transfer, offset)
+
+async def handle_status(conn, frame):
+    """Report the state and timings of a training job."""
+    try:
+        job = job_queue.get(frame.name)
+        await conn.send_frame(wp.OP_STATUS, job.job_id, json.dumps(job_queue.status(job)).encode('utf-8'))
+    except wp.ProtocolError as e:
+        await conn.send_error(str(e))
+    except OSError as e:
+        print(f"[ERROR] Sending job status failed: {e}")
+    finally:
+        conn.close()
+
+async def handle_progress(conn, frame):
+    """Stream the progress events of a training job, then its final status."""
+    try:
+        job = job_queue.get(frame.name)
+        start = int(json.loads(frame.payload.decode('utf-8') or "{}").get("from", 0))
+        async for event in job.follow(start):
+            await conn.send_frame(wp.OP_PROGRESS, payload=event)
+        await conn.send_frame(wp.OP_STATUS, job.job_id, json.dumps(job_queue.status(job)).encode('utf-8'))
+    except (wp.ProtocolError, ValueError) as e:
+        try:
+            await conn.send_error(str(e))
+        except OSError:
+            pass
+    except OSError as e:
+        print(f"[ERROR] Streaming progress failed: {e}")
+    finally:
+        conn.close()
+
+async def serve_client(conn, addr, handler, *args):
+    """Run a client request, counting it towards the load and reporting failures to the client."""
+    global client_count
+    client_count += 1  # Increment client count
+
+    try:
+        await handler(conn, addr, *args)
+    except Exception as e:
+        print(f"[ERROR] {e}")
+        try:
+            await conn.send_error(str(e))
+        except OSError:
+            pass
+    finally:
+        conn.close()
+        client_count -= 1  # Decrement client count
+        print(f"[DISCONNECT] {addr} disconnected. Current client count: {client_count}")
+
+def parse_session_request(payload):
+    """Read the number of streams requested for an upload session, and whether the client detaches after it."""
+    request = json.loads(payload.decode('utf-8'))
+    streams = int(request["streams"])
+    if not 1 <= streams <= MAX_STREAMS:
+        raise wp.ProtocolError(f"Invalid stream count {streams}")
+    return streams, bool(request.get("detach", False))
+
+async def handle_connection(sock, addr):
+    """Read the first frame of a connection and dispatch it to the right handler."""
+    global uploads_started
+    conn = wire_async.Connection(sock)
+    try:
+        frame = await conn.recv_frame()
+        transfer = compression.Transfer()
+        if frame.opcode == wp.OP_HELLO:
+            # Negotiate compression, then read the actual request
+            transfer = await wire_async.accept_hello(conn, frame, COMPRESSION_ENABLED)
+            frame = await conn.recv_frame()
+        session_request = None
+        if frame.opcode == wp.OP_SESSION:
+            # Resumable or striped upload: remember the session, then read the dataset request
+            session_request = (frame.name, *parse_session_request(frame.payload))
+            frame = await conn.recv_frame()
+    except (OSError, wp.ProtocolError, ValueError, KeyError) as e:
+        print(f"[ERROR] {addr} sent an invalid first frame: {e}")
+        conn.close()
+        return
+
+    kind = REQUEST_KINDS.get(frame.opcode)
+    if kind is not None:
+        request_counts[kind].inc()
+    if frame.opcode == wp.OP_GET_LOAD:
+        # Handle load request from bridge
+        await handle_load_request(conn)
+    elif frame.opcode == wp.OP_STATUS:
+        # Handle a job status query, from a client or relayed by the bridge
+        await handle_status(conn, frame)
+    elif frame.opcode == wp.OP_PROGRESS:
+        # Handle a client watching the progress of a job
+        await handle_progress(conn, frame)
+    elif frame.opcode == wp.OP_STATS:
+        # Handle a request for the metrics of this worker
+        await handle_stats(conn)
+    elif frame.opcode in (wp.OP_DATASET, wp.OP_ARCHIVE, wp.OP_MANIFEST):
+        # Handle dataset transfer from client
+        uploads_started += 1
+        await serve_client(conn, addr, handle_client, frame, transfer, session_request)
+    elif frame.opcode == wp.OP_RESUME:
+        # Handle the reconnection of an interrupted upload
+        await serve_client(conn, addr, handle_resume, frame, transfer)
+    elif frame.opcode == wp.OP_JOIN:
+        # Handle an extra stream of a striped upload
+        await serve_client(conn, addr, handle_join, frame.name, transfer)
+    elif frame.opcode == wp.OP_FETCH:
+        # Handle a (resumed) download of a trained model
+        await serve_client(conn, addr, handle_fetch, frame, transfer)
+    else:
+        print(f"[ERROR] {addr} sent unknown opcode {frame.opcode:#x}")
+        try:
+            await conn.send_error(f"Unknown opcode {frame.opcode:#x}")
+        except OSError:
+            pass
+        conn.close()
+
+def sweep_sessions():
+    """Delete upload sessions abandoned for longer than SESSION_TTL, with their half-filled dataset directories.
+
+    Returns the jobs of the deleted sessions.
+    """
+    abandoned_jobs = []
+    for session_id, meta in session_store.expired():
+        if upload_sessions.has(session_id):
+            continue
+        dir_number = meta.get("dir_number")
+        if dir_number is not None:
+            shutil.rmtree(os.path.join(DATA_DIR, dir_number), ignore_errors=True)
+            job_index.delete_dataset(dir_number)
+        session_store.discard(session_id)
+        if meta.get("job_id"):
+            abandoned_jobs.append(meta["job_id"])
+        print(f"[SESSION EXPIRED] Removed abandoned upload session {session_id}.")
+    return abandoned_jobs
+
+async def sweep_sessions_forever():
+    """Run sweep_sessions every SESSION_SWEEP_INTERVAL seconds."""
+    while True:
+        try:
+            for job_id in await in_executor(sweep_sessions):
+                job = job_queue.find_job(job_id)
+                if job is not None:
+                    job_queue.fail(job, "Upload abandoned")
+        except OSError as e:
+            print(f"[ERROR] Sweeping upload sessions failed: {e}")
+        await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+
+async def serve(host, port):
+    """Accept connections and serve each of them as a task on the event loop."""
+    global job_queue
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=IO_THREADS, thread_name_prefix="io"))
+    job_queue = JobQueue(training_pool.processes, train_job, id_prefix=f"{worker_id}-", index=job_index,
+                         data_dir=DATA_DIR, adopt=adopt_model, registry=metrics_registry)
+    job_queue.start()
+    for job in job_queue.requeue_unfinished(result_key):
+        print(f"[JOB REQUEUED] Job {job.job_id} for dataset '{job.dataset_name}' was interrupted by a restart.")
+
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_socket.bind((host, port))
+    server_socket.listen(LISTEN_BACKLOG)
+    server_socket.setblocking(False)
+    print(f"[STARTING] Server is listening on {host}:{port}, running up to {training_pool.processes} trainings at once")
+
+    tasks = {asyncio.create_task(sweep_sessions_forever())}  # Keep a reference until each task is done
+    if BRIDGE_ADDRESS is not None:
+        tasks.add(asyncio.create_task(heartbeat_forever(host, port)))
+    if METRICS_PORT_OFFSET is not None:
+        try:
+            await metrics.serve_prometheus(metrics_registry, METRICS_HOST, port + METRICS_PORT_OFFSET)
+            print(f"[METRICS] Serving metrics on http://{METRICS_HOST}:{port + METRICS_PORT_OFFSET}/metrics")
+        except OSError as e:
+            print(f"[WARNING] Metrics not served on {METRICS_HOST}:{port + METRICS_PORT_OFFSET}: {e}")
+    try:
+        while True:
+            sock, addr = await loop.sock_accept(server_socket)
+            task = asyncio.create_task(handle_connection(sock, addr))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+    finally:
+        server_socket.close()
+        job_queue.shutdown()
+
+def start_server(host, port, training_processes=None):
+    """Start the server to accept connections.
+
+    ``training_processes`` sizes the pool of warm training processes, which is
+    also how many trainings run at once; it defaults to MAX_TRAININGS.
+    """
+    global blob_store, session_store, training_pool, cpu_allocator, job_index, worker_id, result_cache, cpu_usage
+    if not os.path.exists(DATA_DIR):
+        os.makedirs(DATA_DIR)
+    job_index = JobIndex(INDEX_FILE, legacy_mapping=MAPPING_FILE)
+    worker_id = job_index.worker_id()
+    result_cache = ResultCache(RESULT_CACHE_DIR, RESULT_CACHE_BYTES, registry=metrics_registry)
+    blob_store = BlobStore(BLOB_DIR)
+    session_store = SessionStore(SESSION_DIR, SESSION_TTL)
+    training_processes = training_processes or MAX_TRAININGS
+    cpu_allocator = CpuAllocator(CORES_PER_TRAINING, slots=training_processes)
+    training_pool = TrainingPool(training_processes, threads=cpu_allocator.cores_per_job)
+    cpu_usage = CpuUsage()
+
+    try:
+        asyncio.run(serve(host, port))
+    except KeyboardInterrupt:
+        print("\n[SHUTTING DOWN] Server stopped.")
+    finally:
+        training_pool.shutdown()
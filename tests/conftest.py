@@ -0,0 +1,6 @@
+import os
+import sys
+
+# Import the shared modules and the servers the way their entry points do
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT_DIR, os.path.join(ROOT_DIR, "servers")]
@@ -0,0 +1,65 @@
+import asyncio
+import os
+import socket
+import threading
+
+import pytest
+
+from common import archive_stream
+from common import compression
+from common import wire_async
+
+LONG_NAME = "image-" + "x" * 150 + ".jpg"  # Longer than a ustar header holds, so sent in a PAX header
+
+
+def receive(tmp_path, file_names, transfer, destination_for):
+    """Send files from ``tmp_path/src`` as an archive over a socket pair; return what the receiver reported."""
+    source = tmp_path / "src"
+    sender, receiver = socket.socketpair()
+    thread = threading.Thread(target=archive_stream.send_archive, args=(sender, str(source), file_names, transfer))
+    received = []
+
+    async def unpack():
+        conn = wire_async.Connection(receiver)
+        thread.start()
+        return await wire_async.receive_archive(conn, destination_for, transfer,
+                                                lambda name, path, size: received.append((name, path, size)))
+    try:
+        written = asyncio.run(unpack())
+    finally:
+        thread.join()
+        sender.close()
+        receiver.close()
+    return written, received
+
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_archive_is_unpacked_as_it_arrives(tmp_path, compress):
+    source = tmp_path / "src"
+    source.mkdir()
+    files = {"1.txt": b"0 0.5 0.5 0.1 0.1\n" * 50000, LONG_NAME: os.urandom(300000), "empty.txt": b""}
+    for name, data in files.items():
+        (source / name).write_bytes(data)
+    destination = tmp_path / "dst"
+    destination.mkdir()
+    transfer = compression.Transfer(compression.get_codec(compression.available_codecs()[0]) if compress else None)
+
+    written, received = receive(tmp_path, list(files), transfer, lambda name: str(destination / name))
+    assert written == len(files)
+    assert [(name, size) for name, _, size in received] == [(name, len(data)) for name, data in files.items()]
+    for name, data in files.items():
+        assert (destination / name).read_bytes() == data
+
+
+def test_members_without_destination_are_skipped(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    (source / "keep.txt").write_bytes(b"keep")
+    (source / "skip.txt").write_bytes(b"skip" * 1000)
+
+    written, received = receive(tmp_path, ["skip.txt", "keep.txt"], compression.Transfer(),
+                                lambda name: str(tmp_path / name) if name == "keep.txt" else None)
+    assert written == 1
+    assert [name for name, _, _ in received] == ["keep.txt"]
+    assert (tmp_path / "keep.txt").read_bytes() == b"keep"
+    assert not (tmp_path / "skip.txt").exists()
@@ -0,0 +1,102 @@
+import pytest
+
+from manager.server_manager import CircuitBreaker
+
+
+class FakeClock:
+    """Clock that only moves when a test advances it."""
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+class FixedJitter:
+    """Random source whose jitter is always the same factor of its range."""
+
+    def __init__(self, factor=1.0):
+        self.factor = factor
+
+    def uniform(self, low, high):
+        assert (low, high) == (0.8, 1.2)
+        return self.factor
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
+
+
+def make_breaker(clock, jitter=1.0, **kwargs):
+    return CircuitBreaker(clock=clock, rng=FixedJitter(jitter), **kwargs)
+
+
+def test_circuit_opens_after_failure_threshold(clock):
+    breaker = make_breaker(clock, failure_threshold=3)
+    assert breaker.failure() is None
+    assert breaker.failure() is None
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.available
+    assert breaker.failure() == 1.0
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.available and not breaker.allow()
+
+
+def test_success_resets_the_failures_in_a_row(clock):
+    breaker = make_breaker(clock, failure_threshold=2)
+    breaker.failure()
+    assert breaker.success() is False
+    assert breaker.failure() is None
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_refused_connection_opens_the_circuit_at_once(clock):
+    breaker = make_breaker(clock, failure_threshold=5)
+    assert breaker.failure(refused=True) == 1.0
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+def test_circuit_half_opens_when_the_backoff_runs_out(clock):
+    breaker = make_breaker(clock, backoff_base=2.0)
+    breaker.failure(refused=True)
+    clock.advance(1.999)
+    assert not breaker.allow()
+    clock.advance(0.001)
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow(), "a single trial connection while half open"
+    assert not breaker.available
+
+
+def test_successful_trial_closes_the_circuit(clock):
+    breaker = make_breaker(clock)
+    breaker.failure(refused=True)
+    clock.advance(1.0)
+    assert breaker.allow()
+    assert breaker.success() is True
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.failures == 0
+    assert breaker.failure(refused=True) == 1.0, "the backoff starts over once the circuit closed"
+
+
+def test_failed_trials_double_the_backoff_up_to_backoff_max(clock):
+    breaker = make_breaker(clock, backoff_base=1.0, backoff_max=10.0)
+    backoffs = [breaker.failure(refused=True)]
+    for _ in range(5):
+        clock.advance(backoffs[-1])
+        assert breaker.allow()
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+        backoffs.append(breaker.failure())  # The trial connection fails
+    assert backoffs == [1.0, 2.0, 4.0, 8.0, 10.0, 10.0]
+
+
+@pytest.mark.parametrize("jitter", [0.8, 1.2])
+def test_backoff_is_jittered_within_the_cap(clock, jitter):
+    breaker = make_breaker(clock, jitter=jitter, backoff_base=4.0, backoff_max=4.5)
+    assert breaker.failure(refused=True) == pytest.approx(min(4.5, 4.0 * jitter))
+    clock.advance(breaker.backoff_max)
+    assert breaker.allow()
+    assert breaker.failure() == 4.5
@@ -0,0 +1,39 @@
+from worker.cpu_allocator import CpuAllocator
+
+CPUS = list(range(32))
+
+
+def test_concurrent_jobs_get_disjoint_slices():
+    allocator = CpuAllocator(slots=4, cpus=CPUS)
+    jobs = [allocator.acquire() for _ in range(4)]
+    assert [len(cpus) for cpus in jobs] == [8, 8, 8, 8]
+    assert sorted(cpu for cpus in jobs for cpu in cpus) == CPUS
+
+
+def test_released_cores_go_to_the_next_job():
+    allocator = CpuAllocator(slots=2, cpus=CPUS)
+    first, second = allocator.acquire(), allocator.acquire()
+    assert not set(first) & set(second)
+    allocator.release(first)
+    third = allocator.acquire()
+    assert third == first
+    assert not set(third) & set(second)
+
+
+def test_job_alone_gets_only_its_slice():
+    allocator = CpuAllocator(slots=3, cpus=CPUS)
+    assert len(allocator.acquire()) == 10
+
+
+def test_fixed_cores_per_job():
+    allocator = CpuAllocator(cores_per_job=4, slots=2, cpus=CPUS)
+    first, second = allocator.acquire(), allocator.acquire()
+    assert len(first) == len(second) == 4
+    assert not set(first) & set(second)
+
+
+def test_jobs_beyond_the_slots_share_the_least_used_cores():
+    allocator = CpuAllocator(cores_per_job=4, cpus=[0, 1, 2, 3, 4, 5])
+    first, second = allocator.acquire(), allocator.acquire()
+    assert first == [0, 1, 2, 3]
+    assert second == [0, 1, 4, 5]
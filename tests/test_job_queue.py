@@ -0,0 +1,197 @@
+import asyncio
+import contextlib
+import os
+import sqlite3
+
+import pytest
+
+from common import wire_protocol as wp
+from worker import job_index
+from worker.job_index import JobIndex
+from worker.job_queue import JobQueue
+
+
+@pytest.fixture
+def index(tmp_path):
+    return JobIndex(str(tmp_path / "jobs.sqlite3"))
+
+
+@pytest.fixture
+def model_path(tmp_path):
+    path = tmp_path / "best.pt"
+    path.write_bytes(b"model")
+    return str(path)
+
+
+def open_job(queue, index, data_dir, name="cats"):
+    dir_number = index.create_dataset(name)
+    return queue.open(name, os.path.join(data_dir, dir_number), dir_number)
+
+
+def queue_before_restart(index, data_dir, keys):
+    """Submit jobs with the given result keys to a queue that stops before training them; return their ids."""
+    async def submit():
+        queue = JobQueue(1, lambda job: None, index=index, data_dir=data_dir)
+        jobs = []
+        for key in keys:
+            job = open_job(queue, index, data_dir)
+            queue.submit(job, key)
+            jobs.append(job)
+        return [job.job_id for job in jobs]
+    return asyncio.run(submit())
+
+
+def test_requeued_jobs_keep_their_result_key(index, tmp_path, model_path):
+    data_dir = str(tmp_path)
+    job_ids = queue_before_restart(index, data_dir, ["key-1", "key-1"])
+    trained = []
+
+    def train(job):
+        trained.append((job.job_id, job.key))
+        return model_path
+
+    async def restart():
+        queue = JobQueue(1, train, index=index, data_dir=data_dir, adopt=lambda job, path: path)
+        queue.start()
+        jobs = queue.requeue_unfinished()
+        assert [job.job_id for job in jobs] == job_ids
+        assert [job.key for job in jobs] == ["key-1", "key-1"]
+        assert jobs[1].leader is jobs[0], "an identical requeued job follows the first instead of training"
+        return [await job.wait() for job in jobs]
+
+    assert asyncio.run(restart()) == [model_path, model_path]
+    assert trained == [(job_ids[0], "key-1")]
+
+
+def test_requeue_computes_missing_keys_from_the_dataset(index, tmp_path):
+    data_dir = str(tmp_path)
+    [job_id] = queue_before_restart(index, data_dir, [None])  # Recorded without a key, as older workers did
+    index.dataset_received("1", 10, 2, "content-hash")
+
+    async def restart():
+        queue = JobQueue(1, lambda job: None, index=index, data_dir=data_dir)
+        return queue.requeue_unfinished(lambda content_hash: f"key-of-{content_hash}")
+
+    [job] = asyncio.run(restart())
+    assert job.job_id == job_id
+    assert job.key == "key-of-content-hash"
+
+
+def test_index_of_an_older_worker_gains_the_result_key(tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    old_schema = job_index.SCHEMA.replace(",\n    result_key TEXT", "")
+    assert old_schema != job_index.SCHEMA
+    with sqlite3.connect(path) as db:
+        db.executescript(old_schema)
+    index = JobIndex(path)
+    with sqlite3.connect(path) as db:
+        assert "result_key" in {row[1] for row in db.execute("PRAGMA table_info(jobs)")}
+    assert index.unfinished_jobs() == []
+
+
+def run_jobs(queue_args, submissions, tmp_path):
+    """Submit ``(dataset name, key)`` jobs to a started queue and wait for all of them to end; return the jobs."""
+    index = JobIndex(str(tmp_path / "coalescing.sqlite3"))
+
+    async def scenario():
+        queue = JobQueue(1, index=index, data_dir=str(tmp_path), **queue_args)
+        queue.start()
+        jobs = []
+        for name, key in submissions:
+            job = open_job(queue, index, str(tmp_path), name)
+            queue.submit(job, key)
+            jobs.append(job)
+        for job in jobs:
+            with contextlib.suppress(wp.ProtocolError):  # Failures are checked on the job states
+                await asyncio.wait_for(job.wait(), 5)
+        return queue, jobs
+    return asyncio.run(scenario())
+
+
+def test_identical_jobs_follow_the_one_in_flight(tmp_path, model_path):
+    trained, adopted = [], []
+
+    def train(job):
+        trained.append(job.dataset_name)
+        return model_path
+
+    def adopt(job, path):
+        adopted.append((job.dataset_name, path))
+        return path
+
+    queue, jobs = run_jobs({"run": train, "adopt": adopt},
+                           [("first", "key"), ("copy", "key"), ("other", "other-key")], tmp_path)
+    assert trained == ["first", "other"]
+    assert adopted == [("copy", model_path)]
+    assert [job.state for job in jobs] == ["done", "done", "done"]
+    assert queue.coalesced == 1
+
+
+def test_followers_train_themselves_when_the_leader_fails(tmp_path, model_path):
+    attempts = []
+
+    def train(job):
+        attempts.append(job.dataset_name)
+        if job.dataset_name == "broken":
+            raise RuntimeError("bad dataset")
+        return model_path
+
+    _, (leader, follower) = run_jobs({"run": train, "adopt": lambda job, path: path},
+                                     [("broken", "key"), ("intact", "key")], tmp_path)
+    assert leader.state == "failed" and leader.error == "bad dataset"
+    assert follower.state == "done" and follower.model_path == model_path
+    assert attempts == ["broken", "intact"]
+
+
+def test_followers_end_when_they_fail_too(tmp_path):
+    def train(job):
+        raise RuntimeError(f"{job.dataset_name} failed")
+
+    _, jobs = run_jobs({"run": train}, [("a", "key"), ("b", "key"), ("c", "key")], tmp_path)
+    assert [job.state for job in jobs] == ["failed", "failed", "failed"]
+    assert [job.error for job in jobs] == ["a failed", "b failed", "c failed"]
+
+
+def test_worker_id_is_kept_across_restarts(index, tmp_path):
+    worker_id = index.worker_id()
+    assert worker_id and "-" not in worker_id
+    assert JobIndex(str(tmp_path / "jobs.sqlite3")).worker_id() == worker_id
+    assert JobIndex(str(tmp_path / "other.sqlite3")).worker_id() != worker_id
+
+
+def end_jobs(queue, index, data_dir, count, model_path):
+    jobs = []
+    for number in range(count):
+        job = open_job(queue, index, data_dir, f"dataset-{number}")
+        queue.complete(job, model_path)
+        jobs.append(job)
+    return jobs
+
+
+def test_only_the_latest_ended_jobs_stay_in_memory(index, tmp_path, model_path):
+    async def scenario():
+        queue = JobQueue(1, lambda job: None, index=index, data_dir=str(tmp_path), retain=2)
+        running = open_job(queue, index, str(tmp_path), "running")
+        jobs = end_jobs(queue, index, str(tmp_path), 5, model_path)
+        assert set(queue._jobs) == {running.job_id, jobs[3].job_id, jobs[4].job_id}
+        assert queue.find(jobs[4].dir_number) is jobs[4]
+
+        # Older jobs are read back from the index
+        old = queue.find_job(jobs[0].job_id)
+        assert old is not jobs[0]
+        assert (old.job_id, old.state, old.dataset_name) == (jobs[0].job_id, "done", "dataset-0")
+        assert queue.find(jobs[1].dir_number).job_id == jobs[1].job_id
+        assert queue.find("999") is None
+        assert len(queue._jobs) <= 3, "jobs read back from the index are pruned too"
+    asyncio.run(scenario())
+
+
+def test_ended_jobs_stay_in_memory_without_an_index(tmp_path, model_path):
+    index = JobIndex(str(tmp_path / "datasets.sqlite3"))  # Only allocates the dataset ids here
+
+    async def scenario():
+        queue = JobQueue(1, lambda job: None, data_dir=str(tmp_path), retain=2)
+        jobs = end_jobs(queue, index, str(tmp_path), 5, model_path)
+        assert [queue.find_job(job.job_id) for job in jobs] == jobs
+        assert queue.find(jobs[0].dir_number) is jobs[0]
+    asyncio.run(scenario())
@@ -0,0 +1,137 @@
+import asyncio
+
+import pytest
+
+from common import metrics
+
+BUCKETS = tuple(float(bound) for bound in range(10, 101, 10))
+
+
+def uniform_histogram(registry=None):
+    """Histogram of 1 to 100, ten values in each of ``BUCKETS``."""
+    registry = registry or metrics.Registry()
+    histogram = registry.histogram("job_seconds", "Job duration", buckets=BUCKETS)
+    for value in range(1, 101):
+        histogram.observe(value)
+    return histogram
+
+
+def sample_lines(text, prefix):
+    return [line for line in text.splitlines() if line.startswith(prefix)]
+
+
+def test_state_counts_cumulatively_with_inf_last():
+    histogram = uniform_histogram()
+    histogram.observe(250)
+    counts, total = histogram.state()
+    assert counts == [10, 20, 30, 40, 50, 60, 70, 80, 90, 100, 101]
+    assert total == sum(range(1, 101)) + 250
+
+
+def test_value_on_a_bound_counts_in_its_bucket():
+    histogram = metrics.Histogram({}, (1.0, 2.0))
+    histogram.observe(1.0)
+    histogram.observe(2.0)
+    histogram.observe(2.5)
+    assert histogram.state()[0] == [1, 2, 3]
+
+
+@pytest.mark.parametrize("fraction, expected", [(0.5, 50.0), (0.9, 90.0), (0.25, 25.0), (0.99, 99.0)])
+def test_quantiles_of_a_known_distribution(fraction, expected):
+    assert uniform_histogram().quantile(fraction) == pytest.approx(expected)
+
+
+def test_quantile_interpolates_within_a_bucket():
+    histogram = metrics.Histogram({}, (1.0, 2.0, 4.0))
+    for value in (0.5, 3.0, 3.0, 3.0):
+        histogram.observe(value)
+    assert histogram.quantile(0.5) == pytest.approx(2.0 + 2.0 / 3)
+
+
+def test_quantile_of_an_empty_histogram_or_in_inf():
+    histogram = metrics.Histogram({}, (1.0, 2.0))
+    assert histogram.quantile(0.5) is None
+    histogram.observe(10.0)
+    assert histogram.quantile(0.5) == 2.0
+
+
+def test_rendered_histogram_has_cumulative_buckets():
+    registry = metrics.Registry()
+    histogram = uniform_histogram(registry)
+    histogram.observe(1000)
+    text = registry.render()
+    assert "# TYPE job_seconds histogram" in text
+    buckets = sample_lines(text, "job_seconds_bucket")
+    assert buckets[0] == 'job_seconds_bucket{le="10"} 10'
+    assert buckets[-2] == 'job_seconds_bucket{le="100"} 100'
+    assert buckets[-1] == 'job_seconds_bucket{le="+Inf"} 101'
+    counts = [int(line.rsplit(" ", 1)[1]) for line in buckets]
+    assert counts == sorted(counts)
+    assert sample_lines(text, "job_seconds_count") == ["job_seconds_count 101"]
+    assert sample_lines(text, "job_seconds_sum") == [f"job_seconds_sum {sum(range(1, 101)) + 1000}"]
+
+
+def test_rendered_inf_bucket_equals_the_count_with_labels():
+    registry = metrics.Registry()
+    histogram = registry.histogram("request_seconds", "Request latency", labels={"op": "upload"})
+    for value in (0.0002, 0.003, 0.04, 30.0):
+        histogram.observe(value)
+    text = registry.render()
+    assert 'request_seconds_bucket{op="upload",le="+Inf"} 4' in text
+    assert 'request_seconds_count{op="upload"} 4' in text
+    assert 'request_seconds_bucket{op="upload",le="0.00025"} 1' in text
+
+
+def test_rendered_counters_and_gauges():
+    registry = metrics.Registry()
+    counter = registry.counter("requests_total", "Requests", labels={"op": 'say "hi"\n'})
+    counter.inc()
+    counter.inc(2)
+    registry.gauge("queued_jobs", "Jobs queued", function=lambda: 1.5)
+    text = registry.render()
+    assert 'requests_total{op="say \\"hi\\"\\n"} 3' in text
+    assert "queued_jobs 1.5" in text
+    assert "# HELP queued_jobs Jobs queued" in text
+
+
+def test_same_name_with_another_type_is_refused():
+    registry = metrics.Registry()
+    registry.counter("things_total", "Things")
+    with pytest.raises(ValueError):
+        registry.gauge("things_total", "Things")
+
+
+def test_snapshot_summarises_histograms():
+    registry = metrics.Registry()
+    uniform_histogram(registry)
+    registry.counter("jobs_total", "Jobs", labels={"state": "done"}).inc(4)
+    registry.counter("jobs_total", "Jobs", labels={"state": "failed"}).inc()
+    snapshot = registry.snapshot()
+    summary = snapshot["job_seconds"]
+    assert summary["count"] == 100 and summary["mean"] == pytest.approx(50.5)
+    assert summary["p50"] == pytest.approx(50.0) and summary["p90"] == pytest.approx(90.0)
+    assert snapshot["jobs_total"] == {"state=done": 4, "state=failed": 1}
+
+
+def test_prometheus_endpoint_serves_the_registry():
+    registry = metrics.Registry()
+    registry.counter("requests_total", "Requests").inc()
+
+    async def scrape(path):
+        server = await metrics.serve_prometheus(registry, "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode("utf-8"))
+            response = await reader.read()
+            writer.close()
+            return response.decode("utf-8")
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = asyncio.run(scrape("/metrics"))
+    assert response.startswith("HTTP/1.1 200 OK")
+    assert f"Content-Type: {metrics.CONTENT_TYPE}" in response
+    assert response.endswith("requests_total 1\n")
+    assert asyncio.run(scrape("/other")).startswith("HTTP/1.1 404")
@@ -0,0 +1,102 @@
+import os
+import threading
+
+from common import metrics
+from worker.result_cache import ResultCache
+
+
+def write_model(directory, name, size):
+    path = directory / name
+    path.write_bytes(b"m" * size)
+    return str(path)
+
+
+def test_lookup_counts_hits_and_misses(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=100)
+    assert cache.lookup("key") is None
+    cache.store("key", write_model(tmp_path, "best.pt", 10))
+    cached = cache.lookup("key")
+    assert open(cached, "rb").read() == b"m" * 10
+    assert cache.stats() == {"hits": 1, "misses": 1, "evictions": 0, "entries": 1, "bytes": 10}
+
+
+def test_least_recently_used_entries_are_evicted_above_max_bytes(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=10)
+    cache.store("a", write_model(tmp_path, "a.pt", 4))
+    cache.store("b", write_model(tmp_path, "b.pt", 4))
+    assert cache.lookup("a") is not None  # Now more recent than b
+    cache.store("c", write_model(tmp_path, "c.pt", 4))
+    assert cache.lookup("b") is None
+    assert cache.lookup("a") is not None and cache.lookup("c") is not None
+    assert not os.path.exists(os.path.join(cache.root, "b.pt"))
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 8
+
+
+def test_model_larger_than_the_cache_is_not_stored(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=0)
+    cache.store("key", write_model(tmp_path, "best.pt", 10))
+    assert cache.lookup("key") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_recency_survives_a_restart_through_access_times(tmp_path):
+    root = str(tmp_path / "cache")
+    cache = ResultCache(root, max_bytes=10)
+    cache.store("old", write_model(tmp_path, "old.pt", 4))
+    cache.store("new", write_model(tmp_path, "new.pt", 4))
+    os.utime(os.path.join(root, "new.pt"), (1000, 1000))
+    os.utime(os.path.join(root, "old.pt"), (2000, 2000))  # Used after "new" before the restart
+
+    restarted = ResultCache(root, max_bytes=10)
+    assert restarted.stats()["bytes"] == 8
+    restarted.store("third", write_model(tmp_path, "third.pt", 4))
+    assert restarted.lookup("new") is None
+    assert restarted.lookup("old") is not None
+
+
+def test_counters_are_exposed_as_metrics(tmp_path):
+    registry = metrics.Registry()
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=4, registry=registry)
+    cache.lookup("missing")
+    cache.store("a", write_model(tmp_path, "a.pt", 4))
+    cache.store("b", write_model(tmp_path, "b.pt", 4))
+    cache.lookup("b")
+    snapshot = registry.snapshot()
+    assert snapshot["worker_result_cache_hits_total"] == 1
+    assert snapshot["worker_result_cache_misses_total"] == 1
+    assert snapshot["worker_result_cache_evictions_total"] == 1
+    assert snapshot["worker_result_cache_bytes"] == 4
+
+
+def test_entry_removed_behind_the_cache_is_a_miss(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=100)
+    cache.store("key", write_model(tmp_path, "best.pt", 10))
+    os.remove(os.path.join(cache.root, "key.pt"))
+    assert cache.lookup("key") is None
+    assert cache.stats() == {"hits": 0, "misses": 1, "evictions": 0, "entries": 0, "bytes": 0}
+
+
+def test_lookups_race_with_evicting_stores(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"), max_bytes=8)
+    models = [write_model(tmp_path, f"{index}.pt", 4) for index in range(50)]
+    errors = []
+
+    def look_up():
+        try:
+            for _ in range(20):
+                for index in range(50):
+                    cache.lookup(str(index))
+        except Exception as e:  # Reported below, from the main thread
+            errors.append(e)
+
+    readers = [threading.Thread(target=look_up) for _ in range(4)]
+    for reader in readers:
+        reader.start()
+    for index, model in enumerate(models):
+        cache.store(str(index), model)
+    for reader in readers:
+        reader.join()
+    assert errors == []
+    stats = cache.stats()
+    assert stats["entries"] == 2 and stats["bytes"] == 8
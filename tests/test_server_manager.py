@@ -0,0 +1,42 @@
+import socket
+
+import pytest
+
+from manager.server_manager import CircuitBreaker, ServerManager
+
+
+def heartbeat_info(port, clients=0):
+    return {"port": port, "capacity": 1, "load": {"clients": clients}}
+
+
+def test_heartbeat_closes_a_circuit_opened_by_relay_failures():
+    manager = ServerManager([])
+    server = manager.register(heartbeat_info(5001), "10.0.0.1")
+    assert manager.choose_server()["port"] == 5001
+
+    for _ in range(manager.failure_threshold):
+        manager._record_failure(server, socket.timeout("timed out"))
+    assert manager.health(server).state == CircuitBreaker.OPEN
+    assert manager.choose_server()["port"] is None
+
+    manager.heartbeat(server, heartbeat_info(5001))
+    assert manager.health(server).state == CircuitBreaker.CLOSED
+    assert manager.choose_server() is server
+
+
+def test_job_owner_is_found_by_worker_id_across_hosts_sharing_a_port():
+    manager = ServerManager([])
+    first = manager.register(dict(heartbeat_info(5001), load={"clients": 0, "worker_id": "a1"}), "10.0.0.1")
+    second = manager.register(dict(heartbeat_info(5001), load={"clients": 0, "worker_id": "b2"}), "10.0.0.2")
+    assert manager.get_job_owner("a1-abcdef") is first
+    assert manager.get_job_owner("b2-abcdef") is second
+    with pytest.raises(LookupError):
+        manager.get_job_owner("5001-abcdef")  # Named by a port two servers share
+
+
+def test_job_named_by_port_is_found_when_the_port_is_unique():
+    manager = ServerManager([])
+    server = manager.register(heartbeat_info(5001), "10.0.0.1")
+    assert manager.get_job_owner("5001-abcdef") is server
+    with pytest.raises(LookupError):
+        manager.get_job_owner("5002-abcdef")
@@ -0,0 +1,136 @@
+import argparse
+import random
+from collections import Counter
+
+import pytest
+
+from manager import simulator
+from manager.server_manager import (STRATEGIES, ConsistentHashing, PowerOfTwoChoices, Strategy, WeightedRoundRobin,
+                                    make_strategy)
+
+
+def make_servers(capacities):
+    return [{"host": "test", "port": port, "capacity": capacity} for port, capacity in enumerate(capacities)]
+
+
+class RecordingRandom(random.Random):
+    """Seeded random source that remembers the servers each ``sample`` drew."""
+
+    def __init__(self, seed):
+        super().__init__(seed)
+        self.samples = []
+
+    def sample(self, population, k, **kwargs):
+        drawn = super().sample(population, k, **kwargs)
+        self.samples.append(drawn)
+        return drawn
+
+
+def test_strategy_cannot_be_instantiated_without_choose():
+    with pytest.raises(TypeError):
+        Strategy()
+
+    class Incomplete(Strategy):
+        pass
+
+    with pytest.raises(TypeError):
+        Incomplete()
+
+
+def test_make_strategy_knows_every_strategy():
+    for name, strategy_class in STRATEGIES.items():
+        assert type(make_strategy(name)) is strategy_class
+    with pytest.raises(ValueError):
+        make_strategy("random")
+
+
+def test_power_of_two_never_picks_the_worse_sample():
+    rng = RecordingRandom(7)
+    strategy = PowerOfTwoChoices(rng)
+    servers = make_servers([1] * 8)
+    for trial in range(500):
+        loads = {server["port"]: random.Random(trial * 10 + server["port"]).random() for server in servers}
+        chosen = strategy.choose(servers, lambda server: loads[server["port"]])
+        first, second = rng.samples[-1]
+        assert chosen in (first, second)
+        assert loads[chosen["port"]] == min(loads[first["port"]], loads[second["port"]])
+
+
+def test_power_of_two_with_a_single_server():
+    [server] = make_servers([1])
+    assert PowerOfTwoChoices(random.Random(1)).choose([server], lambda s: 0.0) is server
+
+
+def test_weighted_round_robin_follows_capacity():
+    strategy = WeightedRoundRobin()
+    servers = make_servers([1, 2, 4])
+    picks = Counter(strategy.choose(servers, lambda s: 0.0)["port"] for _ in range(700))
+    assert picks == {0: 100, 1: 200, 2: 400}
+
+
+def test_weighted_round_robin_interleaves_servers():
+    strategy = WeightedRoundRobin()
+    servers = make_servers([3, 1, 1])
+    picks = [strategy.choose(servers, lambda s: 0.0)["port"] for _ in range(50)]
+    assert all(picks[i:i + 3] != [0, 0, 0] for i in range(len(picks) - 2))
+    assert picks.count(0) == 30
+
+
+def test_consistent_hashing_keeps_a_key_on_its_server():
+    servers = make_servers([1, 1, 1, 1])
+    strategy = ConsistentHashing()
+    keys = [f"dataset-{i}" for i in range(200)]
+    first = {key: strategy.choose(servers, lambda s: 0.0, key)["port"] for key in keys}
+    assert {key: strategy.choose(servers, lambda s: 0.0, key)["port"] for key in keys} == first
+    assert {key: ConsistentHashing().choose(servers, lambda s: 0.0, key)["port"] for key in keys} == first
+    assert len(set(first.values())) == len(servers)
+
+
+def test_consistent_hashing_moves_only_the_keys_of_a_removed_server():
+    servers = make_servers([1] * 5)
+    strategy = ConsistentHashing()
+    keys = [f"dataset-{i}" for i in range(5000)]
+    before = {key: strategy.choose(servers, lambda s: 0.0, key)["port"] for key in keys}
+    removed = servers.pop(2)
+    after = {key: strategy.choose(servers, lambda s: 0.0, key)["port"] for key in keys}
+    moved = [key for key in keys if before[key] != after[key]]
+    assert all(before[key] == removed["port"] for key in moved)
+    assert abs(len(moved) / len(keys) - 1 / 5) < 0.05
+
+
+def test_consistent_hashing_sends_requests_without_key_to_the_least_loaded():
+    servers = make_servers([1, 1, 1])
+    loads = {0: 2.0, 1: 0.5, 2: 1.0}
+    assert ConsistentHashing().choose(servers, lambda s: loads[s["port"]])["port"] == 1
+
+
+def simulation_args(**overrides):
+    args = {"jobs": 300, "utilisation": 0.8, "mean_training": 60.0, "training_spread": 1.0, "burst_size": 5.0,
+            "datasets": 20, "seed": 3}
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+def test_trace_is_reproducible():
+    trace = simulator.make_trace(simulation_args(), 4)
+    assert len(trace) == 300
+    assert trace == simulator.make_trace(simulation_args(), 4)
+    assert [job["time"] for job in trace] == sorted(job["time"] for job in trace)
+    assert trace != simulator.make_trace(simulation_args(seed=4), 4)
+
+
+@pytest.mark.parametrize("name", list(STRATEGIES))
+def test_simulation_completes_every_job(name):
+    capacities = [1, 2, 1]
+    trace = simulator.make_trace(simulation_args(), sum(capacities))
+    times = simulator.simulate(name, capacities, trace, refresh=2.0, seed=3)
+    assert len(times) == len(trace)
+    assert all(time >= job["duration"] - 1e-9 for time, job in zip(times, trace))
+    assert times == simulator.simulate(name, capacities, trace, refresh=2.0, seed=3)
+
+
+def test_percentile():
+    values = list(range(100))
+    assert simulator.percentile(values, 0.5) == 50
+    assert simulator.percentile(values, 0.99) == 99
+    assert simulator.percentile(values, 1.0) == 99
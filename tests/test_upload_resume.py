@@ -0,0 +1,213 @@
+import asyncio
+import contextlib
+import os
+import random
+import socket
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from client.model.train_model import TrainModel
+from common import compression
+from common import manifest
+from common import wire_protocol as wp
+from worker import upload_session
+from worker import worker_server
+from worker.blob_store import BlobStore
+from worker.job_index import JobIndex
+from worker.job_queue import JobQueue
+from worker.result_cache import ResultCache
+from worker.upload_session import SessionStore
+
+# Client bytes let through before the connection is cut: inside the largest file, raw or compressed, and past
+# the first receive buffer the worker writes out
+CUT_AFTER = 3 * wp.RECV_BUFFER_SIZE // 2
+LABEL_FILE_SIZE = 4 * 1024 * 1024  # Largest file, sent first, and compressible
+IMAGE_FILE_SIZE = 3 * 1024 * 1024
+
+
+def make_dataset(dataset_path):
+    """Write a dataset whose largest file is a label file, so the cut lands inside a compressible file."""
+    rng = random.Random(7)
+    os.makedirs(dataset_path)
+    lines = []
+    size = 0
+    while size < LABEL_FILE_SIZE:
+        line = f"{rng.randrange(5)} {rng.random():.6f} {rng.random():.6f} {rng.random():.6f} {rng.random():.6f}\n"
+        lines.append(line)
+        size += len(line)
+    with open(os.path.join(dataset_path, "1.txt"), "w") as f:
+        f.writelines(lines)
+    with open(os.path.join(dataset_path, "1.png"), "wb") as f:
+        f.write(rng.randbytes(IMAGE_FILE_SIZE))
+    with open(os.path.join(dataset_path, "2.txt"), "w") as f:
+        f.write("0 0.5 0.5 0.25 0.25\n")
+    with open(os.path.join(dataset_path, "labels.json"), "w") as f:
+        f.write('[{"name": "cat"}]')
+
+
+def fake_training(job):
+    model_path = os.path.join(job.new_dir, "best.pt")
+    with open(model_path, "wb") as f:
+        f.write(b"model")
+    return model_path
+
+
+def upload(address, dataset_path, session_id, mode, compress, resume):
+    """Upload a dataset with the client over a single connection, detaching once the job is queued."""
+    client = TrainModel(upload_mode=mode, compress=compress, connections=1)
+    files = client._get_valid_files(dataset_path)
+    with socket.create_connection(address) as sock:
+        transfer = compression.negotiate(sock, compress)
+        return client.send_dataset(sock, "dataset", dataset_path, files, transfer, session_id, resume, detach=True)
+
+
+@pytest.fixture
+def worker(tmp_path, monkeypatch):
+    """The worker module, with its stores in a temporary directory and progress journaled after every write."""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(upload_session, "CHECKPOINT_BYTES", 1)
+    os.makedirs(worker_server.DATA_DIR)
+    monkeypatch.setattr(worker_server, "job_index", JobIndex("jobs.sqlite3"))
+    monkeypatch.setattr(worker_server, "blob_store", BlobStore("blob_store"))
+    monkeypatch.setattr(worker_server, "session_store", SessionStore("upload_sessions", 3600))
+    monkeypatch.setattr(worker_server, "result_cache", ResultCache("result_cache", 0))
+    monkeypatch.setattr(worker_server, "job_queue", None)  # Created by running_worker, on its event loop
+    return worker_server
+
+
+@contextlib.asynccontextmanager
+async def running_worker(worker, cut_after):
+    """Serve the worker on a local port, behind a proxy that cuts every connection after ``cut_after`` bytes.
+
+    Yields the addresses of the worker and of the proxy.
+    """
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=worker.IO_THREADS))
+    worker.job_queue = JobQueue(1, fake_training, index=worker.job_index, data_dir=worker.DATA_DIR,
+                                adopt=worker.adopt_model)
+    worker.job_queue.start()
+    listener = socket.create_server(("127.0.0.1", 0))
+    listener.setblocking(False)
+    tasks = set()
+
+    async def accept():
+        while True:
+            sock, addr = await loop.sock_accept(listener)
+            task = asyncio.create_task(worker.handle_connection(sock, addr))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def cut(client_reader, client_writer):
+        worker_reader, worker_writer = await asyncio.open_connection(*listener.getsockname())
+
+        async def downstream():
+            while data := await worker_reader.read(65536):
+                client_writer.write(data)
+                await client_writer.drain()
+
+        replies = asyncio.create_task(downstream())
+        forwarded = 0
+        while forwarded < cut_after:
+            data = await client_reader.read(min(65536, cut_after - forwarded))
+            if not data:
+                break
+            worker_writer.write(data)
+            await worker_writer.drain()
+            forwarded += len(data)
+        replies.cancel()
+        worker_writer.transport.abort()
+        client_writer.transport.abort()
+
+    accepting = asyncio.create_task(accept())
+    proxy = await asyncio.start_server(cut, "127.0.0.1", 0)
+    try:
+        yield listener.getsockname(), proxy.sockets[0].getsockname()
+    finally:
+        proxy.close()
+        accepting.cancel()
+        for task in list(tasks):
+            task.cancel()
+        listener.close()
+        worker.job_queue.shutdown()
+
+
+async def wait_suspended(worker, session_id):
+    """Wait until the worker gave up on the cut connection and made the session resumable."""
+    for _ in range(200):
+        if not worker.upload_sessions.has(session_id):
+            return
+        await asyncio.sleep(0.05)
+    raise AssertionError(f"Session {session_id} was never suspended")
+
+
+async def cut_upload(worker, dataset_path, session_id, mode, compress):
+    """Start an upload through the cutting proxy and return the durable offsets of the suspended session."""
+    async with running_worker(worker, CUT_AFTER) as (_, proxy_address):
+        with pytest.raises((OSError, wp.ProtocolError)):
+            await asyncio.to_thread(upload, proxy_address, dataset_path, session_id, mode, compress, False)
+        await wait_suspended(worker, session_id)
+    _, journal = worker.session_store.load(session_id)
+    return journal.offsets()
+
+
+@pytest.mark.parametrize("mode", ["incremental", "files"])
+@pytest.mark.parametrize("compress", [True, False])
+def test_resumed_upload_matches_manifest(worker, tmp_path, mode, compress):
+    dataset_path = str(tmp_path / "client" / "dataset")
+    make_dataset(dataset_path)
+    entries = {entry["name"]: entry for entry in manifest.build_manifest(dataset_path, os.listdir(dataset_path))}
+    session_id = f"{mode}-{compress}"
+
+    async def scenario():
+        offsets = await cut_upload(worker, dataset_path, session_id, mode, compress)
+        cut_file = entries["1.txt"]["digest"] if mode == "incremental" else "1.txt"
+        assert 0 < offsets[cut_file] < LABEL_FILE_SIZE, "the cut should leave the largest file partly received"
+
+        async with running_worker(worker, cut_after=float("inf")) as (worker_address, _):
+            return await asyncio.to_thread(upload, worker_address, dataset_path, session_id, mode, compress, True)
+
+    receipt = asyncio.run(scenario())
+
+    dataset_dir = os.path.join(worker.DATA_DIR, receipt["dataset_id"])
+    for name, entry in entries.items():
+        received_path = worker.dataset_path_for(dataset_dir, name)
+        assert os.path.getsize(received_path) == entry["size"]
+        assert manifest.file_digest(received_path) == entry["digest"], name
+    assert not os.path.exists(worker.session_store.state_dir(session_id))
+
+
+def test_expired_session_is_swept_and_cannot_resume(worker, tmp_path, monkeypatch):
+    dataset_path = str(tmp_path / "client" / "dataset")
+    make_dataset(dataset_path)
+    session_id = "expired"
+
+    async def scenario():
+        await cut_upload(worker, dataset_path, session_id, "files", False)
+        meta, _ = worker.session_store.load(session_id)
+        monkeypatch.setattr(worker.session_store, "ttl", 0)
+        assert await asyncio.to_thread(worker.sweep_sessions) == [meta["job_id"]]
+        assert not os.path.exists(os.path.join(worker.DATA_DIR, meta["dir_number"]))
+        assert worker.job_index.dataset_ids("dataset") == []
+
+        async with running_worker(worker, cut_after=float("inf")) as (worker_address, _):
+            with pytest.raises(wp.RemoteError, match="Unknown upload session"):
+                await asyncio.to_thread(upload, worker_address, dataset_path, session_id, "files", False, True)
+
+    asyncio.run(scenario())
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="names synced descriptors through /proc")
+def test_checkpoint_syncs_only_the_files_of_the_upload(tmp_path, monkeypatch):
+    synced = []
+    real_fsync = os.fsync
+    monkeypatch.setattr(os, "sync", lambda: pytest.fail("a checkpoint must not flush the whole machine"),
+                        raising=False)
+    monkeypatch.setattr(os, "fsync", lambda fd: (synced.append(os.readlink(f"/proc/self/fd/{fd}")), real_fsync(fd)))
+    journal = upload_session.UploadJournal(str(tmp_path / "journal"))
+    for name in ("a.jpg", "b.jpg"):
+        (tmp_path / name).write_bytes(b"data")
+        journal.file_done(name, 4, str(tmp_path / name))
+    journal.commit()
+    assert synced == [str(tmp_path / "a.jpg"), str(tmp_path / "b.jpg"), str(tmp_path / "journal")]
+    assert journal.offsets() == {"a.jpg": 4, "b.jpg": 4}